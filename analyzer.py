@@ -1,46 +1,78 @@
 import json
 import time
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import asdict, dataclass, field, replace
+from typing import Callable, Iterator, Optional, Union
 
 from databases.mysql import MySqlDatabase
 from databases.postgresql import PostgresDatabase
-from databases.sql import SqlDatabase
-from utils import generate_queries, generate_id_query
+from checkpoint import Checkpoint
+from databases.sql import CACHE_MODES, EXECUTION_MODES, FETCH_MODES, IndexStrategy, SqlDatabase
+from databases.sqlite import SqliteDatabase
+from fitting import SAMPLINGS, SeriesFit, fit_series, refine_sizes, size_grid
+from generator import COLUMN_KINDS, SpatialProfile
+from load_generator import LoadGenerator
+from query_bank import SELECTIVITY_TOLERANCE, QueryBank
+from results_store import ResultsStore
+from snapshots import SnapshotCache
+from timing import Distribution, TimingPolicy, measure, summarize
+from tracing import span
+from utils import generate_queries, generate_id_query, strategy_queries
+
+
+# Minimum trials per measured query, shared by run_analysis and the scheduler's jobs
+SELECT_TRIALS = 100
+GEOSPATIAL_TRIALS = 10
+JOIN_TRIALS = 10
+GEOSPATIAL_JOIN_TRIALS = 2
+POINT_POLY_TRIALS = 2
+ID_TRIALS = 100
+# The point/polygon join is measured on its own grid of sizes
+POINT_POLY_STOP = 20000
+POINT_POLY_POINTS = 10
 
 
 @dataclass
 class SelectSection:
-    str_plain: list[float]
-    str_ndx: list[float]
-    int_plain: list[float]
-    int_ndx: list[float]
-    point_plain: Optional[list[float]]
-    point_ndx: Optional[list[float]]
-    poly_plain: Optional[list[float]]
-    poly_ndx: Optional[list[float]]
+    str_plain: list[Distribution]
+    str_ndx: list[Distribution]
+    int_plain: list[Distribution]
+    int_ndx: list[Distribution]
+    point_plain: Optional[list[Distribution]]
+    point_ndx: Optional[list[Distribution]]
+    poly_plain: Optional[list[Distribution]]
+    poly_ndx: Optional[list[Distribution]]
 
 
 @dataclass
 class JoinSection:
-    str_plain: list[float]
-    str_ndx: list[float]
-    int_plain: list[float]
-    int_ndx: list[float]
-    point_plain: Optional[list[float]]
-    point_ndx: Optional[list[float]]
-    poly_plain: Optional[list[float]]
-    poly_ndx: Optional[list[float]]
-    point_poly_plain: Optional[list[float]]
-    point_poly_ndx: Optional[list[float]]
+    str_plain: list[Distribution]
+    str_ndx: list[Distribution]
+    int_plain: list[Distribution]
+    int_ndx: list[Distribution]
+    point_plain: Optional[list[Distribution]]
+    point_ndx: Optional[list[Distribution]]
+    poly_plain: Optional[list[Distribution]]
+    poly_ndx: Optional[list[Distribution]]
+    point_poly_plain: Optional[list[Distribution]]
+    point_poly_ndx: Optional[list[Distribution]]
 
 
 @dataclass
 class IdSection:
-    integer: list[float]
-    uuid: list[float]
-    binary: Optional[list[float]]
-    char: list[float]
+    integer: list[Distribution]
+    uuid: list[Distribution]
+    binary: Optional[list[Distribution]]
+    char: list[Distribution]
+
+
+@dataclass
+class StorageSample:
+    size: int
+    table_bytes: Optional[int]
+    index_bytes: Optional[int]
+    index_build_seconds: Optional[float]  # None when the index was kept from a smaller size
+    builds: list[dict]  # Build-option sweep: options, seconds and index_bytes per variant
+    strategies: list[dict] = field(default_factory=list)  # Index-strategy matrix: strategy, seconds and index_bytes
 
 
 @dataclass
@@ -48,15 +80,397 @@ class Report:
     selects: SelectSection
     joins: JoinSection
     ids: Optional[IdSection]
+    storage: Optional[dict[str, list[StorageSample]]] = None
+    bank: Optional[dict[str, list[Distribution]]] = None  # '{column}/{query name}' -> one point per size
+    execution: Optional[dict[str, list[dict[str, float]]]] = None  # Median per execution mode, per size
+    cold: Optional[dict[str, list[Distribution]]] = None  # Same series as selects and ids, timed from an evicted cache
+    sizes: Optional[dict[str, list[int]]] = None  # Table sizes every section's points were measured at, in order
+    fits: Optional[dict[str, SeriesFit]] = None  # Complexity model fitted to every series' medians
+    strategies: Optional[dict[str, list[Distribution]]] = None  # '{strategy}/selects/{column}', joins and bank series
+    matrix: Optional[dict[str, list[dict]]] = None  # '{table}/{strategy}' -> medians, build seconds and bytes per size
+    cache_eviction: Optional[str] = None  # How the cold section's cache was evicted, and what that leaves cached
 
 
 class Analyzer:
 
-    def __init__(self, database: SqlDatabase):
+    def __init__(self, database: SqlDatabase, seed: Optional[int] = None, snapshots: Optional[SnapshotCache] = None,
+                 results: Optional[ResultsStore] = None):
         self.database: SqlDatabase = database
+        self.seed = seed
+        self.snapshots = snapshots  # Only used with a fixed seed, otherwise the data is not reproducible
+        self.results = results  # Every measured point and its raw samples are appended here as they finish
+        self.run_id: Optional[int] = None
+        self.checkpoint: Optional[Checkpoint] = None
+        self.pending: dict[str, dict] = {}  # Points of the (table, size) unit in progress, keyed by series
         self.report: Optional[Report] = None
 
-    def run_analysis(self, out_file: str, start: int = 100, stop: int = 1000000, stop_small: int = 10000, geospatial: bool = False, ids: bool = False, num_points: int = 10):
+        self.growth = False
+        self.analyze = False
+        self.vacuum = False
+        self.index_policy = 'keep'
+        self.timing = TimingPolicy()
+        self.explain = False
+        self.fetch_modes: dict[str, str] = {}
+        self.arraysize = 1000
+        self.loaded: dict[str, int] = {}
+        self.indexed: set[str] = set()
+        self.index_options: list[dict] = []
+        self.index_builds: dict[str, Optional[float]] = {}
+        self.query_bank: Optional[dict] = None
+        self.execution_modes: tuple[str, ...] = ('literal',)
+        self.cache_modes: tuple[str, ...] = ('warm',)
+        self.cold_trials = 5
+        self.statements = 0
+        self.sampling = 'linear'
+        self.adaptive_points = 0
+        self.index_strategies: tuple[str, ...] = ()
+
+    def prepare_table(self, name: str, columns: dict[str, str], n: int,
+                      index: Optional[str] = None, geospatial: bool = False) -> None:
+        # Brings a table to n rows, appending only the delta over what is already loaded when growing
+        with span('prepare_table', 'load', table=name, rows=n):
+            loaded = self.loaded.get(name, 0)
+            if loaded and (n < loaded or (not self.growth and n != loaded)):
+                self.release_table(name, index)
+                loaded = 0
+
+            if index is not None and name in self.indexed and self.index_policy == 'rebuild':
+                self.database.drop_index(index, name)
+                self.indexed.discard(name)
+
+            if n > loaded and loaded == 0 and self.snapshots is not None and self.seed is not None:
+                self.load_snapshot(name, columns, n)
+            elif n > loaded:
+                self.database.insert_dummy_data(name, n - loaded, *[x for col in columns.items() for x in col],
+                                                seed=self.seed, offset=loaded)
+            self.loaded[name] = n
+
+            self.index_builds[name] = None
+            if index is not None and name not in self.indexed:
+                self.index_builds[name] = self.build_index(name, index, geospatial)
+
+            if self.analyze or self.vacuum:
+                with span('analyze_table', 'load', table=name, vacuum=self.vacuum):
+                    self.database.analyze_table(name, self.vacuum)
+
+    def build_index(self, name: str, index: str, geospatial: bool = False, options: Optional[dict] = None) -> float:
+        with span('build_index', 'index', table=name, index=index, options=options):
+            t1 = time.perf_counter()
+            self.database.create_index(name, index, index, geospatial, options)
+            seconds = time.perf_counter() - t1
+        self.indexed.add(name)
+        print(f'Built index {index} on {name}' + (f' with {options}' if options else '') + f' in {seconds} seconds')
+        return seconds
+
+    def build_strategy_index(self, name: str, index: str, strategy: IndexStrategy, columns: dict[str, str],
+                             n: int) -> float:
+        with span('build_index', 'index', table=name, index=index, strategy=strategy.name):
+            t1 = time.perf_counter()
+            self.database.create_strategy_index(name, index, index, strategy, list(columns), n)
+            seconds = time.perf_counter() - t1
+        self.indexed.add(name)
+        print(f'Built {strategy.name} index {index} on {name} in {seconds} seconds')
+        return seconds
+
+    def measure_strategies(self, name: str, columns: dict[str, str], column: str, n: int, queries: list[str],
+                           num_trials: int, num_join_trials: int,
+                           geospatial: bool = False) -> tuple[dict[str, Distribution], list[dict]]:
+        # Swaps the column's index for each strategy that can index it, timing the indexed select and join (and
+        # the query bank) against each, then restores the default index the other sections and sizes expect
+        kind = COLUMN_KINDS[columns[column]]
+        max_trials = num_trials if geospatial else None
+        points = {}
+        builds = []
+        for strategy in (self.database.index_strategies[s] for s in self.index_strategies):
+            if kind not in strategy.kinds:
+                continue
+            if name in self.indexed:
+                self.database.drop_index(column, name)
+                self.indexed.discard(name)
+            seconds = self.build_strategy_index(name, column, strategy, columns, n)
+            builds.append({'strategy': strategy.name, 'seconds': seconds,
+                           'index_bytes': self.database.table_size(name)['index_bytes']})
+
+            # queries are the indexed select and join the default index was timed with
+            select, join = strategy_queries(queries, column, strategy, n)
+            # Invisible indexes are expected to be passed over
+            indexes = (column,) if strategy.visible else ()
+            series = f'{strategy.name}/selects/{column}'
+            points[series] = self.record_point(f'strategies/{series}', n, select,
+                                               self.measure_query(select, num_trials, indexes,
+                                                                  max_trials=max_trials))
+            series = f'{strategy.name}/joins/{column}'
+            points[series] = self.record_point(f'strategies/{series}', n, join,
+                                               self.measure_query(join, num_join_trials, indexes, 'join',
+                                                                  max_trials=num_join_trials))
+            print(f'Timed {strategy.name} on {column}: median {points[f"{strategy.name}/selects/{column}"].median} / '
+                  f'{points[series].median}')
+
+            if self.query_bank is not None:
+                points.update(self.measure_bank(
+                    name, columns, column, n, num_trials, indexes=indexes, label=f'{strategy.name}/bank/{column}',
+                    rewrite=lambda template: strategy_queries([template], column, strategy, n)[0],
+                    prefix='strategies', max_trials=max_trials))
+
+        # Nothing to restore when no strategy applied to the column's type
+        if builds:
+            if name in self.indexed:
+                self.database.drop_index(column, name)
+            self.indexed.discard(name)
+            self.build_index(name, column, geospatial)
+        return points, builds
+
+    @staticmethod
+    def strategy_matrix(name: str, column: str, sizes: list[int], selects: list[Distribution],
+                        joins: list[Distribution], samples: list[StorageSample],
+                        strategies: dict[str, list[Distribution]]) -> dict[str, list[dict]]:
+        # Select and join medians next to build seconds and index bytes, per strategy and size; 'default' is the
+        # index every other section is measured with
+        matrix = {f'{name}/default': [
+            {'size': size, 'select': select.median, 'join': join.median,
+             'build_seconds': sample.index_build_seconds, 'index_bytes': sample.index_bytes}
+            for size, select, join, sample in zip(sizes, selects, joins, samples)]}
+        for k, (size, sample) in enumerate(zip(sizes, samples)):
+            for build in sample.strategies:
+                strategy = build['strategy']
+                matrix.setdefault(f'{name}/{strategy}', []).append({
+                    'size': size,
+                    'select': strategies[f'{strategy}/selects/{column}'][k].median,
+                    'join': strategies[f'{strategy}/joins/{column}'][k].median,
+                    'build_seconds': build['seconds'],
+                    'index_bytes': build['index_bytes']
+                })
+        return matrix
+
+    def record_storage(self, name: str, n: int, index: Optional[str] = None,
+                       geospatial: bool = False, strategies: Optional[list[dict]] = None) -> StorageSample:
+        sizes = self.database.table_size(name)
+        builds = []
+        if index is not None and self.index_options:
+            for options in self.index_options:
+                self.database.drop_index(index, name)
+                seconds = self.build_index(name, index, geospatial, options)
+                builds.append({'options': options, 'seconds': seconds,
+                               'index_bytes': self.database.table_size(name)['index_bytes']})
+            # Later sizes and queries should see the index built with default options again
+            self.database.drop_index(index, name)
+            self.build_index(name, index, geospatial)
+        return StorageSample(n, sizes['table_bytes'], sizes['index_bytes'], self.index_builds.get(name), builds,
+                             strategies or [])
+
+    def load_snapshot(self, name: str, columns: dict[str, str], n: int) -> None:
+        geometry = any(COLUMN_KINDS.get(type_name) in ('point', 'polygon') for type_name in columns.values())
+        key = SnapshotCache.key(self.database.engine, name, n, columns, self.seed,
+                                asdict(self.database.spatial) if geometry else None)
+        path = self.snapshots.get(key)
+        if path is not None:
+            print(f'Restoring {n} rows into {name} from snapshot {key[:12]}')
+            t1 = time.time()
+            with span('restore_snapshot', 'load', table=name, rows=n):
+                self.database.restore_snapshot(name, path)
+            t2 = time.time()
+            print(f'Restored {n} rows into {name} in {t2 - t1} seconds')
+            return
+
+        self.database.insert_dummy_data(name, n, *[x for col in columns.items() for x in col], seed=self.seed)
+        path = self.snapshots.path(key, self.database.snapshot_suffix)
+        self.database.save_snapshot(name, path)
+        self.snapshots.put(key, path, engine=self.database.engine, table=name, rows=n, columns=columns, seed=self.seed)
+
+    def measure_query(self, query: Union[str, list[str]], min_trials: int, indexes: tuple[str, ...] = (),
+                      kind: str = 'select', timer: Optional[Callable[[str], float]] = None,
+                      max_trials: Optional[int] = None) -> Distribution:
+        # A list of queries is rotated through, one per trial (warmups included)
+        queries = [query] if isinstance(query, str) else query
+        policy = self.timing if max_trials is None else replace(self.timing, max_trials=max_trials)
+        trials = iter(range(1 << 62))
+        query = queries[0]
+        timer = timer or self.database.time_query
+        mode = self.fetch_modes.get(kind, 'none')
+        if mode == 'none':
+            with span('measure', 'query', kind=kind, query=query, variants=len(queries)):
+                distribution = measure(lambda: timer(queries[next(trials) % len(queries)]), min_trials, policy)
+        else:
+            fetches = []
+
+            def trial():
+                fetches.append(self.database.fetch_query(queries[next(trials) % len(queries)], mode, self.arraysize))
+                return fetches[-1].total_seconds
+
+            with span('measure', 'query', kind=kind, query=query, variants=len(queries), fetch=mode):
+                distribution = measure(trial, min_trials, policy)
+            fetches = fetches[self.timing.warmup:]
+            first_rows = [f.first_row_seconds for f in fetches if f.first_row_seconds is not None]
+            distribution.fetch = {
+                'mode': mode,
+                'arraysize': self.arraysize,
+                'first_row': asdict(summarize(first_rows, self.timing.warmup)) if first_rows else None,
+                'rows': fetches[-1].rows,
+                'bytes': fetches[-1].bytes
+            }
+
+        if self.explain:
+            plan = self.database.explain_query(query)
+            distribution.plan = asdict(plan)
+            # Flags indexed queries whose plan never touched the index they are meant to measure
+            distribution.plan['index_missed'] = bool(indexes) and not set(indexes) & set(plan.indexes)
+            if distribution.plan['index_missed']:
+                print(f'Warning: plan did not use {" or ".join(indexes)} for: {query}')
+        return distribution
+
+    def measure_bank(self, name: str, columns: dict[str, str], column: str, n: int, min_trials: int,
+                     ordinal: str = 'id', indexes: tuple[str, ...] = (), label: Optional[str] = None,
+                     rewrite: Optional[Callable[[str], str]] = None, prefix: str = 'bank',
+                     max_trials: Optional[int] = None) -> dict[str, Distribution]:
+        bank = QueryBank(self.database, self.seed, **self.query_bank)
+        points = {}
+        for query in bank.build(name, columns, column, n, ordinal):
+            if rewrite is not None:
+                query = replace(query, template=rewrite(query.template))
+            matched = bank.count_matches(query)
+            # Wide ranges are expected to scan, so only selective queries are checked for index use
+            selective = query.selectivity is None or query.selectivity <= 0.01
+            distribution = self.measure_query(query.queries(self.database), min_trials,
+                                              indexes if selective else (), query.kind, self.database.time_literal,
+                                              max_trials)
+            distribution.matched = {
+                'selectivity': query.selectivity,
+                'rows': matched,
+                'mean': float(sum(matched) / len(matched)),
+                'fraction': float(sum(matched) / len(matched) / n) if n else 0.0
+            }
+            if query.selectivity is not None and n:
+                target = query.selectivity * n
+                off = abs(distribution.matched['mean'] - target) > max(SELECTIVITY_TOLERANCE * target, 1.0)
+                distribution.matched['off_target'] = off
+                if off:
+                    print(f'Warning: {query.name} on {name}.{column} matched {distribution.matched["fraction"]:.4%} '
+                          f'of rows, not {query.selectivity:.4%}')
+            series = f'{label or column}/{query.name}'
+            points[series] = self.record_point(f'{prefix}/{series}', n, query.template, distribution)
+            print(f'Timed {series} ({distribution.matched["mean"]:.1f} rows matched): median {distribution.median}')
+
+            for mode in self.execution_modes:
+                if mode == 'literal':
+                    continue
+                other = self.measure_execution(query.template, query.params, min_trials, mode, max_trials)
+                other.matched = distribution.matched
+                points[f'{series}/{mode}'] = self.record_point(f'{prefix}/{series}/{mode}', n, query.template, other)
+                print(f'Timed {series} {mode}: median {other.median} '
+                      f'({(other.median - distribution.median) / distribution.median:+.1%} vs literal)')
+        return points
+
+    def measure_cold(self, query: str, min_trials: int) -> Distribution:
+        # Every trial starts right after the engine's cache was evicted; the eviction itself is not timed
+        policy = replace(self.timing, warmup=0, max_trials=self.cold_trials)
+
+        def trial():
+            with span('evict_cache', 'query'):
+                self.database.evict_cache()
+            return self.database.time_query(query)
+
+        return measure(trial, min(min_trials, self.cold_trials), policy)
+
+    def prewarm(self, *tables: str) -> None:
+        t1 = time.time()
+        for table in tables:
+            self.database.prewarm(table)
+        print(f'Prewarmed {", ".join(tables)} in {time.time() - t1} seconds')
+
+    def measure_execution(self, template: str, params: list[tuple], min_trials: int, mode: str,
+                          max_trials: Optional[int] = None) -> Distribution:
+        # Client-side bound parameters, or one server-side prepared statement executed with each params tuple
+        trials = iter(range(1 << 62))
+        policy = self.timing if max_trials is None else replace(self.timing, max_trials=max_trials)
+        if mode == 'parameterized':
+            return measure(lambda: self.database.time_parameterized(template, params[next(trials) % len(params)]),
+                           min_trials, policy)
+        elif mode == 'prepared':
+            self.statements += 1
+            name = f'bank_{self.statements}'
+            self.database.prepare(name, template)
+            try:
+                return measure(lambda: self.database.time_prepared(name, params[next(trials) % len(params)]),
+                               min_trials, policy)
+            finally:
+                self.database.deallocate(name)
+        raise ValueError(f'Unknown execution mode {mode}')
+
+    def sample_sizes(self, grid: list[int], measured: list[int],
+                     curves: Callable[[], list[list[Distribution]]]) -> Iterator[int]:
+        # Yields the grid, then with adaptive sampling up to adaptive_points more sizes, two at a time, where the
+        # curves measured so far bend or are noisy. Every yielded size is appended to measured
+        queue = list(grid)
+        while queue:
+            measured.append(queue.pop(0))
+            yield measured[-1]
+            budget = len(grid) + self.adaptive_points - len(measured)
+            if not queue and self.sampling == 'adaptive' and budget > 0:
+                order = sorted(range(len(measured)), key=measured.__getitem__)
+                points = [[series[k] for k in order] for series in curves()]
+                queue = refine_sizes([measured[k] for k in order],
+                                     [([p.median for p in series],
+                                       [(p.ci_high - p.ci_low) / p.median if p.median else 0.0 for p in series])
+                                      for series in points], min(budget, 2))
+                if queue:
+                    print(f'Adaptive sampling adds sizes {queue}')
+
+    @staticmethod
+    def added_series(extras: dict[str, dict[str, list]], lengths: dict[tuple[str, str], int],
+                     count: int) -> dict[str, list]:
+        # Bank and cold series that gained one point per size of the table just measured
+        return {f'{prefix}/{series}': points for prefix, section in extras.items()
+                for series, points in section.items() if len(points) - lengths.get((prefix, series), 0) == count}
+
+    @staticmethod
+    def sort_by_size(measured: list[int], *series: list) -> list[int]:
+        # Adaptive sizes are measured after the grid; puts every series' points back in size order
+        if not measured:
+            return measured
+        order = sorted(range(len(measured)), key=measured.__getitem__)
+        for points in series:
+            points[-len(measured):] = [points[-len(measured):][k] for k in order]
+        measured.sort()
+        return measured
+
+    def record_point(self, series: str, size: int, query: str, distribution: Distribution) -> Distribution:
+        if self.results is not None and self.run_id is not None:
+            self.results.add_point(self.run_id, series, size, query, distribution)
+        self.pending[series] = {'query': query, 'distribution': asdict(distribution)}
+        return distribution
+
+    def finish_unit(self, table: str, size: int, storage: Optional[StorageSample] = None) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint.put(table, size, self.pending, asdict(storage) if storage is not None else None)
+        self.pending = {}
+
+    def resume_unit(self, table: str, size: int) -> Optional[tuple[dict[str, Distribution], Optional[StorageSample]]]:
+        entry = self.checkpoint.get(table, size) if self.checkpoint is not None else None
+        if entry is None:
+            return None
+        print(f'Skipping {table} at {size} rows, measured before the restart')
+        points = {series: self.record_point(series, size, point['query'], Distribution(**point['distribution']))
+                  for series, point in entry['points'].items()}
+        self.pending = {}
+        return points, StorageSample(**entry['storage']) if entry['storage'] is not None else None
+
+    def clean_tables(self, tables: dict[str, dict], id_tables: dict[str, dict]) -> None:
+        # Undoes whatever a crashed run left behind: rows of a half-finished load and any index that survived it
+        self.database.connection.rollback()
+        for name, data in {**tables, **id_tables}.items():
+            print(f'Cleaning up {name}')
+            self.database.clear_table(name)
+            if name in tables:
+                self.database.drop_index([x for x in data if 'ndx' in x][0], name, missing_ok=True)
+            self.loaded[name] = 0
+            self.indexed.discard(name)
+
+    def release_table(self, name: str, index: Optional[str] = None) -> None:
+        self.database.clear_table(name, index if name in self.indexed else None)
+        self.loaded[name] = 0
+        self.indexed.discard(name)
+
+    def table_definitions(self, geospatial: bool = False, ids: bool = False) -> tuple[dict, dict]:
         text_type = 'text' if type(self.database) is PostgresDatabase else 'char(36)'
         tables = {
             'int_test': {'id': 'int', 'int_plain': 'int', 'int_ndx': 'int'},
@@ -89,64 +503,221 @@ class Analyzer:
                 tables['poly_test'] = {'id': 'int',
                                        'poly_plain': 'polygon not null srid 4326',
                                        'poly_ndx': 'polygon not null srid 4326'}
-
-        step = (stop - start) // num_points
-        step_small = (stop_small - start) // num_points
+            elif type(self.database) is SqliteDatabase:  # WKB blobs with R*Tree indexes
+                tables['point_test'] = {'id': 'int', 'pt_plain': 'point', 'pt_ndx': 'point'}
+                tables['poly_test'] = {'id': 'int', 'poly_plain': 'polygon', 'poly_ndx': 'polygon'}
+
+        return tables, id_tables
+
+    def run_analysis(self, out_file: str, start: int = 100, stop: int = 1000000, stop_small: int = 10000,
+                     geospatial: bool = False, ids: bool = False, num_points: int = 10,
+                     growth: bool = False, analyze: bool = False, vacuum: bool = False, index_policy: str = 'keep',
+                     timing: Optional[TimingPolicy] = None, explain: bool = False,
+                     fetch_modes: Optional[dict[str, str]] = None, arraysize: int = 1000,
+                     index_options: Optional[list[dict]] = None, checkpoint: Optional[str] = None,
+                     resume: bool = False, spatial: Optional[SpatialProfile] = None,
+                     query_bank: Optional[dict] = None, execution_modes: tuple[str, ...] = ('literal',),
+                     cache_modes: tuple[str, ...] = ('warm',), cold_trials: int = 5, sampling: str = 'linear',
+                     adaptive_points: int = 4, extrapolate: tuple[int, ...] = (),
+                     index_strategies: tuple[str, ...] = ()):
+        if index_policy not in ('keep', 'rebuild'):
+            raise ValueError(f'Unknown index policy {index_policy}')
+        self.growth = growth
+        self.analyze = analyze
+        self.vacuum = vacuum
+        self.index_policy = index_policy
+        self.timing = timing or TimingPolicy()
+        self.explain = explain
+        # Per query kind ('select', 'join', 'point_poly', 'id'): one of FETCH_MODES, 'none' by default
+        self.fetch_modes = fetch_modes or {}
+        self.arraysize = arraysize
+        # Each entry rebuilds the index once per sample with these create_index options, e.g.
+        # {'maintenance_work_mem': '1GB', 'max_parallel_maintenance_workers': 4} or {'concurrently': True}
+        self.index_options = index_options or []
+        if spatial is not None:
+            self.database.spatial = spatial
+        # QueryBank options ({} for the defaults): adds key lookups, misses and selectivity-controlled predicates
+        # to every size, alongside the fixed queries
+        self.query_bank = query_bank
+        # Query bank queries are timed once per mode: inlined literal SQL, client-parameterized, server-prepared
+        self.execution_modes = tuple(execution_modes)
+        for mode in self.execution_modes:
+            if mode not in EXECUTION_MODES:
+                raise ValueError(f'Unknown execution mode {mode}')
+        if 'literal' not in self.execution_modes:
+            raise ValueError('Execution modes are compared against literal, which must be included')
+        # 'warm' prewarms every table before its queries are timed (warmup trials stay excluded); 'cold' adds
+        # selects and id lookups timed right after evicting the cache, reported separately
+        self.cache_modes = tuple(cache_modes)
+        self.cold_trials = cold_trials
+        for mode in self.cache_modes:
+            if mode not in CACHE_MODES:
+                raise ValueError(f'Unknown cache mode {mode}')
+        if 'cold' in self.cache_modes and not self.database.cold_cache_supported:
+            raise ValueError(f'Cold-cache timing on {self.database.engine} needs a restart_command')
+        if 'warm' in self.cache_modes and self.timing.warmup < 1:
+            self.timing = replace(self.timing, warmup=1)
+        for mode in self.fetch_modes.values():
+            if mode not in FETCH_MODES:
+                raise ValueError(f'Unknown fetch mode {mode}')
+        # 'linear' keeps the evenly stepped grid; 'log' spaces the same number of sizes evenly in log n; 'adaptive'
+        # starts from the log grid and adds up to adaptive_points sizes per table where the curves bend or are noisy.
+        # Every series gets a fitted complexity model, extrapolated to the sizes in extrapolate
+        if sampling not in SAMPLINGS:
+            raise ValueError(f'Unknown sampling {sampling}')
+        self.sampling = sampling
+        self.adaptive_points = adaptive_points if sampling == 'adaptive' else 0
+        grid_sampling = 'linear' if sampling == 'linear' else 'log'
+        # Names from the engine's index_strategies, e.g. ('hash', 'brin', 'covering', 'partial') on Postgres. At every
+        # size, each strategy that applies to a table's indexed column replaces the default index while the indexed
+        # select and join (and query bank) are re-timed, and is reported next to its build time and size
+        self.index_strategies = tuple(index_strategies)
+        for strategy in self.index_strategies:
+            if strategy not in self.database.index_strategies:
+                raise ValueError(f'Unknown index strategy {strategy} for {self.database.engine}')
+
+        tables, id_tables = self.table_definitions(geospatial, ids)
+
+        grid = size_grid(start, stop, num_points, grid_sampling)
+        grid_small = size_grid(start, stop_small, num_points, grid_sampling)
+
+        # Every finished (table, size) is appended to the checkpoint; resume=True skips those and starts over
+        # on the rest from empty tables
+        if checkpoint is not None:
+            config = dict(start=start, stop=stop, stop_small=stop_small, geospatial=geospatial, ids=ids,
+                          num_points=num_points, growth=growth, analyze=analyze, vacuum=vacuum,
+                          index_policy=index_policy, timing=asdict(self.timing), explain=explain,
+                          fetch_modes=self.fetch_modes, arraysize=arraysize, index_options=self.index_options,
+                          seed=self.seed, engine=self.database.engine, spatial=asdict(self.database.spatial),
+                          query_bank=query_bank, execution_modes=self.execution_modes,
+                          cache_modes=self.cache_modes, cold_trials=cold_trials, sampling=sampling,
+                          adaptive_points=self.adaptive_points, index_strategies=self.index_strategies)
+            self.checkpoint = Checkpoint(checkpoint, config, resume)
+            if resume:
+                self.clean_tables(tables, id_tables)
+
+        if self.results is not None:
+            self.run_id = self.results.start_run(
+                self.database.engine, self.database.server_version(), self.seed, grid,
+                geospatial=geospatial, ids=ids, growth=growth, analyze=analyze, vacuum=vacuum,
+                index_policy=index_policy, timing=asdict(self.timing), explain=explain, fetch_modes=self.fetch_modes,
+                index_options=self.index_options, spatial=asdict(self.database.spatial), query_bank=query_bank,
+                execution_modes=self.execution_modes, cache_modes=self.cache_modes, cold_trials=cold_trials,
+                sampling=sampling, adaptive_points=self.adaptive_points, index_strategies=self.index_strategies,
+                cache_eviction=self.database.cache_eviction if 'cold' in self.cache_modes else None
+            )
 
         results = {}
+        storage = {}
+        bank = {}
+        cold = {}
+        strategies = {}
+        matrix = {}
+        extras = {'bank': bank, 'cold': cold, 'strategies': strategies}  # Series prefixes kept outside the fixed sections
+        sizes = {}
+        curves = {}  # Series -> (sizes, points) for model fitting
         for name, data in tables.items():
             if len(data) == 3:  # This is a probably-unnecessary safety precaution
                 points_plain = []
                 points_ndx = []
                 points_join_plain = []
                 points_join_ndx = []
+                storage[name] = []
 
                 table_geospatial = 'point' in name or 'poly' in name
 
-                real_stop = stop_small if table_geospatial else stop
-                real_step = step_small if table_geospatial else step
-                for i in range(2):
-                    keys = list(data.keys())
-                    ndx = [x for x in keys if 'ndx' in x][0]
-                    plain = [x for x in keys if 'plain' in x][0]
+                keys = list(data.keys())
+                ndx = [x for x in keys if 'ndx' in x][0]
+                plain = [x for x in keys if 'plain' in x][0]
+                measured = []
+                lengths = {(prefix, series): len(points) for prefix, section in extras.items()
+                           for series, points in section.items()}
+                for i in self.sample_sizes(grid_small if table_geospatial else grid, measured,
+                                           lambda: [points_plain, points_ndx, points_join_plain, points_join_ndx]):
+                    done = self.resume_unit(name, i)
+                    if done is not None:
+                        points_plain.append(done[0][f'selects/{plain}'])
+                        points_ndx.append(done[0][f'selects/{ndx}'])
+                        points_join_plain.append(done[0][f'joins/{plain}'])
+                        points_join_ndx.append(done[0][f'joins/{ndx}'])
+                        storage[name].append(done[1])
+                        for series, distribution in done[0].items():
+                            prefix, _, rest = series.partition('/')
+                            if prefix in extras:
+                                extras[prefix].setdefault(rest, []).append(distribution)
+                        continue
+
                     queries = generate_queries(name, plain, data[plain], ndx, data[ndx])
 
-                    self.database.insert_dummy_data(
-                        name, i, 'id', data['id'], plain, data[plain], ndx, data[ndx])
-                    self.database.create_index(name, ndx, ndx, table_geospatial)
+                    self.prepare_table(name, data, i, ndx, table_geospatial)
+                    num_trials = GEOSPATIAL_TRIALS if table_geospatial else SELECT_TRIALS
+                    # Geospatial queries and joins are slow enough that they keep to their fixed trial counts
+                    max_trials = num_trials if table_geospatial else None
 
-                    trials_plain = []
-                    trials_ndx = []
-                    trials_join_plain = []
-                    trials_join_ndx = []
+                    if 'cold' in self.cache_modes:
+                        print('Timing Cold Queries')
+                        for series, query in ((f'selects/{plain}', queries[0]), (f'selects/{ndx}', queries[1])):
+                            cold.setdefault(series, []).append(self.record_point(
+                                f'cold/{series}', i, query, self.measure_cold(query, num_trials)))
+                            print(f'Timed {series} cold: median {cold[series][-1].median}')
+                    if 'warm' in self.cache_modes:
+                        self.prewarm(name)
 
                     print('Timing Queries')
                     t1 = time.time()
-                    num_trials = 10 if table_geospatial else 100
-                    for j in range(num_trials):
-                        trials_plain.append(self.database.time_query(queries[0]))
-                        trials_ndx.append(self.database.time_query(queries[1]))
-                        if (j + 1) % 5 == 0:
-                            print(f'Timed: {j + 1}/{num_trials}')
+                    points_plain.append(self.record_point(f'selects/{plain}', i, queries[0],
+                                                          self.measure_query(queries[0], num_trials,
+                                                                             max_trials=max_trials)))
+                    points_ndx.append(self.record_point(f'selects/{ndx}', i, queries[1],
+                                                        self.measure_query(queries[1], num_trials, (ndx,),
+                                                                           max_trials=max_trials)))
                     t2 = time.time()
-                    print(f'Timed {num_trials} * 2 queries in {t2 - t1} seconds')
+                    print(f'Timed {points_plain[-1].trials} + {points_ndx[-1].trials} queries in {t2 - t1} seconds '
+                          f'(median {points_plain[-1].median} / {points_ndx[-1].median})')
 
                     print('Timing Join Queries')
                     t1 = time.time()
-                    num_join_trials = 2 if table_geospatial else 10
-                    for j in range(num_join_trials):
-                        trials_join_plain.append(self.database.time_query(queries[2]))
-                        trials_join_ndx.append(self.database.time_query(queries[3]))
-                        print(f'Timed: {j + 1}/{num_join_trials}')
+                    num_join_trials = GEOSPATIAL_JOIN_TRIALS if table_geospatial else JOIN_TRIALS
+                    points_join_plain.append(self.record_point(
+                        f'joins/{plain}', i, queries[2],
+                        self.measure_query(queries[2], num_join_trials, kind='join', max_trials=num_join_trials)))
+                    points_join_ndx.append(self.record_point(
+                        f'joins/{ndx}', i, queries[3],
+                        self.measure_query(queries[3], num_join_trials, (ndx,), 'join', max_trials=num_join_trials)))
                     t2 = time.time()
-                    print(f'Timed {num_join_trials} * 2 join queries in {t2 - t1} seconds')
-
-                    points_plain.append(sum(trials_plain) / num_trials)
-                    points_ndx.append(sum(trials_ndx) / num_trials)
-                    points_join_plain.append(sum(trials_join_plain) / num_join_trials)
-                    points_join_ndx.append(sum(trials_join_ndx) / num_join_trials)
-
-                    self.database.clear_table(name, ndx)
+                    print(f'Timed {points_join_plain[-1].trials} + {points_join_ndx[-1].trials} join queries in '
+                          f'{t2 - t1} seconds (median {points_join_plain[-1].median} / {points_join_ndx[-1].median})')
+
+                    if self.query_bank is not None:
+                        print('Timing Query Bank')
+                        for column, indexes in ((plain, ()), (ndx, (ndx,))):
+                            for series, distribution in self.measure_bank(name, data, column, i, num_trials,
+                                                                          indexes=indexes,
+                                                                          max_trials=max_trials).items():
+                                bank.setdefault(series, []).append(distribution)
+
+                    builds = []
+                    if self.index_strategies:
+                        print('Timing Index Strategies')
+                        swapped, builds = self.measure_strategies(name, data, ndx, i, [queries[1], queries[3]],
+                                                                  num_trials, num_join_trials, table_geospatial)
+                        for series, distribution in swapped.items():
+                            strategies.setdefault(series, []).append(distribution)
+
+                    storage[name].append(self.record_storage(name, i, ndx, table_geospatial, builds))
+                    self.finish_unit(name, i, storage[name][-1])
+
+                self.release_table(name, ndx)
+                added = self.added_series(extras, lengths, len(measured))
+                sizes[name] = self.sort_by_size(measured, points_plain, points_ndx, points_join_plain,
+                                                points_join_ndx, storage[name], *added.values())
+                added.update({f'selects/{plain}': points_plain, f'selects/{ndx}': points_ndx,
+                              f'joins/{plain}': points_join_plain, f'joins/{ndx}': points_join_ndx})
+                for series, points in added.items():
+                    curves[series] = (sizes[name], points)
+                if self.index_strategies:
+                    matrix.update(self.strategy_matrix(name, ndx, sizes[name], points_ndx, points_join_ndx,
+                                                       storage[name], strategies))
                 results[name] = {
                     'plain': points_plain,
                     'ndx': points_ndx,
@@ -157,7 +728,14 @@ class Analyzer:
                 if 'point' in name:
                     points_pp_plain = []
                     points_pp_ndx = []
-                    for i in range(start, 20000, (20000 - start) // 10):
+                    sizes['point_poly_test'] = size_grid(start, POINT_POLY_STOP, POINT_POLY_POINTS, grid_sampling)
+                    for i in sizes['point_poly_test']:
+                        done = self.resume_unit('point_poly_test', i)
+                        if done is not None:
+                            points_pp_plain.append(done[0]['joins/point_poly_plain'])
+                            points_pp_ndx.append(done[0]['joins/point_poly_ndx'])
+                            continue
+
                         data_point = tables['point_test']
                         data_poly = tables['poly_test']
                         queries = generate_queries(
@@ -165,33 +743,32 @@ class Analyzer:
                             'poly_test', 'poly_plain', data_poly['poly_plain'], 'poly_ndx', data_poly['poly_ndx']
                         )
 
-                        self.database.insert_dummy_data(
-                            'point_test', i, 'id', 'int', 'pt_plain', data_point['pt_plain'], 'pt_ndx', data_point['pt_ndx'])
-                        self.database.create_index('point_test', 'pt_ndx', 'pt_ndx', True)
-
-                        self.database.insert_dummy_data(
-                            'poly_test', i, 'id', 'int', 'poly_plain', data_poly['poly_plain'], 'poly_ndx', data_poly['poly_ndx'])
-                        self.database.create_index('poly_test', 'poly_ndx', 'poly_ndx', True)
-
-                        trials_pp_plain = []
-                        trials_pp_ndx = []
+                        self.prepare_table('point_test', data_point, i, 'pt_ndx', True)
+                        self.prepare_table('poly_test', data_poly, i, 'poly_ndx', True)
+                        if 'warm' in self.cache_modes:
+                            self.prewarm('point_test', 'poly_test')
 
                         print('Timing Point/Poly Queries')
                         t1 = time.time()
-                        num_trials = 2
-                        for j in range(num_trials):
-                            trials_pp_plain.append(self.database.time_query(queries[0]))
-                            trials_pp_ndx.append(self.database.time_query(queries[1]))
-                            print(f'Timed: {j + 1}/{num_trials}')
+                        num_trials = POINT_POLY_TRIALS
+                        points_pp_plain.append(self.record_point(
+                            'joins/point_poly_plain', i, queries[0],
+                            self.measure_query(queries[0], num_trials, kind='point_poly', max_trials=num_trials)))
+                        points_pp_ndx.append(self.record_point(
+                            'joins/point_poly_ndx', i, queries[1],
+                            self.measure_query(queries[1], num_trials, ('pt_ndx', 'poly_ndx'), 'point_poly',
+                                               max_trials=num_trials)))
                         t2 = time.time()
-                        print(f'Timed {num_trials} * 2 Point/Poly queries in {t2 - t1} seconds')
-                        points_pp_plain.append(sum(trials_pp_plain) / num_trials)
-                        points_pp_ndx.append(sum(trials_pp_ndx) / num_trials)
+                        print(f'Timed {points_pp_plain[-1].trials} + {points_pp_ndx[-1].trials} Point/Poly queries '
+                              f'in {t2 - t1} seconds')
+                        self.finish_unit('point_poly_test', i)
 
-                        self.database.clear_table('point_test', 'pt_ndx')
-                        self.database.clear_table('poly_test', 'poly_ndx')
+                    self.release_table('point_test', 'pt_ndx')
+                    self.release_table('poly_test', 'poly_ndx')
 
                     results['point_poly_test'] = {'join_plain': points_pp_plain, 'join_ndx': points_pp_ndx}
+                    curves['joins/point_poly_plain'] = (sizes['point_poly_test'], points_pp_plain)
+                    curves['joins/point_poly_ndx'] = (sizes['point_poly_test'], points_pp_ndx)
 
         selects = SelectSection(
             str_plain=results['str_test']['plain'],
@@ -220,25 +797,50 @@ class Analyzer:
         id_results = {}
         for name, data in id_tables.items():
             points = []
-            for i in range(2):
-                self.database.insert_dummy_data(
-                    name, i, 'id', data['id'], 'num', data['num'])
+            storage[name] = []
+            measured = []
+            lengths = {(prefix, series): len(points) for prefix, section in extras.items()
+                       for series, points in section.items()}
+            for i in self.sample_sizes(grid, measured, lambda: [points]):
+                done = self.resume_unit(name, i)
+                if done is not None:
+                    points.append(done[0][f'ids/{name}'])
+                    storage[name].append(done[1])
+                    for series, distribution in done[0].items():
+                        prefix, _, rest = series.partition('/')
+                        if prefix in extras:
+                            extras[prefix].setdefault(rest, []).append(distribution)
+                    continue
+
+                self.prepare_table(name, data, i)
 
                 query = generate_id_query(name, data['id'])
-                trials = []
+                if 'cold' in self.cache_modes:
+                    series = f'ids/{name}'
+                    cold.setdefault(series, []).append(self.record_point(
+                        f'cold/{series}', i, query, self.measure_cold(query, 100)))
+                    print(f'Timed {series} cold: median {cold[series][-1].median}')
+                if 'warm' in self.cache_modes:
+                    self.prewarm(name)
 
                 print('Timing Queries')
                 t1 = time.time()
-                num_trials = 100
-                for j in range(num_trials):
-                    trials.append(self.database.time_query(query))
-                    if (j + 1) % 5 == 0:
-                        print(f'Timed: {j + 1}/{num_trials}')
+                num_trials = ID_TRIALS
+                points.append(self.record_point(f'ids/{name}', i, query, self.measure_query(query, num_trials, kind='id')))
                 t2 = time.time()
-                print(f'Timed {num_trials} * 4 queries in {t2 - t1} seconds')
-
-                points.append(sum(trials) / num_trials)
-                self.database.clear_table(name)
+                print(f'Timed {points[-1].trials} queries in {t2 - t1} seconds (median {points[-1].median})')
+                if self.query_bank is not None:
+                    for series, distribution in self.measure_bank(name, data, 'id', i, num_trials, 'num',
+                                                                  label=name).items():
+                        bank.setdefault(series, []).append(distribution)
+                storage[name].append(self.record_storage(name, i))
+                self.finish_unit(name, i, storage[name][-1])
+            self.release_table(name)
+            added = self.added_series(extras, lengths, len(measured))
+            sizes[name] = self.sort_by_size(measured, points, storage[name], *added.values())
+            added[f'ids/{name}'] = points
+            for series, extra in added.items():
+                curves[series] = (sizes[name], extra)
             id_results[name] = points
 
         ids_section = None
@@ -250,9 +852,71 @@ class Analyzer:
                 char=id_results.get('id_test_char')
             )
 
-        self.report = Report(selects, joins, ids_section)
+        execution = None
+        if self.query_bank is not None and len(self.execution_modes) > 1:
+            execution = {}
+            for series, points in bank.items():
+                base, _, mode = series.rpartition('/')
+                if mode not in self.execution_modes or base not in bank:
+                    continue
+                rows = execution.setdefault(base, [{'literal': p.median} for p in bank[base]])
+                for row, point in zip(rows, points):
+                    row[mode] = point.median
+                    row[f'{mode}_change'] = (point.median - row['literal']) / row['literal'] if row['literal'] else 0.0
+
+        fits = {}
+        for series, (series_sizes, points) in curves.items():
+            fits[series] = fit_series(series, series_sizes, [p.median for p in points], tuple(extrapolate))
+            best = next((f for f in fits[series].fits if f.model == fits[series].best), None)
+            if best is not None:
+                print(f'Fitted {series}: {best.model} (R² {best.r2:.3f})'
+                      + ''.join(f', {size} rows ~{seconds:.3g}s' for size, seconds in fits[series].extrapolated.items()))
+
+        self.report = Report(selects, joins, ids_section, storage, bank if self.query_bank is not None else None,
+                             execution, cold if 'cold' in self.cache_modes else None, sizes, fits,
+                             strategies if self.index_strategies else None, matrix if self.index_strategies else None,
+                             self.database.cache_eviction if 'cold' in self.cache_modes else None)
 
         with open(out_file, 'w') as file:
-            file.write(json.dumps({k: v.__dict__ for k, v in self.report.__dict__.items()}, indent=4))
+            file.write(json.dumps(asdict(self.report), indent=4))
+        if self.results is not None:
+            self.results.finish_run(self.run_id)
 
         return self.report
+
+    def run_load_analysis(self, out_file: str, n: int = 100000, levels: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+                          duration: float = 10.0, target_rate: Optional[float] = None, ids: bool = False) -> dict:
+        # Saturation curves: throughput and latency of each lookup under a growing number of parallel clients
+        tables, id_tables = self.table_definitions(ids=ids)
+        workloads = {}
+        for name, data in tables.items():
+            keys = list(data.keys())
+            ndx = [x for x in keys if 'ndx' in x][0]
+            plain = [x for x in keys if 'plain' in x][0]
+            queries = generate_queries(name, plain, data[plain], ndx, data[ndx])
+            workloads[plain] = (name, data, ndx, queries[0])
+            workloads[ndx] = (name, data, ndx, queries[1])
+        for name, data in id_tables.items():
+            workloads[name] = (name, data, None, generate_id_query(name, data['id']))
+
+        results = {}
+        for series, (name, data, ndx, query) in workloads.items():
+            self.prepare_table(name, data, n, ndx)
+            print(f'Load testing {series}: {query}')
+            generator = LoadGenerator(self.database, [query])
+            try:
+                results[series] = generator.run(list(levels), duration, target_rate)
+            finally:
+                generator.close()
+        for name, data in {**tables, **id_tables}.items():
+            if self.loaded.get(name):
+                self.release_table(name, [x for x in data if 'ndx' in x][0] if name in tables else None)
+
+        report = {series: [asdict(level) for level in levels] for series, levels in results.items()}
+        for levels_report in report.values():
+            for level in levels_report:
+                if level['latency'] is not None:
+                    level['latency']['samples'] = []  # Load tests collect far too many samples to store
+        with open(out_file, 'w') as file:
+            file.write(json.dumps(report, indent=4))
+        return report
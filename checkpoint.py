@@ -0,0 +1,45 @@
+import json
+import os
+from typing import Optional
+
+
+class Checkpoint:
+    # JSON-lines log of finished (table, size) measurements: a config line, then one line per completed unit,
+    # flushed to disk before the next unit starts so a crash loses at most the unit in progress
+
+    def __init__(self, path: str, config: dict, resume: bool = False):
+        self.path = path
+        self.config = json.loads(json.dumps(config, default=str))
+        self.done: dict[tuple[str, int], dict] = {}
+
+        if resume and os.path.exists(path):
+            with open(path) as file:
+                lines = file.read().splitlines()
+            if lines:
+                saved = json.loads(lines[0])['config']
+                if saved != self.config:
+                    raise ValueError(f'Checkpoint {path} was written with different settings: {saved}')
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # Torn final line from a crash mid-write
+                    continue
+                self.done[(entry['table'], entry['size'])] = entry
+            print(f'Resuming from {path}: {len(self.done)} measurements already done')
+
+        # Rewritten without any torn line, which would otherwise swallow the next appended entry
+        with open(path, 'w') as file:
+            file.write(json.dumps({'config': self.config}) + '\n')
+            for entry in self.done.values():
+                file.write(json.dumps(entry) + '\n')
+
+    def get(self, table: str, size: int) -> Optional[dict]:
+        return self.done.get((table, size))
+
+    def put(self, table: str, size: int, points: dict[str, dict], storage: Optional[dict] = None) -> None:
+        entry = {'table': table, 'size': size, 'points': points, 'storage': storage}
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.done[(table, size)] = entry
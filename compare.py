@@ -0,0 +1,200 @@
+import argparse
+import json
+import math
+import sys
+from dataclasses import asdict, dataclass
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+
+from results_store import ResultsStore
+
+
+@dataclass
+class Comparison:
+    series: str
+    size: int
+    baseline_median: float
+    candidate_median: float
+    change: float  # Relative change of the median, positive when the candidate is slower
+    p_value: Optional[float]  # Two-sided Mann-Whitney U, None without raw samples on both sides
+    effect_size: Optional[float]  # Probability a candidate trial is slower than a baseline trial, 0.5 for no effect
+    verdict: str  # 'regression', 'improvement' or 'same'
+
+
+def rank(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # 1-based ranks with ties sharing their average rank, plus the size of every tie group
+    order = np.argsort(values, kind='mergesort')
+    ordered = values[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ordered)) + 1))
+    ends = np.concatenate((starts[1:], [len(values)]))
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat((starts + ends + 1) / 2, ends - starts)
+    return ranks, ends - starts
+
+
+def mann_whitney(baseline: np.ndarray, candidate: np.ndarray) -> tuple[float, float]:
+    # Normal approximation with tie and continuity correction; returns (p value, P(candidate > baseline))
+    n1, n2 = len(candidate), len(baseline)
+    ranks, ties = rank(np.concatenate((candidate, baseline)))
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - (ties ** 3 - ties).sum() / (n * (n - 1)))
+    effect = float(u / (n1 * n2))
+    if variance <= 0:
+        return 1.0, effect
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(variance)
+    return min(1.0, 2 * (1 - NormalDist().cdf(max(z, 0.0)))), effect
+
+
+# Id lookups are reported under the key type rather than the table they ran on
+ID_FIELDS = {'integer': 'id_test_int', 'uuid': 'id_test_uuid', 'binary': 'id_test_binary', 'char': 'id_test_char'}
+
+
+def series_table(series: str, tables: dict[str, list[int]]) -> Optional[str]:
+    # The table a report series was measured on, found from the column or table named in its path: 'int_ndx' is on
+    # int_test, 'pt_plain' on point_test, 'id_test_int/hit' on id_test_int
+    for part in series.split('/'):
+        if part in tables:
+            return part
+        if ID_FIELDS.get(part) in tables:
+            return ID_FIELDS[part]
+        stem = part.removesuffix('_plain').removesuffix('_ndx')
+        table = f'{"point" if stem == "pt" else stem}_test'
+        if stem != part and table in tables:
+            return table
+    return None
+
+
+def load_report(path: str) -> dict[tuple[str, int], list[float]]:
+    # Analyzer JSON reports list one point per size; the sizes section says which table size each position was
+    # measured at. Reports from before it existed can only be aligned by position
+    with open(path) as file:
+        report = json.loads(file.read())
+    tables = report.get('sizes')
+    if tables is None:
+        print(f'Warning: {path} has no sizes, so its points are paired by position instead of table size')
+    points = {}
+    unmapped = set()
+    for section, fields in report.items():
+        if section in ('storage', 'execution', 'sizes', 'fits', 'matrix', 'cache_eviction') or fields is None:
+            continue
+        for field, values in fields.items():
+            if not values:
+                continue
+            series = f'{section}/{field}'
+            sizes = None
+            if tables is not None:
+                table = series_table(field, tables)
+                if table is None:
+                    unmapped.add(series)
+                    continue
+                sizes = tables[table]
+            for i, value in enumerate(values):
+                if sizes is not None and i >= len(sizes):
+                    unmapped.add(series)
+                    break
+                # Older reports stored a single average per point
+                points[(series, sizes[i] if sizes is not None else i)] = (
+                    value['samples'] if isinstance(value, dict) else [value])
+    if unmapped:
+        print(f'Warning: skipped {len(unmapped)} series of {path} without known sizes: {", ".join(sorted(unmapped))}')
+    return points
+
+
+def unpaired(baseline: dict[tuple[str, int], list[float]],
+             candidate: dict[tuple[str, int], list[float]]) -> dict[str, tuple[list[int], list[int]]]:
+    # Series -> (sizes only the baseline measured, sizes only the candidate measured), e.g. from different grids
+    out: dict[str, tuple[list[int], list[int]]] = {}
+    for side, keys in ((0, baseline.keys() - candidate.keys()), (1, candidate.keys() - baseline.keys())):
+        for series, size in sorted(keys):
+            out.setdefault(series, ([], []))[side].append(size)
+    return out
+
+
+def load_run(source: str, store: Optional[ResultsStore]) -> dict[tuple[str, int], list[float]]:
+    if source.endswith('.json'):
+        return load_report(source)
+    if store is None:
+        raise ValueError(f'{source} is not a JSON report and no results store was given')
+    return store.point_samples(int(source))
+
+
+def compare(baseline: dict[tuple[str, int], list[float]], candidate: dict[tuple[str, int], list[float]],
+            threshold: float = 0.05, alpha: float = 0.01) -> list[Comparison]:
+    # A point regresses (or improves) only when the median moved by more than threshold and the shift is significant
+    comparisons = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before = np.asarray(baseline[key], dtype=np.float64)
+        after = np.asarray(candidate[key], dtype=np.float64)
+        if not len(before) or not len(after):
+            continue
+        before_median = float(np.median(before))
+        after_median = float(np.median(after))
+        change = (after_median - before_median) / before_median if before_median > 0 else math.inf
+        p_value = effect = None
+        if len(before) > 1 and len(after) > 1:
+            p_value, effect = mann_whitney(before, after)
+        verdict = 'same'
+        if p_value is not None and p_value < alpha and abs(change) > threshold:
+            verdict = 'regression' if change > 0 else 'improvement'
+        comparisons.append(Comparison(key[0], key[1], before_median, after_median, change, p_value, effect, verdict))
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark runs and exit non-zero on regressions')
+    parser.add_argument('baseline', help='Run id in the results store or an Analyzer JSON report')
+    parser.add_argument('candidate', help='Run id in the results store or an Analyzer JSON report')
+    parser.add_argument('--db', default='analyses/results.db')
+    parser.add_argument('--threshold', type=float, default=0.05, help='Smallest relative median change that counts')
+    parser.add_argument('--alpha', type=float, default=0.01, help='Significance level of the Mann-Whitney test')
+    parser.add_argument('--all', action='store_true', help='Print unchanged points too')
+    parser.add_argument('--json', default=None, metavar='FILE', help='Also write every comparison to FILE')
+    args = parser.parse_args()
+
+    store = None
+    if not (args.baseline.endswith('.json') and args.candidate.endswith('.json')):
+        store = ResultsStore(args.db)
+    if store is not None:
+        runs = {str(run['id']): run for run in store.runs()}
+        for source in (args.baseline, args.candidate):
+            if source in runs:
+                run = runs[source]
+                print(f"Run {source}: {run['engine']} {run['server_version']}, commit {run['git_commit']}, "
+                      f"host {run['host']}")
+    baseline, candidate = load_run(args.baseline, store), load_run(args.candidate, store)
+    comparisons = compare(baseline, candidate, args.threshold, args.alpha)
+    if store is not None:
+        store.close()
+
+    print(f'{"series":<28}{"size":>9}{"baseline":>13}{"candidate":>13}{"change":>9}{"p":>10}{"effect":>8}  verdict')
+    for c in comparisons:
+        if c.verdict == 'same' and not args.all:
+            continue
+        p_value = f'{c.p_value:.2g}' if c.p_value is not None else 'n/a'
+        effect = f'{c.effect_size:.2f}' if c.effect_size is not None else 'n/a'
+        print(f'{c.series:<28}{c.size:>9}{c.baseline_median:>13.4g}{c.candidate_median:>13.4g}'
+              f'{c.change:>+9.1%}{p_value:>10}{effect:>8}  {c.verdict}')
+
+    missing = unpaired(baseline, candidate)
+    for series, (only_baseline, only_candidate) in missing.items():
+        print(f'{series}: not compared at sizes '
+              + '; '.join(f'{sizes} measured in the {side} only' for side, sizes in
+                          (('baseline', only_baseline), ('candidate', only_candidate)) if sizes))
+
+    regressions = sum(1 for c in comparisons if c.verdict == 'regression')
+    improvements = sum(1 for c in comparisons if c.verdict == 'improvement')
+    untested = sum(1 for c in comparisons if c.p_value is None)
+    print(f'{len(comparisons)} points compared: {regressions} regressions, {improvements} improvements'
+          + (f', {untested} without raw samples' if untested else ''))
+
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            file.write(json.dumps([asdict(c) for c in comparisons], indent=4))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,99 +1,282 @@
-import random
+import json
+import os
+import re
+import tempfile
 import time
-from typing import Optional
+from typing import Iterable, Optional
 
+import numpy as np
 import pymysql
 
-import utils
-from databases.sql import SqlDatabase
+from databases.sql import INDEX_STRATEGIES, IndexStrategy, QueryPlan, SqlDatabase
+from generator import hex_strings
+from geometry import wkb_points, wkb_polygons
+
+
+GEOMETRY_TYPES = ('point not null srid 4326', 'polygon not null srid 4326')
+
+# Prefix indexes store the first characters of each key only; an invisible index is kept up to date on every
+# write but never chosen, which measures what dropping it would cost before doing so
+MYSQL_STRATEGIES = (
+    IndexStrategy('prefix', '({column}(8))', ('str36',)),
+    IndexStrategy('invisible', '({column}) invisible', ('int', 'str36'), visible=False),
+)
+
+# Error codes for LOAD DATA LOCAL being disabled on the client or server side
+LOCAL_INFILE_DISABLED = (1148, 2068, 3948, 3950)
 
 
 class MySqlDatabase(SqlDatabase):
+    engine = 'mysql'
+    snapshot_suffix = '.tsv'
+    index_strategies = {**INDEX_STRATEGIES, **{strategy.name: strategy for strategy in MYSQL_STRATEGIES}}
 
-    def __init__(self, db_name: str, username: str, password: str):
+    def __init__(self, db_name: str, username: str, password: str, load_mode: str = 'infile'):
         super().__init__(db_name, username, password)
+        self.load_mode = load_mode  # 'infile', 'executemany' or 'insert' (the original batched literal inserts)
         self.connection = pymysql.connect(
             host="localhost",
             user=username,
             password=password,
-            database=db_name
+            database=db_name,
+            local_infile=True
         )
         self.cursor = self.connection.cursor()
 
-    def insert_dummy_data(self, table, n, col1, type1, col2, type2, col3=None, type3=None):
-        print(f'Inserting {n} rows into {table}')
-
-        t1 = time.time()
-
-        columns = {col1: type1, col2: type2}
-        column_data = {col1: [], col2: []}
-        if col3 is not None:
-            columns[col3] = type3
-            column_data[col3] = []
-
-        for col_name, type_name in columns.items():
-            print(f'Creating Data for {col_name} of type {type_name}')
-            for i in range(1, n + 1):
-                if type_name == 'int':
-                    column_data[col_name].append(i)
-                elif type_name == 'text' or type_name == 'char(36)':  # Need specific lengths for mysql indexes
-                    column_data[col_name].append(f"'{utils.random_string(36)}'")
-                elif type_name == 'point not null srid 4326':
-                    column_data[col_name].append(
-                        f"st_geomfromtext('POINT({random.uniform(-90.0, 90.0)} {random.uniform(-180.0, 180.0)})', 4326)"
-                    )
-                elif type_name == 'polygon not null srid 4326':
-                    rp = [(random.uniform(-90.0, 90.0), random.uniform(-180.0, 180.0)) for i in range(4)]
-                    column_data[col_name].append(
-                        f"st_geomfromtext('POLYGON(({rp[0][0]} {rp[0][1]}, {rp[1][0]} {rp[1][1]}, {rp[2][0]} {rp[2][1]}, {rp[3][0]} {rp[3][1]}, {rp[0][0]} {rp[0][1]}))', 4326)"
-                    )
-                elif type_name == 'binary(16)':
-                    column_data[col_name].append("unhex(replace(uuid(),'-',''))")
-                elif type_name == 'char(16)':
-                    column_data[col_name].append(f"'{utils.random_string(16)}'")
-
-                if i % 100000 == 0 and i > 0:
-                    print(f'Created: {i}/{n}')
-
-        if type3 == type2:
-            column_data[col3] = column_data.get(col2)
-
-        if col3 is not None:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}, {col3}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}, {column_data[col3][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n - 1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
+    def clone(self) -> 'MySqlDatabase':
+        return MySqlDatabase(self.db_name, self.username, self.password, self.load_mode)
+
+    def isolate(self, namespace: str, tables: list[str]) -> 'MySqlDatabase':
+        database = f'{self.db_name}_{namespace}'
+        self.cursor.execute(f'create database if not exists {database};')
+        for table in tables:
+            self.cursor.execute(f'create table if not exists {database}.{table} like {self.db_name}.{table};')
+        self.connection.commit()
+        return MySqlDatabase(database, self.username, self.password, self.load_mode)
+
+    def drop_isolated(self, namespace: str) -> None:
+        self.cursor.execute(f'drop database if exists {self.db_name}_{namespace};')
+        self.connection.commit()
+
+    def stream_cursor(self, arraysize: int):
+        cursor = self.connection.cursor(pymysql.cursors.SSCursor)  # Unbuffered, rows are read as they are fetched
+        cursor.arraysize = arraysize
+        return cursor
+
+    def explain_query(self, query: str) -> QueryPlan:
+        self.cursor.execute(f'explain analyze {query}')
+        plan = self.cursor.fetchone()[0]
+        self.connection.commit()
+
+        # The root node's "actual time=first..last" is when its last row was produced, in milliseconds
+        actual = re.search(r'actual time=[\d.]+\.\.([\d.]+)', plan)
+        indexes = list(dict.fromkeys(re.findall(r'\busing (\w+)', plan)))
+        return QueryPlan(plan, float(actual.group(1)) / 1000 if actual else None, indexes)
+
+    def load_chunks(self, table, columns, chunks, n):
+        if self.load_mode == 'insert':
+            self.insert_literal_rows(table, columns, self.wkb_chunks(columns, chunks, hex_encode=True), n)
+            return
+        if self.load_mode not in ('infile', 'executemany'):
+            raise ValueError(f'Unknown load mode {self.load_mode}')
+
+        kinds = {col_name: self._column_kind(type_name) for col_name, type_name in columns.items()}
+        inserted = 0
+        try:
+            for data, count in chunks:
+                values = [self._text_column(kinds[col_name], data[col_name]) for col_name in columns]
+                if self.load_mode == 'infile':
+                    try:
+                        self._load_infile_rows(table, kinds, zip(*values))
+                    except pymysql.err.MySQLError as e:
+                        if e.args[0] not in LOCAL_INFILE_DISABLED:
+                            raise
+                        print(f'LOAD DATA LOCAL INFILE is disabled ({e.args[1]}), falling back to executemany')
+                        self.load_mode = 'executemany'
+                if self.load_mode == 'executemany':
+                    self._insert_hex_rows(table, kinds, zip(*values))
+                inserted += count
+                print(f'Inserted: {inserted}/{n}')
+            self.commit_load(table)
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+    @staticmethod
+    def _column_kind(type_name: str) -> str:
+        if type_name in GEOMETRY_TYPES:
+            return 'geometry'
+        elif type_name == 'binary(16)':
+            return 'binary'
+        return 'plain'
+
+    @staticmethod
+    def _text_column(kind: str, values: np.ndarray) -> list[str]:
+        # Geometry columns are passed as WKB and binary columns as raw bytes, both hex-encoded for the TSV
+        if kind == 'geometry':
+            values = wkb_points(values) if values.ndim == 2 else wkb_polygons(values)
+        if kind in ('geometry', 'binary'):
+            return hex_strings(values).tolist()
+        return values.astype(str).tolist()
+
+    def _load_infile(self, table: str, kinds: dict[str, str], path: str, skip_lines: int = 0) -> None:
+        fields = []
+        assignments = []
+        for col_name, kind in kinds.items():
+            if kind == 'plain':
+                fields.append(col_name)
+            else:
+                fields.append(f'@{col_name}')
+                if kind == 'geometry':
+                    assignments.append(f'{col_name} = st_geomfromwkb(unhex(@{col_name}), 4326)')
+                else:
+                    assignments.append(f'{col_name} = unhex(@{col_name})')
+
+        query = (f"load data local infile '{path}' into table {table} "
+                 f"fields terminated by '\\t' lines terminated by '\\n' ignore {skip_lines} lines ({', '.join(fields)})")
+        if assignments:
+            query += ' set ' + ', '.join(assignments)
+        self.cursor.execute(query + ';')
+
+    def _load_infile_rows(self, table: str, kinds: dict[str, str], rows: Iterable[tuple[str, ...]]) -> None:
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False) as file:
+            file.writelines('\t'.join(row) + '\n' for row in rows)
+        try:
+            self._load_infile(table, kinds, file.name)
+        finally:
+            os.remove(file.name)
+
+    def _insert_hex_rows(self, table: str, kinds: dict[str, str], rows: Iterable[tuple[str, ...]],
+                         batch_size: int = 1000) -> None:
+        # Multi-row inserts with bound parameters; batched by hand because pymysql's executemany only
+        # rewrites values clauses made of bare placeholders and falls back to one round trip per row otherwise
+        placeholders = {'plain': '%s', 'binary': '%s', 'geometry': 'st_geomfromwkb(%s, 4326)'}
+        row_sql = '(' + ', '.join(placeholders[kind] for kind in kinds.values()) + ')'
+        query_head = f'insert into {table} ({", ".join(kinds)}) values '
+        decoders = [(lambda v: v) if kind == 'plain' else bytes.fromhex for kind in kinds.values()]
+
+        batch = []
+        for row in rows:
+            batch.append([decode(v) for decode, v in zip(decoders, row)])
+            if len(batch) == batch_size:
+                self.cursor.execute(query_head + ', '.join([row_sql] * len(batch)), [v for r in batch for v in r])
+                batch = []
+        if batch:
+            self.cursor.execute(query_head + ', '.join([row_sql] * len(batch)), [v for r in batch for v in r])
+
+    def save_snapshot(self, table: str, path: str) -> None:
+        self.cursor.execute('select column_name, data_type from information_schema.columns '
+                            'where table_schema = database() and table_name = %s order by ordinal_position;', (table,))
+        kinds = {}
+        for col_name, data_type in self.cursor.fetchall():
+            if data_type in ('point', 'polygon', 'geometry', 'linestring', 'multipoint', 'multipolygon'):
+                kinds[col_name] = 'geometry'
+            elif data_type in ('binary', 'varbinary', 'blob'):
+                kinds[col_name] = 'binary'
+            else:
+                kinds[col_name] = 'plain'
+        expressions = {'plain': '{}', 'binary': 'hex({})', 'geometry': 'hex(st_aswkb({}))'}
+        select = ', '.join(expressions[kind].format(col_name) for col_name, kind in kinds.items())
+
+        cursor = self.stream_cursor(10000)
+        try:
+            cursor.execute(f'select {select} from {table};')
+            with open(path, 'w') as file:
+                file.write(json.dumps(kinds) + '\n')  # Header recording how each column was encoded
+                for rows in iter(lambda: cursor.fetchmany(10000), ()):
+                    file.writelines('\t'.join(str(v) for v in row) + '\n' for row in rows)
+        finally:
+            cursor.close()
+        self.connection.commit()
+
+    def restore_snapshot(self, table: str, path: str) -> None:
+        with open(path) as file:
+            kinds = json.loads(file.readline())
+        try:
+            self._load_infile(table, kinds, path, skip_lines=1)
+        except pymysql.err.MySQLError as e:
+            if e.args[0] not in LOCAL_INFILE_DISABLED:
+                raise
+            with open(path) as file:
+                file.readline()
+                self._insert_hex_rows(table, kinds, (line.rstrip('\n').split('\t') for line in file))
+        self.connection.commit()
+
+    def prewarm(self, table):
+        super().prewarm(table)
+        # The row scan only reads the clustered index, so walk every secondary index too
+        self.cursor.execute('select distinct index_name from information_schema.statistics '
+                            'where table_schema = database() and table_name = %s;', (table,))
+        for (index,) in self.cursor.fetchall():
+            if index != 'PRIMARY':
+                self.cursor.execute(f'select count(*) from {table} force index ({index});')
+                self.cursor.fetchall()
+        self.connection.commit()
+
+    def prepare(self, name, template):
+        self.cursor.execute(f'prepare {name} from %s;', (template.rstrip().rstrip(';').replace('%s', '?'),))
+        self.connection.commit()
+
+    def time_prepared(self, name, params):
+        # pymysql only speaks the text protocol, so parameters go through user variables set outside the timing
+        variables = [f'@{name}_{i}' for i in range(len(params))]
+        if params:
+            self.cursor.execute('set ' + ', '.join(f'{v} = %s' for v in variables) + ';', params)
+        query = f'execute {name} using {", ".join(variables)};' if params else f'execute {name};'
+        t1 = time.perf_counter_ns()
+        self.cursor.execute(query)
+        self.connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def deallocate(self, name):
+        self.cursor.execute(f'deallocate prepare {name};')
+        self.connection.commit()
+
+    def sql_literal(self, type_name, value):
+        if type_name == 'int':
+            return str(value)
+        elif type_name in GEOMETRY_TYPES:
+            return f"st_geomfromwkb(x'{value}', 4326)"  # Hex WKB
+        elif type_name == 'binary(16)':
+            return f"x'{value.hex()}'"
+        return f"'{value}'"
+
+    def analyze_table(self, table: str, vacuum: bool = False) -> None:
+        if vacuum:
+            self.cursor.execute(f'optimize table {table};')  # Rebuilds the table and refreshes its statistics
         else:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n - 1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
-
-        t2 = time.time()
-        print(f'Inserted {n} rows into {table} in {t2 - t1} seconds')
-
-    def drop_index(self, index: str, table: Optional[str] = None) -> None:
+            self.cursor.execute(f'analyze table {table};')
+        self.cursor.fetchall()
+        self.connection.commit()
+
+    def drop_index(self, index: str, table: Optional[str] = None, missing_ok: bool = False) -> None:
+        if missing_ok:  # MySQL has no drop index if exists
+            self.cursor.execute('select count(*) from information_schema.statistics where table_schema = database() '
+                                'and table_name = %s and index_name = %s;', (table, index))
+            if not self.cursor.fetchone()[0]:
+                self.connection.commit()
+                return
         self.cursor.execute(f'drop index {index} on {table};')
         self.connection.commit()
 
-    def create_index(self, table: str, index: str, column: str, geospatial: bool = False):
+    def create_index(self, table: str, index: str, column: str, geospatial: bool = False,
+                     options: Optional[dict] = None):
+        # options: algorithm ('inplace' or 'copy') and lock ('none', 'shared' or 'exclusive')
+        options = options or {}
+        clauses = ''.join(f' {clause} = {options[clause]}' for clause in ('algorithm', 'lock') if clause in options)
         if geospatial:
-            self.cursor.execute(f'create spatial index {index} on {table} ({column});')
+            self.cursor.execute(f'create spatial index {index} on {table} ({column}){clauses};')
         else:
-            self.cursor.execute(f'create unique index {index} on {table} ({column});')
+            self.cursor.execute(f'create unique index {index} on {table} ({column}){clauses};')
+
+    def table_size(self, table: str) -> dict[str, Optional[int]]:
+        # information_schema caches these statistics for a day unless told otherwise
+        self.cursor.execute('set session information_schema_stats_expiry = 0;')
+        self.cursor.execute(f'analyze table {table};')
+        self.cursor.fetchall()
+        self.cursor.execute('select data_length, index_length from information_schema.tables '
+                            'where table_schema = database() and table_name = %s;', (table,))
+        table_bytes, index_bytes = self.cursor.fetchone()
+        self.connection.commit()
+        return {'table_bytes': table_bytes, 'index_bytes': index_bytes}
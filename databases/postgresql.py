@@ -1,104 +1,274 @@
-import random
-from typing import Optional
+import struct
+import time
+from typing import Iterator, Optional
 
 import psycopg2
-import progressbar
-import time
 
-import utils
-from databases.sql import SqlDatabase
+from databases.sql import INDEX_STRATEGIES, PARTIAL_STRATEGY, IndexStrategy, QueryPlan, SqlDatabase
+
+
+GEOMETRY_TYPES = ('geometry(point, 4326)', 'geometry(polygon, 4326)')
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('!h', -1)
+
+# Hash indexes answer equality only; BRIN keeps one summary per block range, tiny but only useful on correlated
+# data; SP-GiST partitions text by prefix and geometry by quadrant; INCLUDE makes a covering index for select *
+POSTGRES_STRATEGIES = (
+    IndexStrategy('hash', 'using hash ({column})', ('int', 'str36')),
+    IndexStrategy('brin', 'using brin ({column})', ('int', 'str36', 'point', 'polygon')),
+    IndexStrategy('spgist', 'using spgist ({column})', ('str36', 'point', 'polygon')),
+    IndexStrategy('covering', '({column}) include ({others})', ('int', 'str36')),
+    PARTIAL_STRATEGY,
+)
+
+
+class CopyStream:
+    # File-like wrapper so copy_expert can pull COPY data from a generator instead of a prebuilt buffer
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            out, self.buffer = self.buffer, b''
+        else:
+            out, self.buffer = self.buffer[:size], self.buffer[size:]
+        return out
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
 
 
 class PostgresDatabase(SqlDatabase):
+    engine = 'postgres'
+    snapshot_suffix = '.copy'
+    index_strategies = {**INDEX_STRATEGIES, **{strategy.name: strategy for strategy in POSTGRES_STRATEGIES}}
 
-    def __init__(self, db_name: str, username: str, password: str, schema: str):
+    def __init__(self, db_name: str, username: str, password: str, schema: str,
+                 load_mode: str = 'copy', copy_format: str = 'text', search_path: tuple[str, ...] = ()):
         super().__init__(db_name, username, password)
+        self.schema = schema
+        self.search_path = tuple(search_path)  # Schemas resolved after schema, e.g. where PostGIS is installed
+        self.load_mode = load_mode  # 'copy' or 'insert' (the original batched literal inserts)
+        self.copy_format = copy_format  # 'text' or 'binary'
+        self.stream_cursors = 0
         self.connection = psycopg2.connect(
             database=db_name,
             user=username,
             password=password,
             host="localhost",
             port="5432",
-            options=f"-c search_path={schema}"
+            options=f"-c search_path={','.join((schema,) + self.search_path)}"
         )
         self.cursor = self.connection.cursor()
 
-    def insert_dummy_data(self, table, n, col1, type1, col2, type2, col3=None, type3=None):
-        print(f'Inserting {n} rows into {table}')
+    def clone(self) -> 'PostgresDatabase':
+        return PostgresDatabase(self.db_name, self.username, self.password, self.schema, self.load_mode,
+                                self.copy_format, self.search_path)
 
-        t1 = time.time()
+    def isolate(self, namespace: str, tables: list[str]) -> 'PostgresDatabase':
+        schema = f'{self.schema}_{namespace}'
+        self.cursor.execute(f'create schema if not exists {schema};')
+        for table in tables:
+            self.cursor.execute(f'create table if not exists {schema}.{table} (like {self.schema}.{table} including defaults);')
+        self.connection.commit()
+        # The base schema stays on the path, so extensions installed in it (PostGIS) still resolve
+        return PostgresDatabase(self.db_name, self.username, self.password, schema, self.load_mode, self.copy_format,
+                                (self.schema,) + self.search_path)
 
-        columns = {col1: type1, col2: type2}
-        column_data = {col1: [], col2: []}
-        if col3 is not None:
-            columns[col3] = type3
-            column_data[col3] = []
+    def drop_isolated(self, namespace: str) -> None:
+        self.cursor.execute(f'drop schema if exists {self.schema}_{namespace} cascade;')
+        self.connection.commit()
 
-        for col_name, type_name in columns.items():
-            print(f'Creating Data for {col_name} of type {type_name}')
-            for i in range(1, n+1):
-                if type_name == 'int':
-                    column_data[col_name].append(i)
-                elif type_name == 'text':
-                    column_data[col_name].append(f"'{utils.random_string(36)}'")
-                elif type_name == 'geometry(point, 4326)':
-                    column_data[col_name].append(
-                        f'st_setsrid(st_makepoint({random.uniform(-90.0, 90.0)}, {random.uniform(-180.0, 180.0)}), 4326)'
-                    )
-                elif type_name == 'geometry(polygon, 4326)':
-                    rp = [(random.uniform(-90.0, 90.0), random.uniform(-180.0, 180.0)) for i in range(4)]
-                    column_data[col_name].append(
-                        f"'POLYGON(({rp[0][0]} {rp[0][1]}, {rp[1][0]} {rp[1][1]}, {rp[2][0]} {rp[2][1]}, {rp[3][0]} {rp[3][1]}, {rp[0][0]} {rp[0][1]}))'::geometry"
-                    )
-                elif type_name == 'bytea':
-                    column_data[col_name].append('gen_random_bytes(32)')
-                elif type_name == 'uuid':
-                    column_data[col_name].append('gen_random_uuid()')
-                elif type_name == 'char(16)':
-                    column_data[col_name].append(f"'{utils.random_string(16)}'")
-
-                if i % 100000 == 0 and i > 0:
-                    print(f'Created: {i}/{n}')
-
-        if type3 == type2:
-            column_data[col3] = column_data.get(col2)
-
-        if col3 is not None:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}, {col3}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}, {column_data[col3][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n-1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
+    def prewarm(self, table):
+        try:
+            self.cursor.execute('select pg_prewarm(%s::regclass);', (table,))
+            self.cursor.execute('select pg_prewarm(indexrelid::regclass) from pg_index where indrelid = %s::regclass;',
+                                (table,))
+            self.connection.commit()
+        except psycopg2.Error:  # The pg_prewarm extension is not installed
+            self.connection.rollback()
+            super().prewarm(table)
+
+    def prepare(self, name, template):
+        parts = template.rstrip().rstrip(';').split('%s')
+        statement = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+        self.cursor.execute(f'prepare {name} as {statement};')
+        self.connection.commit()
+
+    def time_prepared(self, name, params):
+        query = f'execute {name}({", ".join(["%s"] * len(params))});' if params else f'execute {name};'
+        t1 = time.perf_counter_ns()
+        self.cursor.execute(query, params)
+        self.connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def deallocate(self, name):
+        self.cursor.execute(f'deallocate {name};')
+        self.connection.commit()
+
+    def param_literal(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return f"'\\x{bytes(value).hex()}'::bytea"
+        return super().param_literal(value)
+
+    def stream_cursor(self, arraysize: int):
+        # A named cursor is declared server-side, so rows arrive itersize at a time instead of all at once
+        self.stream_cursors += 1
+        cursor = self.connection.cursor(name=f'stream_{self.stream_cursors}')
+        cursor.itersize = arraysize
+        cursor.arraysize = arraysize
+        return cursor
+
+    def explain_query(self, query: str) -> QueryPlan:
+        self.cursor.execute(f'explain (analyze, buffers, format json) {query}')
+        plan = self.cursor.fetchone()[0][0]
+        self.connection.commit()
+
+        indexes = []
+        nodes = [plan['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Index Name' in node:
+                indexes.append(node['Index Name'])
+            nodes.extend(node.get('Plans', []))
+
+        return QueryPlan(plan, plan['Execution Time'] / 1000, indexes, planning_seconds=plan['Planning Time'] / 1000)
+
+    def load_chunks(self, table, columns, chunks, n):
+        if self.load_mode == 'copy':
+            self.copy_chunks(table, columns, chunks)
+        elif self.load_mode == 'insert':
+            self.insert_literal_rows(table, columns, self.wkb_chunks(columns, chunks, 4326, hex_encode=True), n)
+        else:
+            raise ValueError(f'Unknown load mode {self.load_mode}')
+
+    def copy_chunks(self, table, columns, chunks):
+        if self.copy_format == 'binary':
+            chunks = self._binary_copy_chunks(columns, self.wkb_chunks(columns, chunks, 4326))
+            options = ' with (format binary)'
+        elif self.copy_format == 'text':
+            chunks = self._text_copy_chunks(columns, self.wkb_chunks(columns, chunks, 4326, hex_encode=True))
+            options = ''
         else:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n-1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
-
-        t2 = time.time()
-        print(f'Inserted {n} rows into {table} in {t2 - t1} seconds')
-
-    def drop_index(self, index: str, table: Optional[str] = None) -> None:
-        self.cursor.execute(f'drop index {index};')
+            raise ValueError(f'Unknown copy format {self.copy_format}')
+
+        self.cursor.copy_expert(f'copy {table} ({", ".join(columns)}) from stdin{options}', CopyStream(chunks))
+        self.commit_load(table)
+
+    def _text_copy_chunks(self, columns, chunks) -> Iterator[bytes]:
+        types = list(columns.values())
+        lines = []
+        for row in self.rows(columns, chunks):
+            fields = []
+            for type_name, value in zip(types, row):
+                if type_name == 'bytea':
+                    fields.append('\\\\x' + value.hex())
+                elif type_name == 'uuid':
+                    fields.append(value.hex())
+                else:
+                    fields.append(str(value))
+            lines.append('\t'.join(fields))
+            if len(lines) == 500:
+                yield ('\n'.join(lines) + '\n').encode()
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode()
+
+    def _binary_copy_chunks(self, columns, chunks) -> Iterator[bytes]:
+        types = list(columns.values())
+        field_count = struct.pack('!h', len(types))
+        yield COPY_BINARY_HEADER
+        for row in self.rows(columns, chunks):
+            out = [field_count]
+            for type_name, value in zip(types, row):
+                if type_name == 'int':
+                    field = struct.pack('!i', value)
+                elif type_name in GEOMETRY_TYPES + ('uuid', 'bytea'):  # Geometry arrives as EWKB bytes
+                    field = value
+                else:
+                    field = value.encode()
+                out.append(struct.pack('!i', len(field)))
+                out.append(field)
+            yield b''.join(out)
+        yield COPY_BINARY_TRAILER
+
+    def save_snapshot(self, table: str, path: str) -> None:
+        # Binary COPY is the same data stream a data-only pg_dump of the table would carry
+        with open(path, 'wb') as file:
+            self.cursor.copy_expert(f'copy {table} to stdout with (format binary)', file)
+        self.connection.commit()
+
+    def restore_snapshot(self, table: str, path: str) -> None:
+        with open(path, 'rb') as file:
+            self.cursor.copy_expert(f'copy {table} from stdin with (format binary)', file)
+        self.connection.commit()
+
+    def sql_literal(self, type_name, value):
+        if type_name == 'int':
+            return str(value)
+        elif type_name in GEOMETRY_TYPES:
+            return f"'{value}'::geometry"  # Hex EWKB
+        elif type_name == 'bytea':
+            return f"decode('{value.hex()}', 'hex')"
+        elif type_name == 'uuid':
+            return f"'{value.hex()}'::uuid"
+        return f"'{value}'"
+
+    def analyze_table(self, table: str, vacuum: bool = False) -> None:
         self.connection.commit()
+        self.connection.autocommit = True  # vacuum cannot run inside a transaction block
+        try:
+            self.cursor.execute(f'vacuum analyze {table};' if vacuum else f'analyze {table};')
+        finally:
+            self.connection.autocommit = False
 
-    def create_index(self, table: str, index: str, column: str, geospatial: bool = False):
+    def drop_index(self, index: str, table: Optional[str] = None, missing_ok: bool = False) -> None:
+        self.cursor.execute(f'drop index if exists {index};' if missing_ok else f'drop index {index};')
+        self.connection.commit()
+
+    def create_index(self, table: str, index: str, column: str, geospatial: bool = False,
+                     options: Optional[dict] = None):
+        # options: maintenance_work_mem (e.g. '1GB'), max_parallel_maintenance_workers, concurrently
+        options = options or {}
+        settings = [s for s in ('maintenance_work_mem', 'max_parallel_maintenance_workers') if s in options]
+        for setting in settings:
+            self.cursor.execute(f"set {setting} = '{options[setting]}';")
+        # Session settings outlive the commit, which leaves the connection idle so autocommit can be switched
+        self.connection.commit()
+        concurrently = ' concurrently' if options.get('concurrently') else ''
         if geospatial:
-            self.cursor.execute(f'create index {index} on {table} using GIST ({column});')
+            statement = f'create index{concurrently} {index} on {table} using GIST ({column});'
         else:
-            self.cursor.execute(f'create unique index {index} on {table} ({column});')
+            statement = f'create unique index{concurrently} {index} on {table} ({column});'
+        try:
+            if concurrently:
+                self.connection.autocommit = True  # create index concurrently cannot run inside a transaction block
+                try:
+                    self.cursor.execute(statement)
+                finally:
+                    self.connection.autocommit = False
+            else:
+                self.cursor.execute(statement)
+                self.connection.commit()
+        except psycopg2.Error:
+            self.connection.rollback()
+            raise
+        finally:
+            if settings:
+                for setting in settings:
+                    self.cursor.execute(f'reset {setting};')
+                self.connection.commit()
+
+    def table_size(self, table: str) -> dict[str, Optional[int]]:
+        self.cursor.execute('select pg_relation_size(%s), pg_indexes_size(%s);', (table, table))
+        table_bytes, index_bytes = self.cursor.fetchone()
+        self.connection.commit()
+        return {'table_bytes': table_bytes, 'index_bytes': index_bytes}
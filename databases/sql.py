@@ -1,8 +1,104 @@
+import re
+import subprocess
 import time
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, Optional
+
+import numpy as np
+
+from generator import COLUMN_KINDS, DataGenerator, SpatialProfile, hex_strings
+from geometry import wkb_points, wkb_polygons
+from pipeline import ChunkPipeline
+from tracing import TRACER, record, span
+
+
+Chunk = tuple[dict[str, np.ndarray], int]
+
+
+@dataclass
+class LoadStats:
+    table: str
+    rows: int
+    generate_seconds: float
+    load_seconds: float
+    wait_seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / max(self.load_seconds, 1e-9)
+
+
+@dataclass
+class QueryPlan:
+    plan: Any  # In the engine's own format: Postgres JSON, MySQL's EXPLAIN ANALYZE tree, SQLite plan rows
+    server_seconds: Optional[float]  # Execution time as measured by the engine itself
+    indexes: list[str]  # Indexes the plan actually used
+    planning_seconds: Optional[float] = None
+    vm_steps: Optional[int] = None
+
+
+@dataclass
+class FetchStats:
+    mode: str
+    first_row_seconds: Optional[float]
+    total_seconds: float
+    rows: int
+    bytes: int  # Size of the decoded values, as a proxy for what came over the wire
+
+
+@dataclass(frozen=True)
+class IndexStrategy:
+    name: str
+    clause: str  # Follows 'create index {index} on {table}', with {column}, {others}, {expression} and {predicate}
+    kinds: tuple[str, ...]  # COLUMN_KINDS of the columns it can index
+    expression: Optional[str] = None  # Indexed instead of the column, so queries compare it too, e.g. 'lower({column})'
+    predicate: Optional[str] = None  # Rows a partial index covers; queries carry it as well so the planner can match it
+    visible: bool = True  # False when the optimizer is told to ignore the index, which is still built and maintained
+
+    def condition(self, ordinal: str, rows: int) -> str:
+        # Partial indexes cover the most recently inserted quarter of the rows, by their sequential ordinal
+        return self.predicate.format(ordinal=ordinal, cutoff=rows - rows // 4)
+
+
+# Non-unique, multi-column and expression indexes, which every engine builds; engines add their own on top
+INDEX_STRATEGIES = {strategy.name: strategy for strategy in (
+    IndexStrategy('btree', '({column})', ('int', 'str36')),
+    IndexStrategy('multicolumn', '({column}, {others})', ('int', 'str36')),
+    IndexStrategy('expression_abs', '(({expression}))', ('int',), expression='abs({column})'),
+    IndexStrategy('expression_lower', '(({expression}))', ('str36',), expression='lower({column})'),
+)}
+PARTIAL_STRATEGY = IndexStrategy('partial', '({column}) where {predicate}', ('int', 'str36'),
+                                 predicate='{ordinal} >= {cutoff}')
+
+FETCH_MODES = ('none', 'count', 'stream', 'full')
+EXECUTION_MODES = ('literal', 'parameterized', 'prepared')
+CACHE_MODES = ('warm', 'cold')
+
+
+def value_size(value: Any) -> int:
+    if value is None:
+        return 0
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    elif isinstance(value, str):
+        return len(value.encode())
+    elif isinstance(value, (int, float)):
+        return 8
+    return len(str(value))
+
+
+def count_query(query: str) -> str:
+    # Counts a query's rows server-side. Its select list becomes a constant first: a derived table may not have
+    # duplicate column names, which select * over a self-join has on MySQL
+    query = query.strip().rstrip(';')
+    query = re.sub(r'^select\s+.+?\s+from\s', 'select 1 from ', query, count=1, flags=re.IGNORECASE | re.DOTALL)
+    return f'select count(*) from ({query}) q;'
 
 
 class SqlDatabase:
+    engine = 'sql'
+    snapshot_suffix = ''
+    index_strategies = INDEX_STRATEGIES
 
     def __init__(self, db_name: str, username: str, password: str):
         self.db_name = db_name
@@ -10,16 +106,165 @@ class SqlDatabase:
         self.password = password
         self.connection = None
         self.cursor = None
+        self.last_load: Optional[LoadStats] = None
+        self.spatial = SpatialProfile()  # Shape of generated point and polygon columns
+        self.restart_command: Optional[str] = None  # Shell command restarting the server, for cold-cache timing
+
+    def clone(self) -> 'SqlDatabase':
+        # A new instance with the same settings on its own connection
+        raise NotImplementedError()
+
+    def isolate(self, namespace: str, tables: list[str]) -> 'SqlDatabase':
+        # Copies the definitions of tables into a private namespace and connects to it, so parallel
+        # jobs on the same tables do not see each other's rows
+        raise NotImplementedError()
+
+    def drop_isolated(self, namespace: str) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        self.cursor.close()
+        self.connection.close()
+
+    @property
+    def cold_cache_supported(self) -> bool:
+        return self.restart_command is not None
+
+    @property
+    def cache_eviction(self) -> str:
+        # What a cold trial starts from, recorded next to cold-cache results
+        return ('server restart: empties the server buffer pool only, the OS page cache still holds the data '
+                'files, so cold trials read from memory rather than disk')
+
+    def prewarm(self, table: str) -> None:
+        # Reads every row once so the table's pages are in the cache before timing
+        self.fetch_query(f'select * from {table};', 'stream', 10000)
+
+    def evict_cache(self) -> None:
+        # Restarts the server, which empties its buffer cache, then reconnects
+        if self.restart_command is None:
+            raise ValueError(f'Cold-cache timing on {self.engine} needs a restart_command')
+        self.close()
+        subprocess.run(self.restart_command, shell=True, check=True)
+        deadline = time.time() + 60
+        while True:
+            try:
+                fresh = self.clone()
+                break
+            except Exception:  # The server is not accepting connections yet
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+        self.connection, self.cursor = fresh.connection, fresh.cursor
+
+    def server_version(self) -> str:
+        self.cursor.execute('select version();')
+        version = self.cursor.fetchone()[0]
+        self.connection.commit()
+        return version
 
     def time_query(self, query: str, read_only: bool = False) -> float:
-        t1 = time.time()
+        t1 = time.perf_counter_ns()
         self.cursor.execute(query)
         if read_only:
             self.cursor.fetchall()
         else:
             self.connection.commit()
-        t2 = time.time()
-        return t2 - t1
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def time_literal(self, query: str) -> float:
+        # Like time_query, but never served from a client-side cache of compiled statements
+        return self.time_query(query)
+
+    def time_parameterized(self, template: str, params: tuple) -> float:
+        # The driver binds params into template (%s placeholders) on every call
+        t1 = time.perf_counter_ns()
+        self.cursor.execute(template, params)
+        self.connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def prepare(self, name: str, template: str) -> None:
+        # Creates a server-side prepared statement from template (%s placeholders)
+        raise NotImplementedError()
+
+    def time_prepared(self, name: str, params: tuple) -> float:
+        raise NotImplementedError()
+
+    def deallocate(self, name: str) -> None:
+        raise NotImplementedError()
+
+    def param_literal(self, value: Any) -> str:
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return f"x'{bytes(value).hex()}'"
+        elif isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        elif isinstance(value, (int, np.integer)):
+            return str(int(value))
+        return repr(float(value))
+
+    def render_query(self, template: str, params: tuple) -> str:
+        # Inlines params into the %s placeholders of template as SQL literals
+        parts = template.split('%s')
+        if len(parts) != len(params) + 1:
+            raise ValueError(f'{len(params)} parameters for {len(parts) - 1} placeholders in {template}')
+        return parts[0] + ''.join(self.param_literal(param) + part for param, part in zip(params, parts[1:]))
+
+    def stream_cursor(self, arraysize: int):
+        cursor = self.connection.cursor()
+        cursor.arraysize = arraysize
+        return cursor
+
+    def fetch_query(self, query: str, mode: str = 'stream', arraysize: int = 1000) -> FetchStats:
+        if mode not in FETCH_MODES:
+            raise ValueError(f'Unknown fetch mode {mode}')
+        with span('fetch', 'query', mode=mode) as args:
+            stats = self._fetch(query, mode, arraysize)
+            args.update(rows=stats.rows, bytes=stats.bytes)
+        return stats
+
+    def _fetch(self, query: str, mode: str, arraysize: int) -> FetchStats:
+        if mode == 'none':
+            return FetchStats(mode, None, self.time_query(query), 0, 0)
+
+        first_row = None
+        rows = 0
+        size = 0
+        t1 = time.perf_counter_ns()
+        if mode == 'count':
+            self.cursor.execute(count_query(query))
+            rows = self.cursor.fetchone()[0]
+            first_row = time.perf_counter_ns()
+            size = 8
+        elif mode == 'full':
+            self.cursor.execute(query)
+            result = self.cursor.fetchall()
+            first_row = time.perf_counter_ns()  # Nothing is usable before the whole result arrives
+            rows = len(result)
+            size = sum(value_size(v) for row in result for v in row)
+        else:
+            # Only arraysize rows are held client-side at a time
+            cursor = self.stream_cursor(arraysize)
+            try:
+                cursor.execute(query)
+                while True:
+                    batch = cursor.fetchmany(arraysize)
+                    if not batch:
+                        break
+                    if first_row is None:
+                        first_row = time.perf_counter_ns()
+                    rows += len(batch)
+                    size += sum(value_size(v) for row in batch for v in row)
+            finally:
+                cursor.close()
+        self.connection.commit()
+        t2 = time.perf_counter_ns()
+
+        return FetchStats(mode, (first_row - t1) / 1e9 if first_row is not None else None, (t2 - t1) / 1e9, rows, size)
+
+    def explain_query(self, query: str) -> QueryPlan:
+        raise NotImplementedError()
 
     def insert_dummy_data(self,
                           table: str,
@@ -29,17 +274,125 @@ class SqlDatabase:
                           col2: str,
                           type2: str,
                           col3: str = None,
-                          type3: str = None) -> None:
+                          type3: str = None,
+                          seed: Optional[int] = None,
+                          chunk_size: int = 100000,
+                          queue_depth: int = 2,
+                          offset: int = 0) -> LoadStats:
+        columns = {col1: type1, col2: type2}
+        if col3 is not None:
+            columns[col3] = type3
+
+        print(f'Inserting {n} rows into {table}' + (f' after {offset} existing rows' if offset else ''))
+        t1 = time.time()
+        generator = DataGenerator(seed, offset, self.spatial)
+        chunks = ChunkPipeline(lambda start, count: generator.columns(columns, count, start=offset + start + 1),
+                               n, chunk_size, queue_depth, table)
+        batches = self.traced_chunks(table, chunks, n)
+        try:
+            with span('load', 'load', table=table, rows=n, offset=offset, engine=self.engine):
+                self.load_chunks(table, columns, batches, n)
+        finally:
+            batches.close()  # A loader that raised or stopped early still ends its last batch's span here
+        t2 = time.time()
+
+        self.last_load = LoadStats(table, n, chunks.generate_seconds, t2 - t1, chunks.wait_seconds)
+        print(f'Created {n} rows for {table} in {chunks.generate_seconds} seconds '
+              f'(writer waited {chunks.wait_seconds} seconds on generation)')
+        print(f'Inserted {n} rows into {table} in {t2 - t1} seconds ({self.last_load.rows_per_second:.0f} rows/sec)')
+        return self.last_load
+
+    def load_chunks(self, table: str, columns: dict[str, str], chunks: Iterable[Chunk], n: int) -> None:
+        raise NotImplementedError()
+
+    @staticmethod
+    def traced_chunks(table: str, chunks: Iterable[Chunk], n: int) -> Iterator[Chunk]:
+        # An insert_batch span runs from handing a chunk to the loader until it asks for the next one. It is
+        # recorded once finished rather than held open across the yield, which would pop the thread's span stack
+        # out of order whenever the loader raises or abandons the generator
+        for data, count in chunks:
+            parent = TRACER.current()
+            start = time.perf_counter_ns()
+            try:
+                yield data, count
+            finally:
+                record('insert_batch', 'load', start, time.perf_counter_ns(), parent, table=table, rows=count, total=n)
+
+    def commit_load(self, table: str) -> None:
+        with span('commit', 'load', table=table):
+            self.connection.commit()
+
+    @staticmethod
+    def rows(columns: dict[str, str], chunks: Iterable[Chunk]) -> Iterator[tuple]:
+        for data, _ in chunks:
+            yield from zip(*(data[col_name].tolist() for col_name in columns))
+
+    @staticmethod
+    def wkb_chunks(columns: dict[str, str], chunks: Iterable[Chunk], srid: Optional[int] = None,
+                   hex_encode: bool = False) -> Iterator[Chunk]:
+        # Replaces the coordinates of point and polygon columns by (E)WKB, one vectorized pass per chunk
+        for data, count in chunks:
+            encoded = {}
+            data = dict(data)
+            for col_name, type_name in columns.items():
+                if COLUMN_KINDS.get(type_name) not in ('point', 'polygon'):
+                    continue
+                values = data[col_name]
+                if id(values) not in encoded:  # Mirrored columns share their array
+                    wkb = wkb_points(values, srid) if values.ndim == 2 else wkb_polygons(values, srid)
+                    encoded[id(values)] = hex_strings(wkb) if hex_encode else wkb
+                data[col_name] = encoded[id(values)]
+            yield data, count
+
+    def sql_literal(self, type_name: str, value: Any) -> str:
+        raise NotImplementedError()
+
+    def insert_literal_rows(self, table: str, columns: dict[str, str], chunks: Iterable[Chunk], n: int,
+                            batch_size: int = 500) -> None:
+        types = list(columns.values())
+        query_head = f'insert into {table} ({", ".join(columns)}) values '
+        values = []
+        for i, row in enumerate(self.rows(columns, chunks)):
+            values.append('(' + ', '.join(self.sql_literal(t, v) for t, v in zip(types, row)) + ')')
+            if len(values) == batch_size or i == n - 1:
+                self.cursor.execute(query_head + ',\n'.join(values) + ';')
+                self.commit_load(table)
+                values = []
+            if i % 100000 == 0 and i > 0:
+                print(f'Inserted: {i}/{n}')
+
+    def save_snapshot(self, table: str, path: str) -> None:
+        raise NotImplementedError()
+
+    def restore_snapshot(self, table: str, path: str) -> None:
         raise NotImplementedError()
 
     def clear_table(self, table: str, index: Optional[str] = None) -> None:
-        self.cursor.execute(f'delete from {table};')
-        self.connection.commit()
-        if index is not None:
-            self.drop_index(index, table)
+        with span('clear_table', 'load', table=table, index=index):
+            self.cursor.execute(f'delete from {table};')
+            self.connection.commit()
+            if index is not None:
+                self.drop_index(index, table)
 
-    def drop_index(self, index: str, table: Optional[str] = None) -> None:
+    def analyze_table(self, table: str, vacuum: bool = False) -> None:
         raise NotImplementedError()
 
-    def create_index(self, table: str, index: str, column: str, geospatial: bool = False) -> None:
+    def drop_index(self, index: str, table: Optional[str] = None, missing_ok: bool = False) -> None:
+        raise NotImplementedError()
+
+    def create_index(self, table: str, index: str, column: str, geospatial: bool = False,
+                     options: Optional[dict] = None) -> None:
+        raise NotImplementedError()
+
+    def create_strategy_index(self, table: str, index: str, column: str, strategy: IndexStrategy,
+                              columns: list[str], rows: int, ordinal: str = 'id') -> None:
+        # columns are the table's, of which all but column are what a covering or multi-column index adds
+        others = ', '.join(c for c in columns if c != column)
+        expression = strategy.expression.format(column=column) if strategy.expression is not None else column
+        predicate = strategy.condition(ordinal, rows) if strategy.predicate is not None else ''
+        clause = strategy.clause.format(column=column, others=others, expression=expression, predicate=predicate)
+        self.cursor.execute(f'create index {index} on {table} {clause};')
+
+    def table_size(self, table: str) -> dict[str, Optional[int]]:
+        # On-disk bytes of the table itself and of all its indexes
         raise NotImplementedError()
@@ -1,82 +1,446 @@
-import random
+import functools
+import os
+import re
 import sqlite3
 import time
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Union
 
-import utils
-from databases.sql import SqlDatabase
+import numpy as np
+
+from databases.sql import INDEX_STRATEGIES, PARTIAL_STRATEGY, Chunk, QueryPlan, SqlDatabase
+from generator import COLUMN_KINDS
+from geometry import contains, distance_within, intersects, overlaps, wkb_vertices
+
+
+# Load profiles trade durability for speed while rows are inserted; 'default' is what queries are timed under
+PRAGMA_PROFILES = {
+    'default': {'journal_mode': 'delete', 'synchronous': 'full', 'cache_size': -2000, 'temp_store': 'default'},
+    'safe': {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -65536, 'temp_store': 'default'},
+    'fast': {'journal_mode': 'memory', 'synchronous': 'off', 'cache_size': -262144, 'temp_store': 'memory'},
+    'unsafe': {'journal_mode': 'off', 'synchronous': 'off', 'cache_size': -1048576, 'temp_store': 'memory'},
+}
+
+# Geometry columns hold WKB blobs. Each has a bounding-box table, filled by the loader, from which a spatial index
+# builds an R*Tree; spatial_columns records which column each box table and R*Tree belongs to
+SPATIAL_CATALOG = 'spatial_columns'
+
+
+def bbox_table(table: str, column: str) -> str:
+    return f'{table}_{column}_bbox'
+
+
+def rtree_table(index: str) -> str:
+    return f'{index}_rtree'
+
+
+# A nested-loop join hands the same blobs to a predicate over and over, so decoded geometries are memoized
+decode = functools.lru_cache(maxsize=1 << 17)(wkb_vertices)
+
+
+def spatial_function(predicate):
+    # Exact predicates over WKB blobs as Python functions, applied after an R*Tree prefilter when there is one
+    def function(*args):
+        if any(arg is None for arg in args):
+            return None
+        return int(predicate(*(decode(arg) if isinstance(arg, bytes) else arg for arg in args)))
+    return function
+
+
+SPATIAL_FUNCTIONS = {
+    'st_dwithin': (3, spatial_function(distance_within)),
+    'st_contains': (2, spatial_function(contains)),
+    'st_intersects': (2, spatial_function(intersects)),
+    'st_overlaps': (2, spatial_function(overlaps)),
+}
 
 
 class SqliteDatabase(SqlDatabase):
+    engine = 'sqlite'
+    snapshot_suffix = '.db'
+    index_strategies = {**INDEX_STRATEGIES, PARTIAL_STRATEGY.name: PARTIAL_STRATEGY}
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, load_mode: str = 'executemany',
+                 pragma_profile: Union[str, dict] = 'fast', measure_profile: Union[str, dict] = 'default'):
         super().__init__('', '', '')
-        self.connection = sqlite3.connect(path)
+        self.path = path
+        self.load_mode = load_mode  # 'executemany' or 'insert' (the original batched literal inserts)
+        self.pragma_profile = pragma_profile
+        self.measure_profile = measure_profile
+        # Connections may be handed to worker threads, each used by one thread at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.register_functions(self.connection)
+        self.cursor = self.connection.cursor()
+        self.apply_pragmas(self.measure_profile)
+        # sqlite3 keeps up to 128 compiled statements per connection, keyed by their text; a second connection
+        # without that cache is used whenever a statement must be compiled on every execution
+        self.uncached: Optional[sqlite3.Connection] = None
+        self.prepared: dict[str, str] = {}
+
+    def clone(self) -> 'SqliteDatabase':
+        return SqliteDatabase(self.path, self.load_mode, self.pragma_profile, self.measure_profile)
+
+    def server_version(self) -> str:
+        return sqlite3.sqlite_version
+
+    @staticmethod
+    def register_functions(connection: sqlite3.Connection) -> None:
+        for name, (arguments, function) in SPATIAL_FUNCTIONS.items():
+            connection.create_function(name, arguments, function, deterministic=True)
+
+    def apply_pragmas(self, profile: Union[str, dict]) -> dict:
+        settings = PRAGMA_PROFILES[profile] if isinstance(profile, str) else profile
+        self.connection.commit()  # journal_mode cannot change inside a transaction
+        for pragma, value in settings.items():
+            self.cursor.execute(f'pragma {pragma} = {value};')
+            self.cursor.fetchall()
+        return settings
+
+    def close(self) -> None:
+        if self.uncached is not None:
+            self.uncached.close()
+            self.uncached = None
+        super().close()
+
+    @property
+    def cold_cache_supported(self) -> bool:
+        return True
+
+    @property
+    def cache_eviction(self) -> str:
+        if hasattr(os, 'posix_fadvise'):
+            return 'reconnect, fsync and posix_fadvise(DONTNEED): drops the page cache and the OS cached file pages'
+        return 'reconnect: drops the page cache only, the OS page cache still holds the file'
+
+    def prewarm(self, table: str) -> None:
+        super().prewarm(table)
+        indexes = self.cursor.execute('select name from sqlite_master where type = ? and tbl_name = ?;',
+                                      ('index', table)).fetchall()
+        for (index,) in indexes:
+            self.cursor.execute(f'select count(*) from {table} indexed by {index};').fetchall()
+        self.connection.commit()
+
+    def evict_cache(self) -> None:
+        # Reopening drops the connection's page cache; the kernel is asked to drop its cached pages of the file,
+        # which it only does for clean pages, and loads run with synchronous=off
+        self.close()
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.register_functions(self.connection)
         self.cursor = self.connection.cursor()
+        self.apply_pragmas(self.measure_profile)
+
+    def uncached_connection(self) -> sqlite3.Connection:
+        if self.uncached is None:
+            self.uncached = sqlite3.connect(self.path, cached_statements=0, check_same_thread=False)
+            self.register_functions(self.uncached)
+            settings = PRAGMA_PROFILES[self.measure_profile] if isinstance(self.measure_profile, str) else self.measure_profile
+            for pragma, value in settings.items():
+                self.uncached.execute(f'pragma {pragma} = {value};').fetchall()
+        return self.uncached
+
+    def time_literal(self, query: str) -> float:
+        connection = self.uncached_connection()
+        t1 = time.perf_counter_ns()
+        connection.execute(query)
+        connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def time_parameterized(self, template: str, params: tuple) -> float:
+        connection = self.uncached_connection()
+        t1 = time.perf_counter_ns()
+        connection.execute(template.replace('%s', '?'), params)
+        connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def prepare(self, name: str, template: str) -> None:
+        # SQLite has no named server-side statements; the connection's statement cache keeps the compiled statement
+        # after its first execution, which the timing warmup covers
+        self.prepared[name] = template.replace('%s', '?')
+
+    def time_prepared(self, name: str, params: tuple) -> float:
+        t1 = time.perf_counter_ns()
+        self.cursor.execute(self.prepared[name], params)
+        self.connection.commit()
+        t2 = time.perf_counter_ns()
+        return (t2 - t1) / 1e9
+
+    def deallocate(self, name: str) -> None:
+        del self.prepared[name]
 
-    def insert_dummy_data(self, table, n, col1, type1, col2, type2, col3=None, type3=None):
-        print(f'Inserting {n} rows into {table}')
-
-        t1 = time.time()
-
-        columns = {col1: type1, col2: type2}
-        column_data = {col1: [], col2: []}
-        if col3 is not None:
-            columns[col3] = type3
-            column_data[col3] = []
-
-        for col_name, type_name in columns.items():
-            print(f'Creating Data for {col_name} of type {type_name}')
-            for i in range(1, n + 1):
-                if type_name == 'int':
-                    column_data[col_name].append(i)
-                elif type_name == 'text' or type_name == 'char(36)':  # Need specific lengths for indexes
-                    column_data[col_name].append(f"'{utils.random_string(36)}'")
-                elif type_name == 'char(16)':
-                    column_data[col_name].append(f"'{utils.random_string(16)}'")
-
-                if i % 100000 == 0 and i > 0:
-                    print(f'Created: {i}/{n}')
-
-        if type3 == type2:
-            column_data[col3] = column_data.get(col2)
-
-        if col3 is not None:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}, {col3}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}, {column_data[col3][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n - 1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
+    def explain_query(self, query: str) -> QueryPlan:
+        plan = [row[3] for row in self.cursor.execute(f'explain query plan {query}').fetchall()]
+        indexes = re.findall(r'USING (?:COVERING )?INDEX (\w+)', '\n'.join(plan))
+        # R*Tree scans show up as virtual tables under their alias; reported under the spatial index's name
+        aliases = {}
+        for index, alias in re.findall(r'\b(\w+)_rtree\b(?:\s+(\w+))?', query):
+            aliases[rtree_table(index)] = aliases[alias or rtree_table(index)] = index
+        indexes += [aliases[name] for name in re.findall(r'(?:SCAN|SEARCH) (\w+) VIRTUAL TABLE', '\n'.join(plan))
+                    if name in aliases]
+        indexes = list(dict.fromkeys(indexes))
+
+        t1 = time.perf_counter_ns()
+        self.cursor.execute(query).fetchall()
+        t2 = time.perf_counter_ns()
+
+        # SQLite has no EXPLAIN ANALYZE; count virtual machine steps through the progress handler instead,
+        # on a second run so the per-step callback does not inflate the timing above
+        steps = 0
+
+        def count_step():
+            nonlocal steps
+            steps += 1
+            return 0
+
+        self.connection.set_progress_handler(count_step, 1)
+        try:
+            self.cursor.execute(query).fetchall()
+        finally:
+            self.connection.set_progress_handler(None, 1)
+        self.connection.commit()
+        return QueryPlan(plan, (t2 - t1) / 1e9, indexes, vm_steps=steps)
+
+    def load_chunks(self, table, columns, chunks, n):
+        if self.ensure_spatial(table, columns):
+            chunks = self.bbox_chunks(table, columns, chunks)
+        if self.load_mode == 'executemany':
+            self.apply_pragmas(self.pragma_profile)
+            try:
+                self.executemany_chunks(table, columns, self.wkb_chunks(columns, chunks), n)
+            finally:
+                self.apply_pragmas(self.measure_profile)
+        elif self.load_mode == 'insert':
+            self.insert_literal_rows(table, columns, self.wkb_chunks(columns, chunks, hex_encode=True), n)
         else:
-            print('Inserting Data')
-            query_head = f'insert into {table} ({col1}, {col2}) values '
-            mut_query = query_head
-            for i in range(n):
-                mut_query += f'\n({column_data[col1][i]}, {column_data[col2][i]}),'
-                if (i % 500 == 0 and i > 0) or i == n - 1:
-                    mut_query = mut_query[:-1] + ';'
-                    self.cursor.execute(mut_query)
-                    self.connection.commit()
-                    mut_query = query_head
-                if i % 100000 == 0 and i > 0:
-                    print(f'Inserted: {i}/{n}')
-
-        t2 = time.time()
-        print(f'Inserted {n} rows into {table} in {t2 - t1} seconds')
-
-    def drop_index(self, index: str, table: Optional[str] = None) -> None:
-        self.cursor.execute(f'drop index {index};')
+            raise ValueError(f'Unknown load mode {self.load_mode}')
+
+    def spatial_columns(self, table: Optional[str] = None) -> list[tuple[str, str, Optional[str]]]:
+        # (table, column, spatial index or None) of every geometry column the loader has seen
+        if self.cursor.execute('select 1 from sqlite_master where type = ? and name = ?;',
+                               ('table', SPATIAL_CATALOG)).fetchone() is None:
+            return []
+        query = f'select table_name, column_name, index_name from {SPATIAL_CATALOG}'
+        if table is None:
+            return self.cursor.execute(query + ';').fetchall()
+        return self.cursor.execute(query + ' where table_name = ?;', (table,)).fetchall()
+
+    def ensure_spatial(self, table: str, columns: dict[str, str]) -> list[str]:
+        # Creates the catalog and a bounding-box table per geometry column; returns the geometry columns
+        geometry = [column for column, type_name in columns.items() if COLUMN_KINDS.get(type_name) in ('point', 'polygon')]
+        for column in geometry:
+            self.add_spatial_column(table, column)
         self.connection.commit()
+        return geometry
+
+    def add_spatial_column(self, table: str, column: str) -> None:
+        self.cursor.execute(f'create table if not exists {SPATIAL_CATALOG} (table_name text not null, '
+                            'column_name text not null, index_name text, primary key (table_name, column_name));')
+        self.cursor.execute(f'create table if not exists {bbox_table(table, column)} '
+                            '(id integer primary key, minx real, maxx real, miny real, maxy real);')
+        self.cursor.execute(f'insert or ignore into {SPATIAL_CATALOG} (table_name, column_name) values (?, ?);',
+                            (table, column))
+
+    def create_table(self, table: str, columns: dict[str, str]) -> None:
+        self.cursor.execute(f'create table if not exists {table} '
+                            f'({", ".join(f"{column} {type_name}" for column, type_name in columns.items())});')
+        self.ensure_spatial(table, columns)
+        self.connection.commit()
+
+    def rtree(self, table: str, column: str) -> Optional[str]:
+        # The R*Tree indexing a geometry column, if one has been built
+        for _, name, index in self.spatial_columns(table):
+            if name == column and index is not None:
+                return rtree_table(index)
+        return None
+
+    def bbox_chunks(self, table: str, columns: dict[str, str], chunks: Iterable[Chunk]) -> Iterator[Chunk]:
+        # Writes each chunk's bounding boxes, and R*Tree entries for indexed columns, keyed by the rowids its rows
+        # are about to get: without AUTOINCREMENT or deletes in between, those continue from the current maximum
+        spatial = {column: index for _, column, index in self.spatial_columns(table) if column in columns}
+        rowid = None
+        for data, count in chunks:
+            if rowid is None:
+                rowid = self.cursor.execute(f'select coalesce(max(rowid), 0) from {table};').fetchone()[0]
+            ids = np.arange(rowid + 1, rowid + count + 1)
+            boxes = {}
+            for column, index in spatial.items():
+                values = data[column]
+                if id(values) not in boxes:  # Mirrored columns share their array
+                    low = values if values.ndim == 2 else values.min(axis=1)
+                    high = values if values.ndim == 2 else values.max(axis=1)
+                    boxes[id(values)] = list(zip(ids.tolist(), low[:, 0].tolist(), high[:, 0].tolist(),
+                                                 low[:, 1].tolist(), high[:, 1].tolist()))
+                targets = [bbox_table(table, column)] + ([rtree_table(index)] if index is not None else [])
+                for target in targets:
+                    self.cursor.executemany(f'insert into {target} values (?, ?, ?, ?, ?);', boxes[id(values)])
+            rowid += count
+            yield data, count
+
+    def executemany_chunks(self, table, columns, chunks, n):
+        query = f'insert into {table} ({", ".join(columns)}) values ({", ".join("?" * len(columns))});'
+        inserted = 0
+        try:
+            self.cursor.execute('begin;')
+            for data, count in chunks:
+                self.cursor.executemany(query, zip(*(data[col_name].tolist() for col_name in columns)))
+                inserted += count
+                print(f'Inserted: {inserted}/{n}')
+            self.commit_load(table)
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+    def _copy_table_schema(self, table: str, database: str) -> None:
+        ddl = self.cursor.execute('select sql from sqlite_master where type = ? and name = ?;', ('table', table)).fetchone()[0]
+        ddl = re.sub(r'^create\s+table\s+', f'create table if not exists {database}.', ddl, count=1, flags=re.IGNORECASE)
+        self.cursor.execute(ddl)
+
+    def isolated_path(self, namespace: str) -> str:
+        root, ext = os.path.splitext(self.path)
+        return f'{root}_{namespace}{ext or ".db"}'
 
-    def create_index(self, table: str, index: str, column: str, geospatial: bool = False):
-        if geospatial:
-            raise TypeError()
+    def isolate(self, namespace: str, tables: list[str]) -> 'SqliteDatabase':
+        # A separate database file holding empty copies of the tables
+        self.connection.commit()
+        self.cursor.execute('attach database ? as isolated;', (self.isolated_path(namespace),))
+        try:
+            for table in tables:
+                self._copy_table_schema(table, 'isolated')
+            self.connection.commit()
+        finally:
+            self.cursor.execute('detach database isolated;')
+        return SqliteDatabase(self.isolated_path(namespace), self.load_mode, self.pragma_profile, self.measure_profile)
+
+    def drop_isolated(self, namespace: str) -> None:
+        path = self.isolated_path(namespace)
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def save_snapshot(self, table: str, path: str) -> None:
+        # A template database holding just this table, with the same declared schema
+        if os.path.exists(path):
+            os.remove(path)
+        self.connection.commit()
+        self.cursor.execute('attach database ? as snapshot;', (path,))
+        try:
+            self._copy_table_schema(table, 'snapshot')
+            self.cursor.execute(self._copy_rows(table, 'main', 'snapshot'))
+            for name, column, _ in self.spatial_columns(table):
+                self._copy_table_schema(bbox_table(name, column), 'snapshot')
+                self.cursor.execute(f'insert into snapshot.{bbox_table(name, column)} '
+                                    f'select * from main.{bbox_table(name, column)};')
+            self.connection.commit()
+        finally:
+            self.cursor.execute('detach database snapshot;')
+
+    def _copy_rows(self, table: str, source: str, target: str) -> str:
+        # Bounding boxes are keyed by rowid, which insert ... select * does not carry over, so tables with
+        # geometry copy it explicitly at the cost of the page-copying fast path
+        if not self.spatial_columns(table):
+            return f'insert into {target}.{table} select * from {source}.{table};'
+        columns = ', '.join(row[1] for row in self.cursor.execute(f'pragma {source}.table_info({table});').fetchall())
+        return f'insert into {target}.{table} (rowid, {columns}) select rowid, {columns} from {source}.{table};'
+
+    def restore_snapshot(self, table: str, path: str) -> None:
+        # insert ... select * between identical schemas lets SQLite copy pages without decoding rows
+        self.apply_pragmas(self.pragma_profile)
+        self.cursor.execute('attach database ? as snapshot;', (path,))
+        try:
+            saved = {row[0] for row in self.cursor.execute('select name from snapshot.sqlite_master where type = ?;',
+                                                           ('table',)).fetchall()}
+            for row in self.cursor.execute(f'pragma main.table_info({table});').fetchall():
+                if bbox_table(table, row[1]) in saved:
+                    self.add_spatial_column(table, row[1])
+            self.cursor.execute(self._copy_rows(table, 'snapshot', 'main'))
+            for name, column, index in self.spatial_columns(table):
+                self.cursor.execute(f'insert into main.{bbox_table(name, column)} '
+                                    f'select * from snapshot.{bbox_table(name, column)};')
+                if index is not None:
+                    self.cursor.execute(f'insert into {rtree_table(index)} '
+                                        f'select * from snapshot.{bbox_table(name, column)};')
+            self.connection.commit()
+        finally:
+            self.cursor.execute('detach database snapshot;')
+            self.apply_pragmas(self.measure_profile)
+
+    def sql_literal(self, type_name, value):
+        if type_name == 'int':
+            return str(value)
+        elif COLUMN_KINDS.get(type_name) in ('point', 'polygon'):
+            return f"x'{value}'"
+        return f"'{value}'"
+
+    def analyze_table(self, table: str, vacuum: bool = False) -> None:
+        self.connection.commit()
+        if vacuum:
+            self.cursor.execute('vacuum;')
+        self.cursor.execute(f'analyze {table};')
+        self.connection.commit()
+
+    def drop_index(self, index: str, table: Optional[str] = None, missing_ok: bool = False) -> None:
+        if any(name == index for _, _, name in self.spatial_columns(table)):
+            self.cursor.execute(f'drop table {rtree_table(index)};')
+            self.cursor.execute(f'update {SPATIAL_CATALOG} set index_name = null where index_name = ?;', (index,))
+        elif missing_ok and self.cursor.execute('select 1 from sqlite_master where type = ? and name = ?;',
+                                                ('table', rtree_table(index))).fetchone() is not None:
+            self.cursor.execute(f'drop table {rtree_table(index)};')  # Left by a crash before the catalog update
         else:
-            self.cursor.execute(f'create unique index {index} on {table} ({column});')
+            self.cursor.execute(f'drop index if exists {index};' if missing_ok else f'drop index {index};')
+        self.connection.commit()
+
+    def clear_table(self, table, index=None):
+        for name, column, spatial_index in self.spatial_columns(table):
+            self.cursor.execute(f'delete from {bbox_table(name, column)};')
+            if spatial_index is not None and spatial_index != index:
+                self.cursor.execute(f'delete from {rtree_table(spatial_index)};')
+        super().clear_table(table, index)
+
+    def create_index(self, table: str, index: str, column: str, geospatial: bool = False,
+                     options: Optional[dict] = None):
+        # options: threads (sorter worker threads) and cache_size, applied only while the index builds
+        options = options or {}
+        previous = {pragma: self.cursor.execute(f'pragma {pragma};').fetchone()[0]
+                    for pragma in ('threads', 'cache_size') if pragma in options}
+        self.apply_pragmas({pragma: options[pragma] for pragma in previous})
+        try:
+            if geospatial:
+                # Built from the loader's bounding boxes; R*Tree coordinates are 32-bit floats rounded outwards, so
+                # the box test only prefilters and queries still apply the exact predicate
+                if not any(name == column for _, name, _ in self.spatial_columns(table)):
+                    raise ValueError(f'{table}.{column} is not a geometry column loaded through insert_dummy_data')
+                self.cursor.execute(f'create virtual table {rtree_table(index)} using rtree(id, minx, maxx, miny, maxy);')
+                self.cursor.execute(f'insert into {rtree_table(index)} select * from {bbox_table(table, column)};')
+                self.cursor.execute(f'update {SPATIAL_CATALOG} set index_name = ? where table_name = ? and column_name = ?;',
+                                    (index, table, column))
+                self.connection.commit()
+            else:
+                self.cursor.execute(f'create unique index {index} on {table} ({column});')
+        finally:
+            self.apply_pragmas(previous)
+
+    def table_size(self, table: str) -> dict[str, Optional[int]]:
+        indexes = [row[0] for row in self.cursor.execute(
+            'select name from sqlite_master where type = ? and tbl_name = ?;', ('index', table)).fetchall()]
+        try:
+            sizes = dict(self.cursor.execute(
+                'select name, sum(pgsize) from dbstat group by name;').fetchall())
+        except sqlite3.OperationalError:
+            # Built without dbstat: only the whole file's page count is available
+            page_count = self.cursor.execute('pragma page_count;').fetchone()[0]
+            page_size = self.cursor.execute('pragma page_size;').fetchone()[0]
+            return {'table_bytes': page_count * page_size, 'index_bytes': None}
+        # Bounding boxes count with the table, R*Trees (stored in their _node, _parent and _rowid tables) as indexes
+        spatial = self.spatial_columns(table)
+        boxes = [bbox_table(table, column) for _, column, _ in spatial]
+        rtrees = [f'{rtree_table(index)}_{part}' for _, _, index in spatial if index is not None
+                  for part in ('node', 'parent', 'rowid')]
+        return {'table_bytes': sizes.get(table, 0) + sum(sizes.get(name, 0) for name in boxes),
+                'index_bytes': sum(sizes.get(index, 0) for index in indexes + rtrees)}
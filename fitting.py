@@ -0,0 +1,128 @@
+import math
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import numpy as np
+
+
+SAMPLINGS = ('linear', 'log', 'adaptive')
+
+# Latency modelled as a + b * f(n); 'constant' is a alone
+MODELS: dict[str, Optional[Callable[[np.ndarray], np.ndarray]]] = {
+    'constant': None,
+    'log': np.log,
+    'linear': lambda n: n,
+    'nlogn': lambda n: n * np.log(n),
+    'quadratic': lambda n: n ** 2,
+}
+
+
+@dataclass
+class ModelFit:
+    model: str
+    intercept: float  # Seconds
+    slope: float  # Seconds per unit of the model's term, 0 for 'constant'
+    r2: float  # On the relative scale the fit minimises, so small and large sizes weigh alike
+    relative_rmse: float
+    aicc: float  # Corrected Akaike criterion; the lowest wins, which keeps extra terms from winning on noise
+
+
+@dataclass
+class SeriesFit:
+    series: str
+    sizes: list[int]
+    best: Optional[str]
+    fits: list[ModelFit]
+    extrapolated: dict[int, float] = field(default_factory=dict)  # Size -> predicted seconds under the best model
+
+
+def size_grid(start: int, stop: int, num_points: int, sampling: str = 'linear') -> list[int]:
+    # Sizes in [start, stop): the original evenly stepped grid, or evenly spaced in log n so the small sizes
+    # where index behaviour changes are sampled as densely as the large ones
+    if sampling not in SAMPLINGS:
+        raise ValueError(f'Unknown sampling {sampling}')
+    if sampling == 'linear':
+        return list(range(start, stop, (stop - start) // num_points))
+    sizes = np.geomspace(start, stop, num_points, endpoint=False)
+    return sorted(set(int(round(s)) for s in sizes))
+
+
+def evaluate(model: str, sizes: np.ndarray, intercept: float, slope: float) -> np.ndarray:
+    term = MODELS[model]
+    return intercept + (slope * term(sizes) if term is not None else np.zeros_like(sizes))
+
+
+def fit_model(model: str, sizes: np.ndarray, seconds: np.ndarray) -> Optional[ModelFit]:
+    # Least squares on relative error (rows weighted by 1 / seconds): latencies span orders of magnitude, and
+    # plain least squares would fit the largest sizes only
+    term = MODELS[model]
+    k = 1 if term is None else 2
+    if len(sizes) < k + 1:
+        return None
+    design = np.ones((len(sizes), k))
+    if term is not None:
+        design[:, 1] = term(sizes.astype(np.float64))
+    weights = 1 / np.maximum(seconds, 1e-12)
+    coefficients = np.linalg.lstsq(design * weights[:, None], seconds * weights, rcond=None)[0]
+    intercept, slope = float(coefficients[0]), float(coefficients[1]) if k == 2 else 0.0
+
+    residuals = (evaluate(model, sizes.astype(np.float64), intercept, slope) - seconds) * weights
+    rss = float(np.sum(residuals ** 2))
+    # Every weighted observation is 1, so R² compares against the best constant under the same weighting
+    constant = np.sum(weights) / np.sum(weights ** 2)
+    tss = float(np.sum(((constant - seconds) * weights) ** 2))
+    n = len(sizes)
+    r2 = 1 - rss / tss if tss > 0 else (1.0 if rss == 0 else 0.0)
+    aicc = n * math.log(max(rss, 1e-300) / n) + 2 * k
+    if n - k - 1 > 0:
+        aicc += 2 * k * (k + 1) / (n - k - 1)
+    else:
+        aicc = math.inf
+    return ModelFit(model, intercept, slope, r2, math.sqrt(rss / n), aicc)
+
+
+def fit_series(series: str, sizes: list[int], seconds: list[float],
+               extrapolate: tuple[int, ...] = ()) -> SeriesFit:
+    x = np.asarray(sizes, dtype=np.float64)
+    y = np.asarray(seconds, dtype=np.float64)
+    fits = [fit for fit in (fit_model(model, x, y) for model in MODELS) if fit is not None]
+    # A decreasing fit of a latency curve is noise being fitted, not a complexity class
+    candidates = [fit for fit in fits if fit.slope >= 0 and math.isfinite(fit.aicc)]
+    best = min(candidates, key=lambda fit: fit.aicc) if candidates else None
+    extrapolated = {}
+    if best is not None:
+        for size in extrapolate:
+            extrapolated[size] = float(evaluate(best.model, np.array([size], dtype=np.float64),
+                                                best.intercept, best.slope)[0])
+    return SeriesFit(series, list(sizes), best.model if best is not None else None, fits, extrapolated)
+
+
+def refine_sizes(sizes: list[int], curves: list[tuple[list[float], list[float]]], count: int,
+                 min_ratio: float = 1.25, threshold: float = 0.1) -> list[int]:
+    # Proposes up to count new sizes, each the geometric midpoint of an interval between measured sizes where a
+    # curve bends (change of log-log slope across the interval's ends) or is noisy (relative confidence interval
+    # width at its ends). curves holds (medians, relative CI widths) per series, aligned with sorted sizes
+    if len(sizes) < 2 or count < 1:
+        return []
+    x = np.log(np.asarray(sizes, dtype=np.float64))
+    scores = np.zeros(len(sizes) - 1)
+    for medians, widths in curves:
+        y = np.log(np.maximum(np.asarray(medians, dtype=np.float64), 1e-12))
+        slopes = np.diff(y) / np.diff(x)
+        bend = np.zeros(len(sizes))
+        if len(sizes) > 2:
+            bend[1:-1] = np.abs(np.diff(slopes))
+        noise = np.asarray(widths, dtype=np.float64)
+        # Each interval inherits the bend and noise of the points bounding it
+        scores = np.maximum(scores, np.maximum(np.maximum(bend[:-1], bend[1:]), np.maximum(noise[:-1], noise[1:])))
+
+    new = []
+    for k in np.argsort(-scores, kind='stable'):
+        if len(new) == count or scores[k] < threshold:
+            break
+        if sizes[k + 1] / sizes[k] < min_ratio:
+            continue
+        size = int(round(math.sqrt(sizes[k] * sizes[k + 1])))
+        if sizes[k] < size < sizes[k + 1]:
+            new.append(size)
+    return sorted(new)
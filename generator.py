@@ -0,0 +1,126 @@
+import math
+import string
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+CHARACTERS = np.frombuffer((string.ascii_uppercase + string.ascii_lowercase + string.digits).encode(), dtype='S1')
+HEX_DIGITS = np.array([f'{i:02x}' for i in range(256)], dtype='S2')
+
+# Maps every column type used by the analyzer onto the kind of data generated for it
+COLUMN_KINDS = {
+    'int': 'int',
+    'text': 'str36',
+    'char(36)': 'str36',
+    'char(16)': 'str16',
+    'geometry(point, 4326)': 'point',
+    'point not null srid 4326': 'point',
+    'geometry(polygon, 4326)': 'polygon',
+    'polygon not null srid 4326': 'polygon',
+    'point': 'point',  # SQLite, as WKB blobs
+    'polygon': 'polygon',
+    'uuid': 'uuid',
+    'binary(16)': 'uuid',
+    'bytea': 'id32',
+}
+
+
+# Coordinates are (x, y) with x in [-90, 90] and y in [-180, 180]
+BOUNDS = np.array([[-90.0, 90.0], [-180.0, 180.0]])
+
+
+@dataclass
+class SpatialProfile:
+    points: str = 'uniform'  # 'uniform' or 'clustered'
+    clusters: int = 16  # Gaussian clusters, centred uniformly at random, when points are clustered
+    cluster_spread: float = 2.0  # Standard deviation of each cluster in degrees
+    polygon_vertices: int = 4
+    polygon_area: float = 100.0  # Mean area in square degrees
+    polygon_jitter: float = 0.5  # How far (0-1) vertex radii may shrink from the circumscribed circle
+
+
+class DataGenerator:
+
+    def __init__(self, seed: Optional[int] = None, stream: int = 0, spatial: Optional[SpatialProfile] = None):
+        # stream separates the rows appended by incremental loads from those of the original load
+        self.rng = np.random.default_rng(None if seed is None else [seed, stream])
+        self.spatial = spatial or SpatialProfile()
+        # Cluster centres are shared by every stream so incremental loads keep the same hot spots
+        centre_rng = np.random.default_rng(None if seed is None else [seed, 1 << 32])
+        self.centres = np.column_stack([centre_rng.uniform(low, high, self.spatial.clusters) for low, high in BOUNDS])
+
+    def ints(self, start: int, n: int) -> np.ndarray:
+        return np.arange(start, start + n, dtype=np.int64)
+
+    def strings(self, n: int, length: int) -> np.ndarray:
+        codes = self.rng.integers(0, len(CHARACTERS), size=(n, length), dtype=np.uint8)
+        return CHARACTERS[codes].view(f'S{length}').reshape(n).astype(f'U{length}')
+
+    def points(self, n: int, margin: float = 0.0) -> np.ndarray:
+        low = BOUNDS[:, 0] + margin
+        high = BOUNDS[:, 1] - margin
+        if self.spatial.points == 'uniform':
+            return self.rng.uniform(low, high, (n, 2))
+        elif self.spatial.points == 'clustered':
+            centres = self.centres[self.rng.integers(0, len(self.centres), n)]
+            return np.clip(centres + self.rng.normal(0.0, self.spatial.cluster_spread, (n, 2)), low, high)
+        raise ValueError(f'Unknown point distribution {self.spatial.points}')
+
+    def polygons(self, n: int, vertices: Optional[int] = None) -> np.ndarray:
+        # Star-shaped around a centre: vertices at strictly increasing angles, each at its own radius, can never
+        # cross each other, so every polygon is simple and counter-clockwise
+        vertices = vertices or self.spatial.polygon_vertices
+        jitter = self.spatial.polygon_jitter
+        # Circumradius of a regular polygon with the target area, scaled up for the radii lost to jitter
+        radius = math.sqrt(2 * self.spatial.polygon_area / (vertices * math.sin(2 * math.pi / vertices)))
+        radius /= 1 - jitter / 2
+        slot = 2 * math.pi / vertices
+        angles = self.rng.uniform(0.0, 2 * math.pi, (n, 1)) + slot * (np.arange(vertices) + self.rng.uniform(0.1, 0.9, (n, vertices)))
+        radii = radius * (1 - jitter * self.rng.uniform(0.0, 1.0, (n, vertices)))
+        centres = self.points(n, margin=radius)
+        return centres[:, None, :] + np.stack((radii * np.cos(angles), radii * np.sin(angles)), axis=-1)
+
+    def ids(self, n: int, nbytes: int, uuid: bool = False) -> np.ndarray:
+        raw = self.rng.integers(0, 256, size=(n, nbytes), dtype=np.uint8)
+        if uuid:  # Version 4 / RFC 4122 variant bits, matching gen_random_uuid()
+            raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40
+            raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80
+        return raw.view(f'V{nbytes}').reshape(n)
+
+    def column(self, type_name: str, start: int, n: int) -> np.ndarray:
+        kind = COLUMN_KINDS.get(type_name)
+        if kind == 'int':
+            return self.ints(start, n)
+        elif kind == 'str36':
+            return self.strings(n, 36)
+        elif kind == 'str16':
+            return self.strings(n, 16)
+        elif kind == 'point':
+            return self.points(n)
+        elif kind == 'polygon':
+            return self.polygons(n)
+        elif kind == 'uuid':
+            return self.ids(n, 16, uuid=True)
+        elif kind == 'id32':
+            return self.ids(n, 32)
+        raise TypeError(f'Unsupported column type {type_name}')
+
+    def columns(self, columns: dict[str, str], n: int, start: int = 1) -> dict[str, np.ndarray]:
+        data = {}
+        names = list(columns)
+        for col_name, type_name in columns.items():
+            # The third column mirrors the second so plain and indexed columns hold identical values
+            if len(names) == 3 and col_name == names[2] and type_name == columns[names[1]]:
+                data[col_name] = data[names[1]]
+            else:
+                data[col_name] = self.column(type_name, start, n)
+        return data
+
+
+def hex_strings(values: np.ndarray) -> np.ndarray:
+    # Hex-encodes a column of fixed-width binary values (ids, WKB) without a per-row Python loop
+    width = values.dtype.itemsize
+    raw = np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(len(values), width)
+    return HEX_DIGITS[raw].view(f'S{2 * width}').reshape(len(values)).astype(f'U{2 * width}')
@@ -0,0 +1,128 @@
+import struct
+from typing import Optional
+
+import numpy as np
+
+
+WKB_POINT = 1
+WKB_POLYGON = 3
+EWKB_SRID_FLAG = 0x20000000
+
+
+def _pack(header: list[tuple[str, str, int]], coords: np.ndarray, srid: Optional[int]) -> np.ndarray:
+    # Packs one little-endian WKB record per row with a structured dtype, so a whole column is encoded at once
+    fields = [('order', 'u1')] + [(name, fmt) for name, fmt, _ in header]
+    if srid is not None:
+        fields.insert(2, ('srid', '<u4'))
+    fields.append(('coords', '<f8', coords.shape[1:]))
+
+    out = np.empty(coords.shape[0], dtype=np.dtype(fields))
+    out['order'] = 1
+    for name, _, value in header:
+        out[name] = value
+    if srid is not None:  # EWKB, as read by PostGIS
+        out['type'] |= EWKB_SRID_FLAG
+        out['srid'] = srid
+    out['coords'] = coords
+    return out.view(f'V{out.dtype.itemsize}')
+
+
+def wkb_points(points: np.ndarray, srid: Optional[int] = None) -> np.ndarray:
+    return _pack([('type', '<u4', WKB_POINT)], points, srid)
+
+
+def wkb_polygons(polygons: np.ndarray, srid: Optional[int] = None) -> np.ndarray:
+    ring = np.concatenate((polygons, polygons[:, :1]), axis=1)  # Rings are closed by repeating the first vertex
+    header = [('type', '<u4', WKB_POLYGON), ('rings', '<u4', 1), ('points', '<u4', ring.shape[1])]
+    return _pack(header, ring, srid)
+
+
+def wkb_vertices(wkb: bytes) -> list[tuple[float, float]]:
+    # The point, or the closed exterior ring of a polygon, of one (E)WKB record in either byte order
+    order = '<' if wkb[0] == 1 else '>'
+    geometry_type, = struct.unpack_from(order + 'I', wkb, 1)
+    offset = 9 if geometry_type & EWKB_SRID_FLAG else 5
+    geometry_type &= 0xffff
+    if geometry_type == WKB_POINT:
+        return [struct.unpack_from(order + 'dd', wkb, offset)]
+    elif geometry_type == WKB_POLYGON:
+        _, count = struct.unpack_from(order + 'II', wkb, offset)
+        flat = struct.unpack_from(f'{order}{2 * count}d', wkb, offset + 8)
+        return list(zip(flat[::2], flat[1::2]))
+    raise ValueError(f'Unsupported WKB geometry type {geometry_type}')
+
+
+def bounds(vertices: list[tuple[float, float]]) -> tuple[float, float, float, float]:
+    xs = [x for x, _ in vertices]
+    ys = [y for _, y in vertices]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def _orientation(a, b, c) -> float:
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def _segments_cross(p1, p2, q1, q2, proper: bool) -> bool:
+    # proper: the segments cross at a single point interior to both, so touching and collinear overlaps do not count
+    d1, d2 = _orientation(q1, q2, p1), _orientation(q1, q2, p2)
+    d3, d4 = _orientation(p1, p2, q1), _orientation(p1, p2, q2)
+    if proper:
+        return d1 * d2 < 0 and d3 * d4 < 0
+    if d1 * d2 > 0 or d3 * d4 > 0:
+        return False
+    if d1 == d2 == d3 == d4 == 0:  # Collinear: they meet only if their extents overlap
+        return (min(p1[0], p2[0]) <= max(q1[0], q2[0]) and min(q1[0], q2[0]) <= max(p1[0], p2[0])
+                and min(p1[1], p2[1]) <= max(q1[1], q2[1]) and min(q1[1], q2[1]) <= max(p1[1], p2[1]))
+    return True
+
+
+def _boxes_meet(a: list[tuple[float, float]], b: list[tuple[float, float]]) -> bool:
+    ax1, ax2, ay1, ay2 = bounds(a)
+    bx1, bx2, by1, by2 = bounds(b)
+    return ax1 <= bx2 and bx1 <= ax2 and ay1 <= by2 and by1 <= ay2
+
+
+def _rings_cross(a: list[tuple[float, float]], b: list[tuple[float, float]], proper: bool) -> bool:
+    return any(_segments_cross(a[i], a[i + 1], b[j], b[j + 1], proper)
+               for i in range(len(a) - 1) for j in range(len(b) - 1))
+
+
+def ring_contains(ring: list[tuple[float, float]], point: tuple[float, float]) -> bool:
+    # Even-odd ray casting; a point exactly on the boundary may fall either way
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def distance_within(a: list[tuple[float, float]], b: list[tuple[float, float]], distance: float) -> bool:
+    # Planar, in coordinate units, between points as st_dwithin measures geometries
+    (ax, ay), (bx, by) = a[0], b[0]
+    return (ax - bx) ** 2 + (ay - by) ** 2 <= distance ** 2
+
+
+def contains(a: list[tuple[float, float]], b: list[tuple[float, float]]) -> bool:
+    # A polygon containing a point or another polygon (every vertex inside, no boundary crossing)
+    if len(a) == 1 or not _boxes_meet(a, b):
+        return False
+    return all(ring_contains(a, v) for v in b[:-1] or b) and not _rings_cross(a, b, True)
+
+
+def intersects(a: list[tuple[float, float]], b: list[tuple[float, float]]) -> bool:
+    if not _boxes_meet(a, b):
+        return False
+    if len(a) == 1 or len(b) == 1:
+        point, other = (a, b) if len(a) == 1 else (b, a)
+        return point[0] == other[0] if len(other) == 1 else (
+            ring_contains(other, point[0]) or _rings_cross(other, point + point, False))
+    return _rings_cross(a, b, False) or ring_contains(a, b[0]) or ring_contains(b, a[0])
+
+
+def overlaps(a: list[tuple[float, float]], b: list[tuple[float, float]]) -> bool:
+    # Polygons whose interiors meet with neither inside the other: for simple rings, exactly when the boundaries
+    # properly cross
+    if len(a) == 1 or len(b) == 1 or not _boxes_meet(a, b):
+        return False
+    return _rings_cross(a, b, True)
@@ -0,0 +1,115 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from databases.sql import SqlDatabase
+from timing import Distribution, summarize
+
+
+@dataclass
+class LevelResult:
+    concurrency: int
+    target_rate: Optional[float]  # Queries/sec offered in open-loop mode, None when clients run flat out
+    duration: float
+    completed: int
+    errors: int
+    throughput: float  # Completed queries/sec
+    latency: Optional[Distribution]
+    error_messages: list[str]
+
+
+class LoadGenerator:
+    # Drives queries from a pool of connections, one per client thread, at fixed concurrency levels
+
+    def __init__(self, database: SqlDatabase, queries: list[str], fetch: bool = True):
+        self.database = database
+        self.queries = queries
+        self.fetch = fetch
+        self.pool: list[SqlDatabase] = []
+
+    def _grow_pool(self, size: int) -> None:
+        while len(self.pool) < size:
+            self.pool.append(self.database.clone())
+
+    def close(self) -> None:
+        for database in self.pool:
+            database.close()
+        self.pool = []
+
+    def _execute(self, database: SqlDatabase, query: str) -> None:
+        database.cursor.execute(query)
+        if self.fetch:
+            database.cursor.fetchall()
+        database.connection.commit()
+
+    def run_level(self, concurrency: int, duration: float, target_rate: Optional[float] = None) -> LevelResult:
+        # Closed loop without target_rate: every client issues its next query as soon as the last returns.
+        # Open loop with target_rate: queries are due at fixed arrival times and latency counts from the due
+        # time, so queueing behind a saturated server shows up instead of being hidden by slower arrivals.
+        self._grow_pool(concurrency)
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        arrivals = iter(range(1 << 62))
+        start = time.perf_counter()
+        deadline = start + duration
+
+        def client(worker: int) -> None:
+            database = self.pool[worker]
+            i = worker
+            while True:
+                if target_rate is not None:
+                    with lock:
+                        due = start + next(arrivals) / target_rate
+                    if due >= deadline:
+                        return
+                    time.sleep(max(0.0, due - time.perf_counter()))
+                else:
+                    due = time.perf_counter()
+                    if due >= deadline:
+                        return
+                query = self.queries[i % len(self.queries)]
+                i += concurrency
+                try:
+                    self._execute(database, query)
+                    elapsed = time.perf_counter() - due
+                    with lock:
+                        latencies.append(elapsed)
+                except Exception as e:
+                    database.connection.rollback()
+                    with lock:
+                        errors.append(f'{type(e).__name__}: {e}')
+
+        threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        return LevelResult(
+            concurrency=concurrency,
+            target_rate=target_rate,
+            duration=elapsed,
+            completed=len(latencies),
+            errors=len(errors),
+            throughput=len(latencies) / elapsed,
+            latency=summarize(latencies) if latencies else None,
+            error_messages=errors[:10]
+        )
+
+    def run(self, levels: list[int], duration: float = 10.0, target_rate: Optional[float] = None) -> list[LevelResult]:
+        results = []
+        for concurrency in levels:
+            print(f'Running {concurrency} clients for {duration} seconds'
+                  + (f' at {target_rate} queries/sec' if target_rate is not None else ''))
+            result = self.run_level(concurrency, duration, target_rate)
+            if result.latency is not None:
+                print(f'{concurrency} clients: {result.throughput:.1f} queries/sec, '
+                      f'p50 {result.latency.median}, p90 {result.latency.p90}, p99 {result.latency.p99}, '
+                      f'{result.errors} errors')
+            else:
+                print(f'{concurrency} clients: no queries completed, {result.errors} errors')
+            results.append(result)
+        return results
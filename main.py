@@ -1,11 +1,20 @@
+import json
+
 from analyzer import Analyzer
 from databases.mysql import MySqlDatabase
 from databases.postgresql import PostgresDatabase
 from databases.sqlite import SqliteDatabase
+from results_store import ResultsStore
+from scheduler import EngineSpec, Scheduler
+from tracing import configure
 
 
 # pg.insert_dummy_data('poly_test', 1000000, 'id', 'int', 'poly_plain', 'geometry(polygon, 4326)', 'poly_ndx', 'geometry(polygon, 4326)')
-def run_analysis(postgres=False, mysql=False, sqlite=False):
+def run_analysis(postgres=False, mysql=False, sqlite=False, trace=None):
+    results = ResultsStore('analyses/results.db')
+    if trace is not None:
+        # e.g. trace='analyses/run1' writes run1.jsonl and run1.trace.json, the latter for chrome://tracing or Perfetto
+        tracer = configure(progress=True, jsonl=f'{trace}.jsonl', chrome=f'{trace}.trace.json')
     if postgres:
         pg = PostgresDatabase(
             'dbfinal_postgres',
@@ -13,7 +22,7 @@ def run_analysis(postgres=False, mysql=False, sqlite=False):
             'password',
             'testing'
         )
-        pg_analyzer = Analyzer(pg)
+        pg_analyzer = Analyzer(pg, results=results)
         pg_analyzer.run_analysis('analyses/analysis_pg2.json', geospatial=True, ids=True)
         print(pg_analyzer.report)
 
@@ -23,16 +32,38 @@ def run_analysis(postgres=False, mysql=False, sqlite=False):
             'dbfinal',
             'password'
         )
-        ms_analyzer = Analyzer(ms)
+        ms_analyzer = Analyzer(ms, results=results)
         ms_analyzer.run_analysis('analyses/analysis_ms2.json', geospatial=True, ids=True)
         print(ms_analyzer.report)
 
     if sqlite:
         sl = SqliteDatabase('/Users/paulgagliano/Downloads/dbfinal_sqlite.db')
-        sl_analyzer = Analyzer(sl)
-        sl_analyzer.run_analysis('analyses/analysis_sl.json', geospatial=False, ids=True)
+        sl_analyzer = Analyzer(sl, results=results)
+        # The spatial tables are plain blob columns plus the loader's bounding-box tables, created on first use
+        tables, _ = sl_analyzer.table_definitions(geospatial=True)
+        for name in ('point_test', 'poly_test'):
+            sl.create_table(name, tables[name])
+        sl_analyzer.run_analysis('analyses/analysis_sl.json', geospatial=True, ids=True)
         print(sl_analyzer.report)
 
+    if trace is not None:
+        tracer.close()
+
+
+def run_parallel_analysis(postgres=False, mysql=False, sqlite=False, max_workers=4, mode='isolated'):
+    engines = {}
+    if postgres:
+        engines['postgres'] = EngineSpec('postgres', ('dbfinal_postgres', 'dbfinal', 'password', 'testing'))
+    if mysql:
+        engines['mysql'] = EngineSpec('mysql', ('dbfinal_mysql', 'dbfinal', 'password'))
+    if sqlite:
+        engines['sqlite'] = EngineSpec('sqlite', ('/Users/paulgagliano/Downloads/dbfinal_sqlite.db',))
+
+    scheduler = Scheduler(engines, max_workers=max_workers, mode=mode)
+    results = scheduler.run(scheduler.build_jobs(geospatial=True, ids=True))
+    with open('analyses/analysis_parallel.json', 'w') as file:
+        file.write(json.dumps(scheduler.report(results), indent=4))
+
 
 def main():
     run_analysis(postgres=True, mysql=True)
@@ -0,0 +1,70 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+
+import numpy as np
+
+from tracing import span
+
+
+class ChunkPipeline:
+    # Generates rows in chunks on a worker thread and hands them to the writer over a bounded queue,
+    # so at most queue_depth + 2 chunks are alive at once and generation overlaps with inserts.
+
+    def __init__(self,
+                 generate: Callable[[int, int], dict[str, np.ndarray]],
+                 n: int,
+                 chunk_size: int = 100000,
+                 queue_depth: int = 2,
+                 table: str = ''):
+        if chunk_size < 1 or queue_depth < 1:
+            raise ValueError('chunk_size and queue_depth must be positive')
+        self.generate = generate
+        self.n = n
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stopped = threading.Event()
+        self.table = table
+        self.generate_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _produce(self) -> None:
+        try:
+            for offset in range(0, self.n, self.chunk_size):
+                count = min(self.chunk_size, self.n - offset)
+                t1 = time.perf_counter()
+                with span('generate', 'load', table=self.table, rows=count):
+                    data = self.generate(offset, count)
+                self.generate_seconds += time.perf_counter() - t1
+                if not self._put((data, count)):
+                    return
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self) -> Iterator[tuple[dict[str, np.ndarray], int]]:
+        worker = threading.Thread(target=self._produce, name=f'generate {self.table}'.rstrip(), daemon=True)
+        worker.start()
+        try:
+            while True:
+                t1 = time.perf_counter()
+                item = self.queue.get()
+                self.wait_seconds += time.perf_counter() - t1
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+            worker.join()
@@ -0,0 +1,182 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from databases.sql import SqlDatabase
+from generator import BOUNDS, COLUMN_KINDS, DataGenerator
+from geometry import bounds, wkb_points, wkb_polygons, wkb_vertices
+
+
+SELECTIVITIES = (0.0001, 0.01, 0.1)
+SELECTIVITY_TOLERANCE = 0.5  # Relative miss of the target row count before a bank query is flagged
+EARTH_RADIUS = 6370986.0  # Metres, the sphere st_distance_sphere uses by default
+
+
+@dataclass
+class BankQuery:
+    name: str  # e.g. 'hit', 'miss', 'range_1%'
+    template: str  # %s placeholders, filled from one params tuple per trial
+    params: list[tuple]
+    selectivity: Optional[float] = None  # Target fraction of the table matched, None for key lookups
+    kind: str = 'select'
+    matched: list[int] = field(default_factory=list)  # Rows each params tuple actually matched
+
+    def queries(self, database: SqlDatabase) -> list[str]:
+        return [database.render_query(self.template, params) for params in self.params]
+
+
+def percent(selectivity: float) -> str:
+    return f'{selectivity * 100:g}%'
+
+
+def haversine(x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, y2: np.ndarray) -> np.ndarray:
+    # x is latitude and y longitude, in degrees, as MySQL reads SRID 4326 coordinates
+    x1, y1, x2, y2 = (np.radians(v) for v in (x1, y1, x2, y2))
+    a = np.sin((x2 - x1) / 2) ** 2 + np.cos(x1) * np.cos(x2) * np.sin((y2 - y1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class QueryBank:
+    # Builds lookups from keys actually present in a loaded table, misses, and range or spatial predicates sized
+    # from a sample to match a target fraction of the rows. Every query carries several parameter sets that are
+    # rotated across trials, so no two consecutive trials run identical text
+
+    def __init__(self, database: SqlDatabase, seed: Optional[int] = None,
+                 selectivities: tuple[float, ...] = SELECTIVITIES, miss_ratio: float = 0.5, variants: int = 16,
+                 sample_rows: int = 20000):
+        self.database = database
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.selectivities = selectivities
+        self.miss_ratio = miss_ratio  # Share of misses in the mixed 'lookup' query
+        self.variants = variants
+        self.sample_rows = sample_rows
+
+    def sample(self, table: str, expressions: list[str], n: int, ordinal: str = 'id',
+               order_by: Optional[str] = None) -> list[tuple]:
+        # Every step-th row by the table's sequential ordinal column, so the sample costs one scan and at most a sort
+        # of the sampled rows
+        step = max(1, n // self.sample_rows)
+        order = f' order by {order_by}' if order_by is not None else ''
+        self.database.cursor.execute(
+            f'select {", ".join(expressions)} from {table} where {ordinal} % {step} = 0{order};')
+        rows = self.database.cursor.fetchall()
+        self.database.connection.commit()
+        return [tuple(bytes(v) if isinstance(v, memoryview) else v for v in row) for row in rows]
+
+    def misses(self, type_name: str, n: int, count: int) -> list:
+        generator = DataGenerator(self.seed, 1 << 33)
+        kind = COLUMN_KINDS[type_name]
+        if kind == 'int':
+            return (n + 1 + self.rng.integers(0, max(n, 1), count)).tolist()
+        elif kind == 'str36':
+            return generator.strings(count, 36).tolist()
+        elif kind == 'str16':
+            return generator.strings(count, 16).tolist()
+        elif kind == 'uuid':
+            values = generator.ids(count, 16, uuid=True).tolist()
+            # Postgres compares uuid columns with their text form
+            return [v.hex() for v in values] if type_name == 'uuid' else values
+        elif kind == 'id32':
+            return generator.ids(count, 32).tolist()
+        raise TypeError(f'No misses for column type {type_name}')
+
+    def lookups(self, table: str, column: str, type_name: str, n: int, ordinal: str = 'id') -> list[BankQuery]:
+        template = f'select * from {table} where {column} = %s;'
+        keys = [row[0] for row in self.sample(table, [column], n, ordinal)]
+        hits = [keys[i] for i in self.rng.integers(0, len(keys), self.variants)]
+        misses = self.misses(type_name, n, self.variants)
+        queries = [BankQuery('hit', template, [(k,) for k in hits]),
+                   BankQuery('miss', template, [(k,) for k in misses])]
+        if 0 < self.miss_ratio < 1:
+            mixed = [misses[i] if miss else hits[i] for i, miss in enumerate(self.rng.random(self.variants) < self.miss_ratio)]
+            queries.append(BankQuery(f'lookup_{percent(self.miss_ratio)}_miss', template, [(k,) for k in mixed]))
+        return queries
+
+    def ranges(self, table: str, column: str, n: int, ordinal: str = 'id') -> list[BankQuery]:
+        # Bounds are sample quantiles, so they work for strings as well as ints; the engine sorts the sample, so
+        # string quantiles follow the column's collation as the range predicates compare it
+        keys = [row[0] for row in self.sample(table, [column], n, ordinal, order_by=column)]
+        queries = []
+        for selectivity in self.selectivities:
+            width = max(1, round(selectivity * len(keys)))
+            starts = self.rng.integers(0, max(1, len(keys) - width), self.variants)
+            params = [(keys[i], keys[min(i + width, len(keys) - 1)]) for i in starts.tolist()]
+            queries.append(BankQuery(f'range_{percent(selectivity)}',
+                                     f'select * from {table} where {column} >= %s and {column} < %s;',
+                                     params, selectivity))
+        return queries
+
+    def spatial(self, table: str, column: str, type_name: str, n: int, ordinal: str = 'id') -> list[BankQuery]:
+        postgres = type_name.startswith('geometry')
+        sqlite = type_name in ('point', 'polygon')
+        polygon = COLUMN_KINDS[type_name] == 'polygon'
+        boxes = None
+        if polygon:
+            # Whole polygons as WKB, decoded here, since no bounding-box accessor works on every engine and SRS;
+            # each is located by its first vertex and sized by its bounding box
+            expression = column if sqlite else f'st_asbinary({column})'
+            vertices = [wkb_vertices(row[0]) for row in self.sample(table, [expression], n, ordinal)]
+            coords = np.array([v[0] for v in vertices], dtype=np.float64)
+            boxes = np.array([bounds(v) for v in vertices], dtype=np.float64)  # minx, maxx, miny, maxy
+        elif sqlite:  # WKB blobs without accessor functions, decoded here instead
+            coords = np.array([wkb_vertices(row[0])[0] for row in self.sample(table, [column], n, ordinal)])
+        else:
+            coords = np.array(self.sample(table, [f'st_x({column})', f'st_y({column})'], n, ordinal), dtype=np.float64)
+        centres = coords[self.rng.integers(0, len(coords), self.variants)]
+        geometry = 'st_geomfromewkb(%s)' if postgres else '%s' if sqlite else 'st_geomfromwkb(%s, 4326)'
+        srid = 4326 if postgres else None
+        # An indexed SQLite column is only reached through its R*Tree, so its queries carry the box to search
+        rtree = self.database.rtree(table, column) if sqlite else None
+        prefilter = (f'rowid in (select id from {rtree} where minx <= %s and maxx >= %s and miny <= %s and maxy >= %s) '
+                     'and ') if rtree is not None else ''
+
+        queries = []
+        for selectivity in self.selectivities:
+            params = []
+            for cx, cy in centres.tolist():
+                if polygon:
+                    # Square window whose half-side reaches the target share of polygons: a window meets a polygon's
+                    # bounding box once it reaches the box's nearest point, by Chebyshev distance
+                    dx = np.maximum(np.maximum(boxes[:, 0] - cx, cx - boxes[:, 1]), 0)
+                    dy = np.maximum(np.maximum(boxes[:, 2] - cy, cy - boxes[:, 3]), 0)
+                    reach = np.maximum(dx, dy)
+                    half = max(float(np.quantile(reach, selectivity)), 1e-6)  # Never a degenerate window
+                    x1, x2 = np.clip([cx - half, cx + half], *BOUNDS[0]).tolist()
+                    y1, y2 = np.clip([cy - half, cy + half], *BOUNDS[1]).tolist()
+                    window = np.array([[[x1, y1], [x2, y1], [x2, y2], [x1, y2]]])
+                    box = (x2, x1, y2, y1) if rtree is not None else ()
+                    params.append(box + (wkb_polygons(window, srid).tolist()[0],))
+                else:
+                    if postgres or sqlite:
+                        distances = np.hypot(coords[:, 0] - cx, coords[:, 1] - cy)  # Degrees, as st_dwithin measures
+                    else:
+                        distances = haversine(coords[:, 0], coords[:, 1], cx, cy)
+                    centre = wkb_points(np.array([[cx, cy]]), srid).tolist()[0]
+                    distance = float(np.quantile(distances, selectivity))
+                    box = (cx + distance, cx - distance, cy + distance, cy - distance) if rtree is not None else ()
+                    params.append(box + (centre, distance))
+            if polygon:
+                template = f'select * from {table} where {prefilter}st_intersects({column}, {geometry});'
+            elif postgres or sqlite:
+                template = f'select * from {table} where {prefilter}st_dwithin({column}, {geometry}, %s);'
+            else:
+                template = f'select * from {table} where st_distance_sphere({column}, {geometry}) < %s;'
+            queries.append(BankQuery(f'{"window" if polygon else "near"}_{percent(selectivity)}', template,
+                                     params, selectivity))
+        return queries
+
+    def build(self, table: str, columns: dict[str, str], column: str, n: int, ordinal: str = 'id') -> list[BankQuery]:
+        type_name = columns[column]
+        kind = COLUMN_KINDS[type_name]
+        if kind in ('point', 'polygon'):
+            return self.spatial(table, column, type_name, n, ordinal)
+        queries = self.lookups(table, column, type_name, n, ordinal)
+        if kind in ('int', 'str36', 'str16'):
+            queries += self.ranges(table, column, n, ordinal)
+        return queries
+
+    def count_matches(self, query: BankQuery) -> list[int]:
+        query.matched = [self.database.fetch_query(q, 'count').rows for q in query.queries(self.database)]
+        return query.matched
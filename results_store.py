@@ -0,0 +1,189 @@
+import csv
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+from typing import Iterator, Optional
+
+from timing import Distribution
+
+
+SCHEMA = '''
+create table if not exists runs (
+    id integer primary key,
+    started real not null,
+    finished real,
+    engine text not null,
+    server_version text,
+    host text,
+    git_commit text,
+    seed integer,
+    sizes text,
+    meta text
+);
+create table if not exists points (
+    id integer primary key,
+    run_id integer not null references runs (id),
+    series text not null,
+    size integer not null,
+    query text not null,
+    trials integer not null,
+    warmup integer not null,
+    mean real,
+    min real,
+    median real,
+    p90 real,
+    p99 real,
+    stddev real,
+    ci_low real,
+    ci_high real,
+    confidence real,
+    extra text
+);
+create table if not exists samples (
+    point_id integer not null references points (id),
+    trial integer not null,
+    seconds real not null
+);
+create index if not exists points_run on points (run_id, series, size);
+create index if not exists points_query on points (query);
+create index if not exists samples_point on samples (point_id);
+'''
+
+POINT_COLUMNS = ['run_id', 'engine', 'server_version', 'series', 'size', 'query', 'trials', 'warmup', 'mean', 'min',
+                 'median', 'p90', 'p99', 'stddev', 'ci_low', 'ci_high', 'confidence']
+SAMPLE_COLUMNS = ['run_id', 'engine', 'server_version', 'series', 'size', 'query', 'trial', 'seconds']
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ResultsStore:
+    # Append-only SQLite store of every run's raw per-trial samples. Each measured point is committed as soon as
+    # it is recorded, and the exporters stream rows straight from a cursor so sweeps of any size fit in memory
+
+    def __init__(self, path: str = 'analyses/results.db'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def start_run(self, engine: str, server_version: Optional[str] = None, seed: Optional[int] = None,
+                  sizes: Optional[list[int]] = None, **meta) -> int:
+        cursor = self.connection.execute(
+            'insert into runs (started, engine, server_version, host, git_commit, seed, sizes, meta) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?);',
+            (time.time(), engine, server_version, platform.node(), git_commit(), seed,
+             json.dumps(sizes), json.dumps(meta, default=str))
+        )
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def finish_run(self, run_id: int) -> None:
+        self.connection.execute('update runs set finished = ? where id = ?;', (time.time(), run_id))
+        self.connection.commit()
+
+    def add_point(self, run_id: int, series: str, size: int, query: str, distribution: Distribution) -> int:
+        extra = {'plan': distribution.plan, 'fetch': distribution.fetch}
+        cursor = self.connection.execute(
+            'insert into points (run_id, series, size, query, trials, warmup, mean, min, median, p90, p99, stddev, '
+            'ci_low, ci_high, confidence, extra) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+            (run_id, series, size, query, distribution.trials, distribution.warmup, distribution.mean,
+             distribution.min, distribution.median, distribution.p90, distribution.p99, distribution.stddev,
+             distribution.ci_low, distribution.ci_high, distribution.confidence, json.dumps(extra))
+        )
+        point_id = cursor.lastrowid
+        self.connection.executemany('insert into samples (point_id, trial, seconds) values (?, ?, ?);',
+                                    ((point_id, trial, seconds) for trial, seconds in enumerate(distribution.samples)))
+        self.connection.commit()
+        return point_id
+
+    def runs(self, engine: Optional[str] = None) -> list[dict]:
+        cursor = self.connection.execute(
+            'select id, started, finished, engine, server_version, host, git_commit, seed, sizes, meta from runs '
+            + ('where engine = ? ' if engine is not None else '') + 'order by id;',
+            (engine,) if engine is not None else ()
+        )
+        names = [column[0] for column in cursor.description]
+        runs = []
+        for row in cursor:
+            run = dict(zip(names, row))
+            run['sizes'] = json.loads(run['sizes']) if run['sizes'] else None
+            run['meta'] = json.loads(run['meta']) if run['meta'] else {}
+            runs.append(run)
+        return runs
+
+    def latest_run(self, engine: Optional[str] = None) -> Optional[int]:
+        runs = self.runs(engine)
+        return runs[-1]['id'] if runs else None
+
+    def _where(self, run_id: Optional[int], series: Optional[str], query: Optional[str]) -> tuple[str, tuple]:
+        clauses = []
+        params = []
+        for column, value in (('points.run_id', run_id), ('points.series', series), ('points.query', query)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        return (' where ' + ' and '.join(clauses)) if clauses else '', tuple(params)
+
+    def points(self, run_id: Optional[int] = None, series: Optional[str] = None,
+               query: Optional[str] = None) -> Iterator[tuple]:
+        where, params = self._where(run_id, series, query)
+        return self.connection.execute(
+            'select points.run_id, runs.engine, runs.server_version, points.series, points.size, points.query, '
+            'points.trials, points.warmup, points.mean, points.min, points.median, points.p90, points.p99, '
+            'points.stddev, points.ci_low, points.ci_high, points.confidence '
+            f'from points join runs on runs.id = points.run_id{where} '
+            'order by points.run_id, points.series, points.size;', params
+        )
+
+    def samples(self, run_id: Optional[int] = None, series: Optional[str] = None,
+                query: Optional[str] = None) -> Iterator[tuple]:
+        where, params = self._where(run_id, series, query)
+        return self.connection.execute(
+            'select points.run_id, runs.engine, runs.server_version, points.series, points.size, points.query, '
+            'samples.trial, samples.seconds '
+            f'from samples join points on points.id = samples.point_id join runs on runs.id = points.run_id{where} '
+            'order by points.run_id, points.series, points.size, samples.trial;', params
+        )
+
+    def point_samples(self, run_id: int) -> dict[tuple[str, int], list[float]]:
+        # (series, size) -> raw samples of one run
+        out: dict[tuple[str, int], list[float]] = {}
+        for _, _, _, series, size, _, _, seconds in self.samples(run_id):
+            out.setdefault((series, size), []).append(seconds)
+        return out
+
+    def export_csv(self, out_file: str, run_id: Optional[int] = None, raw: bool = False) -> int:
+        # One row per point with its summary statistics, or one row per trial when raw
+        rows = self.samples(run_id) if raw else self.points(run_id)
+        count = 0
+        with open(out_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(SAMPLE_COLUMNS if raw else POINT_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def export_json(self, out_file: str, run_id: Optional[int] = None, raw: bool = False) -> int:
+        # A JSON array of row objects, written one row at a time
+        rows = self.samples(run_id) if raw else self.points(run_id)
+        columns = SAMPLE_COLUMNS if raw else POINT_COLUMNS
+        count = 0
+        with open(out_file, 'w') as file:
+            file.write('[')
+            for row in rows:
+                file.write((',\n' if count else '\n') + json.dumps(dict(zip(columns, row))))
+                count += 1
+            file.write('\n]\n')
+        return count
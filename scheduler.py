@@ -0,0 +1,238 @@
+import multiprocessing
+import time
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from analyzer import (GEOSPATIAL_JOIN_TRIALS, GEOSPATIAL_TRIALS, ID_TRIALS, JOIN_TRIALS, POINT_POLY_POINTS,
+                      POINT_POLY_STOP, POINT_POLY_TRIALS, SELECT_TRIALS, Analyzer)
+from databases.mysql import MySqlDatabase
+from databases.postgresql import PostgresDatabase
+from databases.sql import SqlDatabase
+from databases.sqlite import SqliteDatabase
+from fitting import SAMPLINGS, size_grid
+from timing import Distribution, TimingPolicy
+from utils import generate_queries, generate_id_query
+
+
+ENGINES = {'postgres': PostgresDatabase, 'mysql': MySqlDatabase, 'sqlite': SqliteDatabase}
+
+
+@dataclass
+class EngineSpec:
+    # Picklable recipe for opening a connection inside a worker process
+    engine: str
+    args: tuple
+    kwargs: dict = field(default_factory=dict)
+
+    def connect(self) -> SqlDatabase:
+        return ENGINES[self.engine](*self.args, **self.kwargs)
+
+
+@dataclass
+class QueryJob:
+    series: str
+    query: str
+    min_trials: int
+    indexes: tuple[str, ...] = ()
+    kind: str = 'select'
+    max_trials: Optional[int] = None  # Caps slow queries at min_trials, as run_analysis does
+
+
+@dataclass
+class Job:
+    # One node of the engine x table x size x query graph: the queries share the loaded tables
+    engine: str
+    size: int
+    tables: dict[str, tuple[dict[str, str], Optional[str], bool]]  # name -> (columns, index, geospatial)
+    queries: list[QueryJob]
+    strategies: tuple[str, ...] = ()  # Index strategies re-timed against each table's indexed select and join
+
+    @property
+    def name(self) -> str:
+        return f'{self.engine}/{"+".join(self.tables)}/{self.size}'
+
+
+@dataclass
+class JobResult:
+    job: str
+    engine: str
+    size: int
+    distributions: dict[str, Distribution]
+    seconds: float
+
+
+def run_job(spec: EngineSpec, job: Job, namespace: Optional[str], timing_lock, seed: Optional[int],
+            timing: Optional[TimingPolicy]) -> JobResult:
+    t1 = time.time()
+    base = spec.connect()
+    database = base.isolate(namespace, list(job.tables)) if namespace is not None else base
+    analyzer = Analyzer(database, seed)
+    analyzer.timing = timing or TimingPolicy()
+    try:
+        for name, (columns, index, geospatial) in job.tables.items():
+            analyzer.prepare_table(name, columns, job.size, index, geospatial)
+
+        distributions = {}
+        for query in job.queries:
+            with timing_lock if timing_lock is not None else nullcontext():
+                distributions[query.series] = analyzer.measure_query(query.query, query.min_trials, query.indexes,
+                                                                     query.kind, max_trials=query.max_trials)
+
+        if job.strategies:
+            analyzer.index_strategies = job.strategies
+            queries = {query.series: query for query in job.queries}
+            for name, (columns, index, geospatial) in job.tables.items():
+                select, join = queries[f'selects/{index}'], queries[f'joins/{index}']
+                with timing_lock if timing_lock is not None else nullcontext():
+                    swapped, _ = analyzer.measure_strategies(name, columns, index, job.size, [select.query, join.query],
+                                                             select.min_trials, join.min_trials, geospatial)
+                distributions.update({f'strategies/{series}': distribution for series, distribution in swapped.items()})
+
+        for name, (_, index, _) in job.tables.items():
+            analyzer.release_table(name, index)
+    finally:
+        if namespace is not None:
+            database.close()
+            base.drop_isolated(namespace)
+        base.close()
+    return JobResult(job.name, job.engine, job.size, distributions, time.time() - t1)
+
+
+class Scheduler:
+    # Runs independent benchmark jobs in parallel worker processes, each with its own connection.
+    # isolate_namespaces gives every job a private schema/database/file so jobs on the same table can overlap;
+    # otherwise jobs touching the same engine table wait for each other. mode='isolated' lets loads run in
+    # parallel but serializes every timing phase so concurrently running jobs cannot skew each other's numbers.
+
+    def __init__(self, engines: dict[str, EngineSpec], max_workers: int = 4, max_per_engine: Optional[int] = None,
+                 isolate_namespaces: bool = True, mode: str = 'parallel', seed: Optional[int] = None,
+                 timing: Optional[TimingPolicy] = None):
+        if mode not in ('parallel', 'isolated'):
+            raise ValueError(f'Unknown scheduling mode {mode}')
+        self.engines = engines
+        self.max_workers = max_workers
+        self.max_per_engine = max_per_engine or max_workers
+        self.isolate_namespaces = isolate_namespaces
+        self.mode = mode
+        self.seed = seed
+        self.timing = timing
+
+    def build_jobs(self, start: int = 100, stop: int = 1000000, stop_small: int = 10000, num_points: int = 10,
+                   geospatial: bool = False, ids: bool = False, sampling: str = 'linear',
+                   index_strategies: tuple[str, ...] = ()) -> list[Job]:
+        # The same size grids and trial counts as Analyzer.run_analysis. Jobs are independent, so 'adaptive'
+        # sampling, which picks sizes from points already measured, runs its log grid without the added sizes
+        if sampling not in SAMPLINGS:
+            raise ValueError(f'Unknown sampling {sampling}')
+        grid_sampling = 'linear' if sampling == 'linear' else 'log'
+        grid = size_grid(start, stop, num_points, grid_sampling)
+        grid_small = size_grid(start, stop_small, num_points, grid_sampling)
+        grid_point_poly = size_grid(start, POINT_POLY_STOP, POINT_POLY_POINTS, grid_sampling)
+
+        jobs = []
+        known = set()
+        for engine, spec in self.engines.items():
+            database = spec.connect()
+            tables, id_tables = Analyzer(database).table_definitions(geospatial, ids)
+            # Each engine runs the strategies it has, so one list can span engines
+            strategies = tuple(s for s in index_strategies if s in database.index_strategies)
+            known.update(strategies)
+            database.close()
+
+            for name, data in tables.items():
+                table_geospatial = 'point' in name or 'poly' in name
+                keys = list(data.keys())
+                ndx = [x for x in keys if 'ndx' in x][0]
+                plain = [x for x in keys if 'plain' in x][0]
+                queries = generate_queries(name, plain, data[plain], ndx, data[ndx])
+                num_trials = GEOSPATIAL_TRIALS if table_geospatial else SELECT_TRIALS
+                num_join_trials = GEOSPATIAL_JOIN_TRIALS if table_geospatial else JOIN_TRIALS
+                max_trials = num_trials if table_geospatial else None
+                for size in grid_small if table_geospatial else grid:
+                    jobs.append(Job(engine, size, {name: (data, ndx, table_geospatial)}, [
+                        QueryJob(f'selects/{plain}', queries[0], num_trials, max_trials=max_trials),
+                        QueryJob(f'selects/{ndx}', queries[1], num_trials, (ndx,), max_trials=max_trials),
+                        QueryJob(f'joins/{plain}', queries[2], num_join_trials, kind='join',
+                                 max_trials=num_join_trials),
+                        QueryJob(f'joins/{ndx}', queries[3], num_join_trials, (ndx,), 'join', num_join_trials)
+                    ], strategies))
+
+            if 'point_test' in tables and 'poly_test' in tables:
+                data_point = tables['point_test']
+                data_poly = tables['poly_test']
+                queries = generate_queries(
+                    'point_test', 'pt_plain', data_point['pt_plain'], 'pt_ndx', data_point['pt_ndx'],
+                    'poly_test', 'poly_plain', data_poly['poly_plain'], 'poly_ndx', data_poly['poly_ndx']
+                )
+                for size in grid_point_poly:
+                    jobs.append(Job(engine, size, {'point_test': (data_point, 'pt_ndx', True),
+                                                   'poly_test': (data_poly, 'poly_ndx', True)}, [
+                        QueryJob('joins/point_poly_plain', queries[0], POINT_POLY_TRIALS, kind='point_poly',
+                                 max_trials=POINT_POLY_TRIALS),
+                        QueryJob('joins/point_poly_ndx', queries[1], POINT_POLY_TRIALS, ('pt_ndx', 'poly_ndx'),
+                                 'point_poly', POINT_POLY_TRIALS)
+                    ]))
+
+            for name, data in id_tables.items():
+                for size in grid:
+                    jobs.append(Job(engine, size, {name: (data, None, False)}, [
+                        QueryJob(f'ids/{name}', generate_id_query(name, data['id']), ID_TRIALS, kind='id')
+                    ]))
+
+        for strategy in index_strategies:
+            if strategy not in known:
+                raise ValueError(f'Unknown index strategy {strategy} for {", ".join(self.engines)}')
+        return jobs
+
+    def _resources(self, job: Job) -> set[tuple[str, str]]:
+        if self.isolate_namespaces:
+            return set()
+        return {(job.engine, table) for table in job.tables}
+
+    def run(self, jobs: list[Job]) -> list[JobResult]:
+        manager = multiprocessing.Manager() if self.mode == 'isolated' else None
+        timing_lock = manager.Lock() if manager is not None else None
+        pending = list(jobs)
+        running: dict[Future, Job] = {}
+        busy: set[tuple[str, str]] = set()
+        results = []
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                while pending or running:
+                    for job in list(pending):
+                        if len(running) >= self.max_workers:
+                            break
+                        engine_jobs = sum(1 for other in running.values() if other.engine == job.engine)
+                        if engine_jobs >= self.max_per_engine or self._resources(job) & busy:
+                            continue
+                        pending.remove(job)
+                        busy |= self._resources(job)
+                        namespace = f'job{jobs.index(job)}' if self.isolate_namespaces else None
+                        print(f'Starting {job.name}')
+                        future = pool.submit(run_job, self.engines[job.engine], job, namespace, timing_lock,
+                                             self.seed, self.timing)
+                        running[future] = job
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = running.pop(future)
+                        busy -= self._resources(job)
+                        result = future.result()
+                        print(f'Finished {job.name} in {result.seconds} seconds')
+                        results.append(result)
+        finally:
+            if manager is not None:
+                manager.shutdown()
+        return results
+
+    @staticmethod
+    def report(results: list[JobResult]) -> dict:
+        # engine -> series -> points ordered by size, the same layout as Analyzer reports
+        report = {}
+        for result in sorted(results, key=lambda r: (r.engine, r.size)):
+            for series, distribution in result.distributions.items():
+                report.setdefault(result.engine, {}).setdefault(series, []).append(
+                    {'size': result.size, **asdict(distribution)})
+        return report
@@ -0,0 +1,112 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+
+class SnapshotCache:
+    # On-disk cache of loaded benchmark tables, keyed by everything that determines their contents
+
+    def __init__(self, root: str = 'snapshots', max_bytes: int = 20 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(root, 'index.json')
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(engine: str, table: str, n: int, columns: dict[str, str], seed: int,
+            spatial: Optional[dict] = None) -> str:
+        ident = json.dumps([engine, table, n, list(columns.items()), seed] + ([spatial] if spatial is not None else []))
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def _read_index(self) -> dict[str, dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as file:
+            return json.loads(file.read())
+
+    def _write_index(self, index: dict[str, dict]) -> None:
+        with open(self.index_file + '.tmp', 'w') as file:
+            file.write(json.dumps(index, indent=4))
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.root, key + suffix)
+
+    def get(self, key: str) -> Optional[str]:
+        index = self._read_index()
+        entry = index.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry['file'])
+        if not os.path.exists(path):
+            del index[key]
+            self._write_index(index)
+            return None
+        entry['last_used'] = time.time()
+        self._write_index(index)
+        return path
+
+    def put(self, key: str, path: str, **meta) -> None:
+        index = self._read_index()
+        index[key] = {
+            'file': os.path.basename(path),
+            'bytes': os.path.getsize(path),
+            'created': time.time(),
+            'last_used': time.time(),
+            **meta
+        }
+        self._write_index(index)
+        self.prune(self.max_bytes)
+
+    def entries(self) -> list[tuple[str, dict]]:
+        return sorted(self._read_index().items(), key=lambda item: item[1]['last_used'], reverse=True)
+
+    def prune(self, max_bytes: Optional[int] = None) -> list[str]:
+        # Evicts least recently used snapshots until the cache fits in max_bytes (everything when None)
+        index = self._read_index()
+        total = sum(entry['bytes'] for entry in index.values())
+        evicted = []
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if max_bytes is not None and total <= max_bytes:
+                break
+            path = os.path.join(self.root, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entry['bytes']
+            del index[key]
+            evicted.append(key)
+        self._write_index(index)
+        return evicted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and prune cached benchmark table snapshots')
+    parser.add_argument('--root', default='snapshots')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list')
+    prune = commands.add_parser('prune')
+    prune.add_argument('--max-bytes', type=int, default=None, help='Evict least recently used entries down to this size')
+    prune.add_argument('--all', action='store_true', help='Remove every snapshot')
+    args = parser.parse_args()
+
+    cache = SnapshotCache(args.root)
+    if args.command == 'list':
+        total = 0
+        for key, entry in cache.entries():
+            total += entry['bytes']
+            last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used']))
+            print(f"{key[:12]}  {entry.get('engine')}  {entry.get('table')}  rows={entry.get('rows')}  "
+                  f"seed={entry.get('seed')}  {entry['bytes'] / 1024 ** 2:.1f} MiB  last used {last_used}")
+        print(f'{len(cache.entries())} snapshots, {total / 1024 ** 2:.1f} MiB')
+    elif args.command == 'prune':
+        if not args.all and args.max_bytes is None:
+            parser.error('prune needs --max-bytes or --all')
+        evicted = cache.prune(None if args.all else args.max_bytes)
+        print(f'Evicted {len(evicted)} snapshots')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import sqlite3
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from analyzer import Analyzer
+from databases.sqlite import PRAGMA_PROFILES, SqliteDatabase
+from results_store import ResultsStore
+from snapshots import SnapshotCache
+
+
+# SQLite's compiled-in defaults come first, so the first configuration of the default grid is the baseline
+SWEEP_GRID = {
+    'mmap_size': (0, 268435456),
+    'page_size': (4096, 16384),
+    'cache_size': (-2000, -65536),
+    'journal_mode': ('delete', 'wal'),
+}
+
+
+@dataclass(frozen=True)
+class SweepConfig:
+    mmap_size: int  # Bytes of the file memory-mapped per connection, 0 for read() I/O
+    page_size: int  # Fixed when the file is built, so every page size gets its own rebuilt file
+    cache_size: int  # Pages when positive, KiB when negative, as the pragma takes it
+    journal_mode: str
+
+    @property
+    def label(self) -> str:
+        return f'mmap={self.mmap_size},page={self.page_size},cache={self.cache_size},journal={self.journal_mode}'
+
+    def pragmas(self) -> dict:
+        # Timed under the engine's default durability, so only the swept settings differ between runs
+        return dict(PRAGMA_PROFILES['default'], journal_mode=self.journal_mode, cache_size=self.cache_size,
+                    mmap_size=self.mmap_size)
+
+
+@dataclass
+class SweepWinner:
+    group: str  # A series, or a query type ('selects', 'joins', 'ids', ...) for the whole group
+    size: int
+    config: str
+    median: float  # Geometric mean of the series medians for a query type
+    baseline_median: Optional[float]
+    speedup: Optional[float]  # baseline_median / median
+
+
+def grid(mmap_sizes=SWEEP_GRID['mmap_size'], page_sizes=SWEEP_GRID['page_size'],
+         cache_sizes=SWEEP_GRID['cache_size'], journal_modes=SWEEP_GRID['journal_mode']) -> list[SweepConfig]:
+    # Grouped by page size, so each page size's file is rebuilt once
+    configs = [SweepConfig(mmap, page, cache, journal)
+               for page, mmap, cache, journal in itertools.product(page_sizes, mmap_sizes, cache_sizes, journal_modes)]
+    for config in configs:
+        if config.page_size < 512 or config.page_size > 65536 or config.page_size & (config.page_size - 1):
+            raise ValueError(f'page_size must be a power of two between 512 and 65536, not {config.page_size}')
+    return configs
+
+
+def remove_database(path: str) -> None:
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def rebuild(source: str, path: str, page_size: int) -> None:
+    # page_size only takes effect on an empty file or through a VACUUM, which cannot run in WAL mode
+    remove_database(path)
+    connection = sqlite3.connect(source)
+    try:
+        connection.execute('vacuum into ?;', (path,))
+    finally:
+        connection.close()
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('pragma journal_mode = delete;').fetchall()
+        connection.execute(f'pragma page_size = {page_size};')
+        connection.execute('vacuum;')
+        actual = connection.execute('pragma page_size;').fetchone()[0]
+    finally:
+        connection.close()
+    if actual != page_size:
+        raise RuntimeError(f'Rebuilt {path} with page_size {actual} instead of {page_size}')
+
+
+def effective_settings(database: SqliteDatabase) -> dict:
+    # mmap_size is silently capped by SQLITE_MAX_MMAP_SIZE, so the values actually in force are recorded
+    return {pragma: database.cursor.execute(f'pragma {pragma};').fetchone()[0]
+            for pragma in ('mmap_size', 'page_size', 'cache_size', 'journal_mode')}
+
+
+def find_winners(medians: dict[str, dict[tuple[str, int], float]], baseline: Optional[str]) -> list[SweepWinner]:
+    # medians: config label -> (series, size) -> median seconds. Each series and size gets the configuration with
+    # the lowest median; each query type and size the one with the lowest geometric mean over that type's series
+    groups: dict[tuple[str, int], dict[str, float]] = {}
+    for label, points in medians.items():
+        for (series, size), median in points.items():
+            groups.setdefault((series, size), {})[label] = median
+
+        by_type: dict[tuple[str, int], list[float]] = {}
+        for (series, size), median in points.items():
+            by_type.setdefault((series.partition('/')[0], size), []).append(median)
+        for (query_type, size), values in by_type.items():
+            # Only compared across configurations that measured the same series
+            groups.setdefault((f'{query_type}/*', size), {})[label] = (
+                math.exp(sum(math.log(max(v, 1e-12)) for v in values) / len(values)), len(values))
+
+    winners = []
+    for (group, size), candidates in sorted(groups.items()):
+        if group.endswith('/*'):
+            most = max(count for _, count in candidates.values())
+            candidates = {label: value for label, (value, count) in candidates.items() if count == most}
+        label = min(candidates, key=candidates.get)
+        base = candidates.get(baseline) if baseline is not None else None
+        winners.append(SweepWinner(group, size, label, candidates[label], base,
+                                   base / candidates[label] if base is not None and candidates[label] > 0 else None))
+    return winners
+
+
+def run_sweep(source: str, out_file: str, configs: Optional[list[SweepConfig]] = None, seed: int = 1,
+              results: Optional[ResultsStore] = None, snapshots: Optional[SnapshotCache] = None,
+              work_dir: Optional[str] = None, keep_files: bool = False, **analysis) -> dict:
+    # Re-runs the Analyzer's select, join and id workloads once per configuration, each on a fresh copy of
+    # source (which holds the empty benchmark tables) built with that configuration's page size. A fixed seed
+    # loads identical rows under every configuration
+    configs = configs or grid()
+    results = results or ResultsStore()
+    root, ext = os.path.splitext(os.path.join(work_dir, os.path.basename(source)) if work_dir else source)
+    ext = ext or '.db'
+
+    runs = []
+    medians = {}
+    templates = {}
+    try:
+        for n, config in enumerate(configs):
+            print(f'Sweep {n + 1}/{len(configs)}: {config.label}')
+            if config.page_size not in templates:
+                templates[config.page_size] = f'{root}_page{config.page_size}{ext}'
+                rebuild(source, templates[config.page_size], config.page_size)
+            path = f'{root}_sweep{ext}'
+            remove_database(path)
+            shutil.copyfile(templates[config.page_size], path)
+
+            pragmas = config.pragmas()
+            # Loaded in the same journal mode it is timed in: leaving WAL needs exclusive access to the file
+            database = SqliteDatabase(path, pragma_profile=dict(PRAGMA_PROFILES['fast'],
+                                                                journal_mode=config.journal_mode),
+                                      measure_profile=pragmas)
+            try:
+                settings = effective_settings(database)
+                analyzer = Analyzer(database, seed, snapshots, results)
+                config_out = f'{os.path.splitext(out_file)[0]}_{n}.json'
+                analyzer.run_analysis(config_out, **analysis)
+            finally:
+                database.close()
+                if not keep_files:
+                    remove_database(path)
+
+            medians[config.label] = {(row[3], row[4]): row[10] for row in results.points(analyzer.run_id)}
+            runs.append({'config': asdict(config), 'label': config.label, 'settings': settings,
+                         'run_id': analyzer.run_id, 'report': config_out})
+    finally:
+        if not keep_files:
+            for template in templates.values():
+                remove_database(template)
+
+    baseline = configs[0].label
+    winners = find_winners(medians, baseline)
+    report = {'baseline': baseline, 'runs': runs, 'winners': [asdict(w) for w in winners]}
+    with open(out_file, 'w') as file:
+        file.write(json.dumps(report, indent=4))
+
+    for winner in winners:
+        if winner.group.endswith('/*'):
+            speedup = f'{winner.speedup:.2f}x' if winner.speedup is not None else 'n/a'
+            print(f'{winner.group:<12}{winner.size:>9}  {speedup:>7}  {winner.config}')
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep SQLite storage settings over the Analyzer workloads')
+    parser.add_argument('source', help='SQLite file holding the empty benchmark tables')
+    parser.add_argument('out_file')
+    parser.add_argument('--db', default='analyses/results.db')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mmap-size', type=int, nargs='+', default=SWEEP_GRID['mmap_size'])
+    parser.add_argument('--page-size', type=int, nargs='+', default=SWEEP_GRID['page_size'])
+    parser.add_argument('--cache-size', type=int, nargs='+', default=SWEEP_GRID['cache_size'])
+    parser.add_argument('--journal-mode', nargs='+', default=SWEEP_GRID['journal_mode'])
+    parser.add_argument('--start', type=int, default=100)
+    parser.add_argument('--stop', type=int, default=1000000)
+    parser.add_argument('--num-points', type=int, default=10)
+    parser.add_argument('--ids', action='store_true')
+    parser.add_argument('--work-dir', default=None, help='Where the rebuilt copies go, next to source by default')
+    parser.add_argument('--keep-files', action='store_true')
+    args = parser.parse_args()
+
+    results = ResultsStore(args.db)
+    try:
+        run_sweep(args.source, args.out_file, grid(args.mmap_size, args.page_size, args.cache_size, args.journal_mode),
+                  args.seed, results, work_dir=args.work_dir, keep_files=args.keep_files,
+                  start=args.start, stop=args.stop, num_points=args.num_points, ids=args.ids)
+    finally:
+        results.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import math
+import time
+from statistics import NormalDist
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from tracing import span
+
+
+@dataclass
+class TimingPolicy:
+    warmup: int = 1  # Runs discarded before sampling starts
+    max_trials: int = 1000
+    target_ci: float = 0.05  # Stop once the median's CI is this narrow, relative to the median
+    time_budget: Optional[float] = 10.0  # Seconds per measurement before giving up on target_ci
+    confidence: float = 0.95
+    resamples: int = 1000
+
+
+@dataclass
+class Distribution:
+    samples: list[float]  # Raw per-trial seconds, warmups excluded
+    warmup: int
+    mean: float
+    min: float
+    median: float
+    p90: float
+    p99: float
+    stddev: float
+    ci_low: float  # Bootstrap confidence interval of the median
+    ci_high: float
+    confidence: float
+    plan: Optional[dict] = None  # Captured QueryPlan when measuring with EXPLAIN
+    fetch: Optional[dict] = None  # Result consumption stats when measuring with a fetch mode
+    matched: Optional[dict] = None  # Rows matched by each rotated parameter set of a query bank query
+
+    @property
+    def trials(self) -> int:
+        return len(self.samples)
+
+    @property
+    def ci_width(self) -> float:
+        return (self.ci_high - self.ci_low) / self.median if self.median > 0 else math.inf
+
+
+def bootstrap_ci(samples: np.ndarray, confidence: float = 0.95, resamples: int = 1000,
+                 seed: int = 0) -> tuple[float, float]:
+    if len(samples) < 2:
+        return float(samples[0]), float(samples[0])
+    if len(samples) > 20000:
+        # Resampling gets expensive for load-test sized samples, where the distribution-free
+        # order-statistic interval for the median is just as good
+        ordered = np.sort(samples)
+        z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+        half_width = z * math.sqrt(len(samples)) / 2
+        low = max(0, math.floor(len(samples) / 2 - half_width))
+        high = min(len(samples) - 1, math.ceil(len(samples) / 2 + half_width))
+        return float(ordered[low]), float(ordered[high])
+    rng = np.random.default_rng(seed)
+    medians = np.median(rng.choice(samples, size=(resamples, len(samples))), axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(medians, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def summarize(samples: list[float], warmup: int = 0, confidence: float = 0.95, resamples: int = 1000) -> Distribution:
+    values = np.asarray(samples, dtype=np.float64)
+    ci_low, ci_high = bootstrap_ci(values, confidence, resamples)
+    return Distribution(
+        samples=list(samples),
+        warmup=warmup,
+        mean=float(values.mean()),
+        min=float(values.min()),
+        median=float(np.median(values)),
+        p90=float(np.percentile(values, 90)),
+        p99=float(np.percentile(values, 99)),
+        stddev=float(values.std(ddof=1)) if len(values) > 1 else 0.0,
+        ci_low=ci_low,
+        ci_high=ci_high,
+        confidence=confidence
+    )
+
+
+def measure(trial: Callable[[], float], min_trials: int, policy: Optional[TimingPolicy] = None) -> Distribution:
+    # Runs trial (which returns its own elapsed seconds) until the median's confidence interval is narrow
+    # enough, max_trials is reached or the time budget runs out, but never fewer than min_trials times
+    policy = policy or TimingPolicy()
+    for i in range(policy.warmup):
+        with span('trial', 'query', trial=i, warmup=True):
+            trial()
+
+    samples = []
+    next_check = min_trials
+    start = time.perf_counter_ns()
+    while len(samples) < max(min_trials, policy.max_trials):
+        with span('trial', 'query', trial=len(samples)) as args:
+            samples.append(trial())
+            args['seconds'] = samples[-1]
+        if len(samples) < min_trials:
+            continue
+        if policy.time_budget is not None and (time.perf_counter_ns() - start) / 1e9 >= policy.time_budget:
+            break
+        if len(samples) >= next_check:
+            # Bootstrapping is far more expensive than a fast query, so only re-check as the sample grows by 25%
+            next_check = math.ceil(len(samples) * 1.25)
+            values = np.asarray(samples)
+            low, high = bootstrap_ci(values, policy.confidence, policy.resamples)
+            median = float(np.median(values))
+            if median > 0 and (high - low) / median <= policy.target_ci:
+                break
+
+    return summarize(samples, policy.warmup, policy.confidence, policy.resamples)
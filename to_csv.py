@@ -1,26 +1,28 @@
-import json
+import argparse
 
+from results_store import ResultsStore
 
-# For easy spreadsheet importing
-def json_to_csv(file_gen):
-    data_list = []
-    with open(file_gen + '.json') as file:
-        data = json.loads(file.read())
 
-        for k, v in data.items():
-            for k2, v2 in v.items():
-                if v2 is not None:
-                    data_list.append([k, k2] + v2)
+# For easy spreadsheet importing
+def main():
+    parser = argparse.ArgumentParser(description='Export benchmark results from the results store')
+    parser.add_argument('out_file')
+    parser.add_argument('--db', default='analyses/results.db')
+    parser.add_argument('--run', type=int, default=None, help='Run id to export, every run by default')
+    parser.add_argument('--latest', default=None, metavar='ENGINE', help="Export the engine's most recent run")
+    parser.add_argument('--raw', action='store_true', help='One row per trial instead of one per point')
+    parser.add_argument('--format', choices=('csv', 'json'), default=None,
+                        help='Defaults to the extension of out_file')
+    args = parser.parse_args()
 
-    with open(file_gen + '.csv', 'w') as file:
-        out = ''
-        for lst in data_list:
-            for item in lst:
-                out += str(item) + ','
-            out = out[:-1] + '\n'
-        file.write(out)
+    store = ResultsStore(args.db)
+    run_id = store.latest_run(args.latest) if args.latest is not None else args.run
+    fmt = args.format or ('json' if args.out_file.endswith('.json') else 'csv')
+    export = store.export_json if fmt == 'json' else store.export_csv
+    rows = export(args.out_file, run_id, args.raw)
+    store.close()
+    print(f'Wrote {rows} rows to {args.out_file}')
 
 
-json_to_csv('analyses/analysis_pg')
-json_to_csv('analyses/analysis_ms')
-json_to_csv('analyses/analysis_sl')
+if __name__ == "__main__":
+    main()
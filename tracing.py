@@ -0,0 +1,209 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, TextIO
+
+import progressbar
+
+
+@dataclass
+class Span:
+    name: str  # e.g. 'generate', 'insert_batch', 'commit', 'build_index', 'clear_table', 'trial', 'fetch'
+    category: str  # 'load', 'index', 'query' or 'run'
+    args: dict = field(default_factory=dict)  # Free to be filled in while the span is open, e.g. rows fetched
+    start_ns: int = 0
+    end_ns: Optional[int] = None
+    thread: int = 0
+    thread_name: str = ''
+    parent: Optional[str] = None
+
+    @property
+    def seconds(self) -> float:
+        return ((self.end_ns or time.perf_counter_ns()) - self.start_ns) / 1e9
+
+
+class Sink:
+
+    def start(self, span: Span) -> None:
+        pass
+
+    def end(self, span: Span) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JsonLinesSink(Sink):
+    # One object per finished span, flushed as it ends so a crashed run keeps everything up to the crash
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w')
+        self.lock = threading.Lock()
+        self.origin = time.time_ns() - time.perf_counter_ns()
+
+    def end(self, span):
+        line = json.dumps({'name': span.name, 'category': span.category, 'parent': span.parent,
+                           'start': (self.origin + span.start_ns) / 1e9, 'seconds': span.seconds,
+                           'thread': span.thread_name, 'args': span.args}, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ChromeTraceSink(Sink):
+    # Trace Event Format, readable by chrome://tracing and Perfetto. The viewers accept an array missing its
+    # closing bracket, so a trace cut short by a crash still opens
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w')
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.threads: set[int] = set()
+        self.file.write('[\n')
+        self.first = True
+
+    def _write(self, event: dict) -> None:
+        self.file.write(('' if self.first else ',\n') + json.dumps(event, default=str))
+        self.first = False
+
+    def end(self, span):
+        with self.lock:
+            if span.thread not in self.threads:
+                self.threads.add(span.thread)
+                self._write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': span.thread,
+                             'args': {'name': span.thread_name}})
+            self._write({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': self.pid, 'tid': span.thread,
+                         'ts': (span.start_ns - self.origin) / 1000, 'dur': (span.end_ns - span.start_ns) / 1000,
+                         'args': span.args})
+
+    def close(self):
+        with self.lock:
+            self.file.write('\n]\n')
+            self.file.close()
+
+
+class ProgressSink(Sink):
+    # A live bar per table load, fed by insert_batch spans carrying rows and total, with rows/sec and ETA
+
+    def __init__(self, stream: TextIO = sys.stderr):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.bars: dict[str, tuple[progressbar.ProgressBar, int, int]] = {}
+
+    def end(self, span):
+        if span.name != 'insert_batch' or 'total' not in span.args:
+            return
+        table = span.args.get('table', '')
+        with self.lock:
+            if table not in self.bars:
+                # FileTransferSpeed scales by 1024, so the rate is computed here in plain rows/sec
+                widgets = [f'{table} ', progressbar.Percentage(), ' ', progressbar.Bar(), ' ',
+                           progressbar.Variable('rate', format='{formatted_value} rows/s', width=9, precision=9),
+                           ' ', progressbar.ETA()]
+                bar = progressbar.ProgressBar(max_value=span.args['total'], widgets=widgets, fd=self.stream)
+                self.bars[table] = (bar.start(), 0, span.start_ns)
+            bar, rows, started = self.bars[table]
+            rows += span.args.get('rows', 0)
+            rate = f'{rows / max((span.end_ns - started) / 1e9, 1e-9):.0f}'
+            if rows >= span.args['total']:
+                bar.update(span.args['total'], rate=rate)
+                bar.finish()
+                del self.bars[table]
+            else:
+                bar.update(rows, rate=rate)
+                self.bars[table] = (bar, rows, started)
+
+    def close(self):
+        with self.lock:
+            for bar, _, _ in self.bars.values():
+                bar.finish(dirty=True)
+            self.bars.clear()
+
+
+class Tracer:
+    # Spans nest per thread. Without sinks a span only enters and leaves a context manager
+
+    def __init__(self, sinks: tuple[Sink, ...] = ()):
+        self.sinks: list[Sink] = list(sinks)
+        self.local = threading.local()
+
+    def add_sink(self, sink: Sink) -> Sink:
+        self.sinks.append(sink)
+        return sink
+
+    def close(self) -> None:
+        sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            sink.close()
+
+    def current(self) -> Optional[str]:
+        # Name of the innermost span open on this thread
+        stack = self.local.__dict__.get('stack')
+        return stack[-1].name if stack else None
+
+    def record(self, name: str, category: str, start_ns: int, end_ns: int, parent: Optional[str] = None,
+               **args) -> None:
+        # A span timed by the caller, for intervals a context manager cannot bracket (such as across a generator's
+        # yield). It never enters the thread's stack, so it cannot leave it out of order
+        if not self.sinks:
+            return
+        thread = threading.current_thread()
+        span = Span(name, category, args, start_ns, end_ns, thread.ident, thread.name, parent)
+        for sink in self.sinks:
+            sink.start(span)
+        for sink in self.sinks:
+            sink.end(span)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'run', **args) -> Iterator[dict]:
+        if not self.sinks:
+            yield args
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        thread = threading.current_thread()
+        span = Span(name, category, args, time.perf_counter_ns(), None, thread.ident, thread.name,
+                    stack[-1].name if stack else None)
+        stack.append(span)
+        for sink in self.sinks:
+            sink.start(span)
+        try:
+            yield span.args
+        except BaseException as e:
+            span.args['error'] = repr(e)
+            raise
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            stack.pop()
+            for sink in self.sinks:
+                sink.end(span)
+
+
+# The process-wide tracer the benchmark phases report to; it does nothing until a sink is added
+TRACER = Tracer()
+
+
+def span(name: str, category: str = 'run', **args):
+    return TRACER.span(name, category, **args)
+
+
+def record(name: str, category: str, start_ns: int, end_ns: int, parent: Optional[str] = None, **args) -> None:
+    TRACER.record(name, category, start_ns, end_ns, parent, **args)
+
+
+def configure(progress: bool = False, jsonl: Optional[str] = None, chrome: Optional[str] = None) -> Tracer:
+    if progress:
+        TRACER.add_sink(ProgressSink())
+    if jsonl is not None:
+        TRACER.add_sink(JsonLinesSink(jsonl))
+    if chrome is not None:
+        TRACER.add_sink(ChromeTraceSink(chrome))
+    return TRACER
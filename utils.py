@@ -1,5 +1,18 @@
+import re
 import string
 import random
+import struct
+
+import numpy as np
+
+from databases.sql import IndexStrategy
+from databases.sqlite import rtree_table
+from geometry import bounds, wkb_points, wkb_polygons
+
+
+# The Postgres query point and polygon, as plain WKB blob literals for SQLite
+SQLITE_POINT = struct.unpack('<dd', bytes.fromhex('C8A6504D69534940ACCE10014CF562C0'))
+SQLITE_POLYGON = [(30, 10), (40, 40), (20, 40), (10, 20)]
 
 
 def random_string(length: int) -> str:
@@ -7,10 +20,51 @@ def random_string(length: int) -> str:
     return ''.join(random.choices(characters, k=length))
 
 
+def box_filter(rtree: str, minx: float, maxx: float, miny: float, maxy: float) -> str:
+    return (f"rowid in (select id from {rtree} "
+            f"where minx <= {maxx} and maxx >= {minx} and miny <= {maxy} and maxy >= {miny})")
+
+
+def rtree_join(table: str, col: str, table2: str, col2: str, condition: str) -> str:
+    # Pairs rows through the R*Trees of both columns (named after their index, which the Analyzer names after the
+    # column) before the exact predicate in the where clause
+    return (f"select a.*, b.* from {table} a join {rtree_table(col)} ra on ra.id = a.rowid "
+            f"join {rtree_table(col2)} rb on {condition} join {table2} b on b.rowid = rb.id where ")
+
+
+def generate_sqlite_queries(table: str, col1: str, type1: str, col2: str,
+                            table2: str = None, col3: str = None, col4: str = None):
+    # SQLite has no geometry type: columns hold WKB blobs, the plain column is filtered by the exact Python
+    # predicate alone and the indexed one by its R*Tree first
+    if table2 is not None:
+        within = "rb.minx <= ra.minx and rb.maxx >= ra.maxx and rb.miny <= ra.miny and rb.maxy >= ra.maxy"
+        return [f"select * from {table} a join {table2} b on st_contains(b.{col3}, a.{col1});",
+                rtree_join(table, col2, table2, col4, within) + f"st_contains(b.{col4}, a.{col2});"]
+    if type1 == 'point':
+        x, y = SQLITE_POINT
+        point = f"x'{wkb_points(np.array([SQLITE_POINT])).tobytes().hex()}'"
+        near = ("rb.minx <= ra.maxx + 10 and rb.maxx >= ra.minx - 10 "
+                "and rb.miny <= ra.maxy + 10 and rb.maxy >= ra.miny - 10")
+        return [f"select * from {table} where st_dwithin({col1}, {point}, 10);",
+                f"select * from {table} where {box_filter(rtree_table(col2), x - 10, x + 10, y - 10, y + 10)} "
+                f"and st_dwithin({col2}, {point}, 10);",
+                f"select * from {table} a join {table} b on st_dwithin(a.{col1}, b.{col1}, 10);",
+                rtree_join(table, col2, table, col2, near) + f"st_dwithin(a.{col2}, b.{col2}, 10);"]
+    polygon = f"x'{wkb_polygons(np.array([SQLITE_POLYGON], dtype=np.float64)).tobytes().hex()}'"
+    overlap = "rb.minx <= ra.maxx and rb.maxx >= ra.minx and rb.miny <= ra.maxy and rb.maxy >= ra.miny"
+    return [f"select * from {table} where st_overlaps({polygon}, {col1});",
+            f"select * from {table} where {box_filter(rtree_table(col2), *bounds(SQLITE_POLYGON))} "
+            f"and st_overlaps({polygon}, {col2});",
+            f"select * from {table} a join {table} b on st_overlaps(a.{col1}, b.{col1});",
+            rtree_join(table, col2, table, col2, overlap) + f"st_overlaps(a.{col2}, b.{col2});"]
+
+
 def generate_queries(table: str, col1: str, type1: str, col2: str, type2: str,
                      table2: str = None, col3: str = None, type3: str = None, col4: str = None, type4: str = None):
     where = None
     joins = None
+    if type1 in ('point', 'polygon'):
+        return generate_sqlite_queries(table, col1, type1, col2, table2, col3, col4)
     if table2 is not None:
         if type1 == 'geometry(point, 4326)' and type3 == 'geometry(polygon, 4326)':
             joins = [f"st_contains(b.{col3}, a.{col1});", f"st_contains(b.{col4}, a.{col2});"]
@@ -52,3 +106,22 @@ def generate_id_query(table: str, _type: str):
     if _type == 'binary(16)':
         where = "id = unhex(replace(uuid(),'-',''));"
     return f"select * from {table} where " + where
+
+
+def strategy_queries(queries: list[str], column: str, strategy: IndexStrategy, rows: int,
+                     ordinal: str = 'id') -> list[str]:
+    # Rewrites select and join queries (or query bank templates) on column so an expression or partial index can
+    # answer them: the column, and any %s compared with it, become the indexed expression, and the partial
+    # index's predicate is added for every aliased copy of the table
+    rewritten = []
+    for query in queries:
+        query = query.rstrip().rstrip(';')
+        if strategy.expression is not None:
+            query = re.sub(rf'\b((?:[ab]\.)?{column})\b', lambda m: strategy.expression.format(column=m.group(1)), query)
+            query = query.replace('%s', strategy.expression.format(column='%s'))
+        if strategy.predicate is not None:
+            aliases = ('a.', 'b.') if re.search(r' a join \w+ b ', query) else ('',)
+            predicate = ' and '.join(strategy.condition(f'{alias}{ordinal}', rows) for alias in aliases)
+            query += f' and {predicate}' if ' where ' in query else f' where {predicate}'
+        rewritten.append(query + ';')
+    return rewritten